@@ -1,5 +1,9 @@
 import argparse
 from .utils import clone_dashboard
+from .utils import planner
+from .utils import instrumentation
+from .utils.state_store import StateStore
+from .utils.catalog import Catalog
 from .utils.client import Client
 import json
 
@@ -23,20 +27,67 @@ parser.add_argument("--config_file", default="config.json", required=False,
                     help="configuration file containing credential and dashboard to clone")
 parser.add_argument("--state_file", default="state.json", required=False,
                     help="state containing the links between the already cloned dashboard. Used to update resources")
+parser.add_argument("--dump_folder", default=None, required=False,
+                    help="optional folder where the source dashboard definitions are also saved as json")
+parser.add_argument("--dump_cache", default=None, required=False,
+                    help="optional file caching the source definitions: the dashboards and queries which didn't change since the previous run aren't fetched again")
+parser.add_argument("--catalog", default=None, required=False,
+                    help="optional SQLite file keeping the listings and definitions of the workspaces between the runs, refreshed incrementally")
+parser.add_argument("--resume", action="store_true",
+                    help="skip the dashboards already cloned by the previous run if it was interrupted")
+parser.add_argument("--plan", default=None, required=False,
+                    help="dry run: save the operations the clone would run in this file, without changing the targets")
+parser.add_argument("--execute_plan", default=None, required=False,
+                    help="plan file saved with --plan: runs the clone, skipping the dashboards without planned change")
+parser.add_argument("--metrics", action="store_true",
+                    help="print the number of calls, errors, retries and p50/p95 latency of each endpoint at the end of the run")
+parser.add_argument("--trace", default=None, required=False,
+                    help="save a timeline of all the api calls in this file (chrome trace format, open it in chrome://tracing or Perfetto)")
 args = parser.parse_args()
 
-source_client, target_clients, delete_target_dashboards = get_client(args.config_file)
+metrics = None
+if args.metrics or args.trace is not None:
+    metrics = instrumentation.add_hook(instrumentation.Metrics())
 
-try:
-    with open("state.json", "r") as r:
-        state = json.loads(r.read())
-except:
-    print("state isn't available, create an empty one")
-    state = {}
+source_client, target_clients, delete_target_dashboards = get_client(args.config_file)
+catalog = None
+if args.catalog is not None:
+    catalog = Catalog(args.catalog)
+    for client in [source_client] + target_clients:
+        client.catalog = catalog
 
 clone_dashboard.delete_queries(target_clients[0], "")
 
+#The source is dumped once and cloned to all the targets at the same time
+ready_targets = []
 for target_client in target_clients:
-    clone_dashboard.set_data_source_id_from_endpoint_id(target_client)
-    clone_dashboard.delete_and_clone_dashboards_with_tags(source_client, target_client, source_client.dashboard_tags,
-                                                         delete_target_dashboards, state)
+    try:
+        clone_dashboard.set_data_source_id_from_endpoint_id(target_client)
+        ready_targets.append(target_client)
+    except Exception as e:
+        print(f"ERROR - skipping target {target_client.url}: {e}")
+if args.plan is not None:
+    plan = planner.plan_dashboards_with_tags(source_client, ready_targets, source_client.dashboard_tags,
+                                             delete_target_dashboards, StateStore(args.state_file).load())
+    planner.save_plan(plan, args.plan)
+    planner.print_plan(plan)
+    print(f"Plan saved in {args.plan}, nothing has been changed in the targets.")
+    exit(0)
+
+plan = planner.load_plan(args.execute_plan) if args.execute_plan is not None else None
+#The state is loaded from the state file, including the progress of an interrupted run
+failures = clone_dashboard.delete_and_clone_dashboards_with_tags_to_targets(source_client, ready_targets, source_client.dashboard_tags,
+                                                                           delete_target_dashboards, None, args.dump_folder,
+                                                                           args.state_file, resume=args.resume, plan=plan,
+                                                                           dump_cache_file=args.dump_cache, dump_cache=catalog)
+for target_url, target_failures in failures.items():
+    for dashboard_id, e in target_failures:
+        print(f"ERROR - {target_url}: couldn't clone dashboard {dashboard_id}: {e}")
+if catalog is not None:
+    catalog.close()
+if metrics is not None:
+    if args.metrics:
+        metrics.print_summary()
+    if args.trace is not None:
+        metrics.save_trace(args.trace)
+        print(f"Trace saved in {args.trace}")
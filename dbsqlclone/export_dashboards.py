@@ -0,0 +1,73 @@
+import argparse
+import json
+import sys
+
+from .utils import clone_dashboard
+from .utils import dump_dashboard
+from .utils import instrumentation
+from .utils.bundle import dump_dashboards_to_bundle
+from .utils.catalog import Catalog
+from .utils.client import Client
+
+
+def get_client(config_file):
+    with open(config_file, "r") as r:
+        config = json.loads(r.read())
+        source = Client(config["source"]["url"], config["source"]["token"],
+                        dashboard_tags=config["source"].get("dashboard_tags"))
+        dashboard_ids = config.get("dashboard_id", [])
+        if not isinstance(dashboard_ids, list):
+            dashboard_ids = [dashboard_ids]
+        return source, dashboard_ids, config.get("dashboard_folder", "./dashboards/")
+
+
+def get_dashboard_ids(source_client: Client, ids, tags):
+    #Ids first, then the dashboards having any of the tags, without duplicates
+    dashboard_ids = list(ids)
+    if len(tags) > 0:
+        dashboard_ids += [d["id"] for d in clone_dashboard.get_all_dashboards(source_client, tags)]
+    return list(dict.fromkeys(dashboard_ids))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Exports multiple dashboards to json files (or a .zip bundle) in parallel.")
+    parser.add_argument("--config_file", default="config_export.json", required=False,
+                        help="configuration file containing the source credentials (see config_export.json)")
+    parser.add_argument("--ids", nargs="+", default=[], help="ids of the dashboards to export")
+    parser.add_argument("--tags", nargs="+", default=[], help="export the dashboards having any of these tags")
+    parser.add_argument("--output", default=None, required=False,
+                        help="folder where the dashboards are saved (dashboard-<id>.json), or a .zip bundle. "
+                             "dashboard_folder of the configuration by default")
+    parser.add_argument("--catalog", default=None, required=False,
+                        help="SQLite file keeping the listings and definitions of the source between the runs")
+    parser.add_argument("--workers", type=int, default=dump_dashboard.max_workers, help="number of dashboards exported at the same time")
+    args = parser.parse_args(argv)
+
+    source_client, config_ids, config_folder = get_client(args.config_file)
+    if args.catalog is not None:
+        source_client.catalog = Catalog(args.catalog)
+    ids, tags = args.ids, args.tags
+    if len(ids) == 0 and len(tags) == 0:
+        #Nothing in the command line: the dashboard_id of the configuration, or its dashboard_tags
+        ids, tags = config_ids, (source_client.dashboard_tags or []) if len(config_ids) == 0 else []
+    output = args.output if args.output is not None else config_folder
+    dashboard_ids = get_dashboard_ids(source_client, ids, tags)
+    dump_dashboard.max_workers = args.workers
+
+    progress = instrumentation.add_hook(instrumentation.Progress("exported", len(dashboard_ids)))
+    try:
+        if output.endswith(".zip"):
+            dump_dashboards_to_bundle(source_client, dashboard_ids, output, progress, source_client.catalog)
+        else:
+            dump_dashboard.dump_dashboards(source_client, dashboard_ids, output, progress, source_client.catalog)
+    finally:
+        instrumentation.remove_hook(progress)
+        source_client.close()
+        if source_client.catalog is not None:
+            source_client.catalog.close()
+    report = progress.report()
+    return 1 if report["failed"] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
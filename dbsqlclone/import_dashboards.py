@@ -0,0 +1,125 @@
+import argparse
+import glob
+import json
+import os
+import sys
+
+from .utils import clone_dashboard
+from .utils import instrumentation
+from .utils import load_dashboard
+from .utils import scheduler
+from .utils.bundle import DashboardBundle, is_bundle
+from .utils.catalog import Catalog
+from .utils.client import Client
+from .utils.state_store import save_state_file
+
+
+def get_clients(config_file, pat_token = None):
+    with open(config_file, "r") as r:
+        config = json.loads(r.read())
+        targets = []
+        for target in config["targets"]:
+            token = pat_token if pat_token is not None else target["token"]
+            client = Client(target["url"], token, permissions=target.get("permissions"))
+            if "endpoint_id" in target:
+                client.endpoint_id = target["endpoint_id"]
+            targets.append(client)
+        dashboard_ids = config.get("dashboard_id", [])
+        if not isinstance(dashboard_ids, list):
+            dashboard_ids = [dashboard_ids] if dashboard_ids else []
+        return targets, dashboard_ids, config.get("dashboard_folder", "./dashboards/")
+
+
+def get_files(input, ids, patterns):
+    """Dump files to import: the files matching the patterns, or the files of the ids in the input folder (all of them by default)."""
+    if len(patterns) > 0:
+        return sorted(set(f for pattern in patterns for f in glob.glob(pattern)))
+    if len(ids) > 0:
+        return [os.path.join(input, f"dashboard-{dashboard_id}.json") for dashboard_id in ids]
+    return sorted(glob.glob(os.path.join(input, "dashboard-*.json")))
+
+
+def has_tags(definition, tags):
+    return len(tags) == 0 or not set(tags).isdisjoint(definition["dashboard"].get("tags") or [])
+
+
+def get_definitions(input, ids, patterns, tags):
+    """
+    Returns the number of dashboards, a generator of (dashboard_id, definition) read lazily from the files or the bundle,
+    and the number of dashboard files missing.
+    """
+    if len(patterns) == 0 and is_bundle(input):
+        with DashboardBundle(input) as bundle:
+            dashboard_ids = ids if len(ids) > 0 else bundle.get_dashboard_ids()
+        if len(tags) > 0:
+            with DashboardBundle(input) as bundle:
+                dashboard_ids = [dashboard_id for dashboard_id in dashboard_ids if has_tags(bundle.get_dashboard(dashboard_id), tags)]
+
+        def read_bundle():
+            with DashboardBundle(input) as bundle:
+                for dashboard_id in dashboard_ids:
+                    yield dashboard_id, bundle.get_dashboard(dashboard_id)
+        return len(dashboard_ids), read_bundle(), 0
+    files = get_files(input, ids, patterns)
+    missing = [f for f in files if not os.path.exists(f)]
+    for f in missing:
+        print(f"ERROR - dashboard file {f} doesn't exist, skipping it")
+    files = [f for f in files if f not in missing]
+    if len(tags) > 0:
+        #The files are parsed once: the definitions having the tags are kept in memory
+        definitions = [(load_dashboard.get_dashboard_file_id(f), load_dashboard.read_dashboard_file(f)) for f in files]
+        definitions = [(dashboard_id, definition) for dashboard_id, definition in definitions if has_tags(definition, tags)]
+        return len(definitions), iter(definitions), len(missing)
+    return len(files), ((load_dashboard.get_dashboard_file_id(f), load_dashboard.read_dashboard_file(f)) for f in files), len(missing)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Imports multiple dashboards from json files (or a .zip bundle) in parallel.")
+    parser.add_argument("--config_file", default="config_import.json", required=False,
+                        help="configuration file containing the targets (see config_import.json)")
+    parser.add_argument("--pat_token", default=None, required=False,
+                        help="Personal Access Token used for all the targets, instead of the token of each target")
+    parser.add_argument("--input", default=None, required=False,
+                        help="folder containing the dashboard-<id>.json files, or a .zip bundle. dashboard_folder of the configuration by default")
+    parser.add_argument("--ids", nargs="+", default=[], help="ids of the dashboards to import")
+    parser.add_argument("--files", nargs="+", default=[], help="dump files to import, can be glob patterns: --files 'dumps/*.json'")
+    parser.add_argument("--tags", nargs="+", default=[], help="only import the dashboards having any of these tags")
+    parser.add_argument("--state_file", default=None, required=False,
+                        help="state containing the links with the dashboards already imported, to update them instead of creating new ones")
+    parser.add_argument("--catalog", default=None, required=False,
+                        help="SQLite file keeping the listings and data sources of the targets between the runs")
+    parser.add_argument("--workers", type=int, default=scheduler.max_workers, help="number of threads loading the dashboards of a target")
+    args = parser.parse_args(argv)
+
+    target_clients, config_ids, config_folder = get_clients(args.config_file, args.pat_token)
+    input = args.input if args.input is not None else config_folder
+    ids = args.ids if len(args.ids) > 0 or len(args.files) > 0 or len(args.tags) > 0 else config_ids
+    scheduler.max_workers = args.workers
+    state = {}
+    if args.state_file is not None and os.path.exists(args.state_file):
+        with open(args.state_file, "r") as r:
+            state = json.load(r)
+
+    catalog = Catalog(args.catalog) if args.catalog is not None else None
+    failed = 0
+    for target_client in target_clients:
+        target_client.catalog = catalog
+        #Uses the first endpoint of the target if it doesn't have any endpoint_id, same as clone_resources.py
+        clone_dashboard.set_data_source_id_from_endpoint_id(target_client)
+        total, definitions, missing = get_definitions(input, ids, args.files, args.tags)
+        progress = instrumentation.add_hook(instrumentation.Progress(f"imported to {target_client.url}", total))
+        try:
+            state[target_client.url] = load_dashboard.load_definitions(target_client, definitions, state.get(target_client.url, {}), progress)
+        finally:
+            instrumentation.remove_hook(progress)
+            target_client.close()
+        failed += progress.report()["failed"] + missing
+        if args.state_file is not None:
+            save_state_file(state, args.state_file)
+    if catalog is not None:
+        catalog.close()
+    return 1 if failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dbsqlclone.utils.client import Client
+from . import instrumentation
+from . import load_dashboard
+from .clone_dashboard import get_target_index
+from .load_dashboard import replace_param_query_ids, get_param_query_ids, get_param_query_task, \
+    get_param_queries_warmup, get_query_payload, get_first_vis, get_default_visualization_payload, \
+    get_visualization_payload, get_dashboard_payload, get_widget_payload, content_hash, get_query_state, get_created_query_state, \
+    get_visualization_changes, get_widget_changes, get_widget_hashes, get_known_query, get_known_dashboard, \
+    get_permissions_hash, is_acl_applied, is_permissions_change, read_dashboard
+
+logger = logging.getLogger('dbsqlclone.load')
+
+#Max number of API calls in flight at the same time, shared by all the dashboards being cloned
+max_in_flight = 16
+
+
+class RequestWindow():
+    """
+    Bounded window of in-flight API calls. Every call from every dashboard goes through the same window,
+    the blocking http calls run in a thread pool of the same size.
+    """
+    def __init__(self, max_in_flight = None):
+        if max_in_flight is None:
+            max_in_flight = globals()["max_in_flight"]
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    async def request(self, client: Client, method, path, **kwargs):
+        return (await self.request_with_status(client, method, path, **kwargs))[1]
+
+    async def request_with_status(self, client: Client, method, path, **kwargs):
+        """Returns (status code, json body) of the call."""
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            r = await loop.run_in_executor(self.executor, instrumentation.bind(functools.partial(client.request, method, path, **kwargs)))
+        with r:
+            return r.status_code, r.json()
+
+    async def update(self, client: Client, item, target_id, data):
+        """POST of the in-place update of the target object, raises if it's rejected (same as the threaded engine)."""
+        status_code, updated = await self.request_with_status(client, "POST", f"/api/2.0/preview/sql/{item}/"+target_id, json=data)
+        if status_code >= 400 or updated.get("id") != target_id:
+            raise Exception(f"couldn't update {item} {target_id}: {status_code} {updated}")
+        return updated
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def run(coroutine):
+    """Runs the coroutine to completion, in a separate thread if an event loop is already running (ex: notebooks)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    result = {}
+    def run_in_thread():
+        try:
+            result["value"] = asyncio.run(coroutine)
+        except BaseException as e:
+            result["error"] = e
+    thread = threading.Thread(target=run_in_thread)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def load_dashboards(target_client: Client, dashboard_ids, workspace_state, folder_prefix="./dashboards/", max_in_flight = None):
+    return run(load_dashboards_async(target_client, dashboard_ids, workspace_state, folder_prefix, max_in_flight))
+
+
+def clone_dashboard(dashboard, target_client: Client, dashboard_state: dict = None, parent: str = None, max_in_flight = None, target_index = None, journal = None):
+    async def clone():
+        window = RequestWindow(max_in_flight)
+        try:
+            return await clone_dashboard_async(window, dashboard, target_client, dashboard_state, parent, target_index, journal)
+        finally:
+            window.close()
+    return run(clone())
+
+
+async def load_dashboards_async(target_client: Client, dashboard_ids, workspace_state, folder_prefix="./dashboards/", max_in_flight = None):
+    if workspace_state is None:
+        workspace_state = {}
+    window = RequestWindow(max_in_flight)
+
+    async def load(dashboard_id):
+        dashboard = read_dashboard(dashboard_id, folder_prefix)
+        dashboard_state = workspace_state[dashboard_id] if dashboard_id in workspace_state else {}
+        workspace_state[dashboard_id] = await clone_dashboard_async(window, dashboard, target_client, dashboard_state, target_index=target_index)
+    try:
+        #Lists the target once instead of checking every object of the state
+        target_index = await asyncio.get_running_loop().run_in_executor(window.executor, instrumentation.bind(get_target_index),
+                                                                        target_client, workspace_state)
+        await asyncio.gather(*[load(dashboard_id) for dashboard_id in dashboard_ids])
+    finally:
+        window.close()
+    return workspace_state
+
+
+async def clone_dashboard_async(window: RequestWindow, dashboard, target_client: Client, dashboard_state: dict = None, parent: str = None, target_index = None, journal = None):
+    with instrumentation.phase("dashboard", dashboard=dashboard.get("id", dashboard["dashboard"].get("id"))):
+        if dashboard_state is None:
+            dashboard_state = {}
+        if "queries" not in dashboard_state:
+            dashboard_state["queries"] = {}
+
+        async def load_query(q):
+            with instrumentation.phase("query", query=q["id"]):
+                replace_param_query_ids(q, dashboard_state)
+                query_state = dashboard_state["queries"].get(q["id"], {})
+                new_query = await clone_or_update_query_async(window, dashboard_state, q, target_client, parent, target_index)
+                if "id" not in new_query:
+                    print(f"Warning - query wasn't properly created, import might fail: {new_query}")
+                else:
+                    if journal is not None and new_query["id"] != query_state.get("new_id"):
+                        #Recorded as soon as it's created, the final state is recorded once its visualizations are created
+                        journal.query(q["id"], get_created_query_state(q, new_query))
+                    permissions_hash = query_state.get("permissions_hash") if new_query["id"] == query_state.get("new_id") else None
+                    with instrumentation.phase("visualizations"):
+                        if new_query["id"] == query_state.get("new_id"):
+                            visualizations = update_query_visualization_async(window, target_client, q, new_query, query_state)
+                        else:
+                            visualizations = clone_query_visualization_async(window, target_client, q, new_query)
+                        #The permissions don't depend on the visualizations: both are sent at the same time
+                        if target_client.permisions_defined():
+                            visualizations, permissions_hash = await asyncio.gather(
+                                visualizations, set_permissions_async(window, target_client, "queries", new_query, query_state, target_index))
+                        else:
+                            visualizations = await visualizations
+                    dashboard_state["queries"][q["id"]] = get_query_state(q, new_query, visualizations, target_client, parent)
+                    if permissions_hash is not None:
+                        dashboard_state["queries"][q["id"]]["permissions_hash"] = permissions_hash
+                    if journal is not None and dashboard_state["queries"][q["id"]] != query_state:
+                        journal.query(q["id"], dashboard_state["queries"][q["id"]])
+            return dashboard_state["queries"].get(q["id"], {}).get("hash") != query_state.get("hash") or \
+                   dashboard_state["queries"].get(q["id"], {}).get("new_id") != query_state.get("new_id")
+
+        #First loads the queries used as parameters, in order as the next ones can depend on them
+        tasks = []
+        for q in dashboard["queries"]:
+            if "is_parameter_query" not in q or q["is_parameter_query"]:
+                if await load_query(q):
+                    tasks.append(get_param_query_task(target_client, q, dashboard_state["queries"][q["id"]]["new_id"]))
+        #The param queries job runs in the background, batched with the other dashboards ones
+        warmup = None
+        if len(tasks) > 0:
+            warmup = get_param_queries_warmup(target_client).submit(tasks)
+
+        queries = [q for q in dashboard["queries"] if "is_parameter_query" in q and not q["is_parameter_query"]]
+        await asyncio.gather(*[load_query(q) for q in queries if len(get_param_query_ids(q)) == 0])
+        if warmup is not None:
+            #Doesn't hold a slot of the window while waiting: the other dashboards keep loading
+            await asyncio.wrap_future(warmup)
+        await asyncio.gather(*[load_query(q) for q in queries if len(get_param_query_ids(q)) > 0])
+
+        await duplicate_dashboard_async(window, target_client, dashboard["dashboard"], dashboard_state, parent, target_index, journal)
+        if journal is not None:
+            journal.dashboard(dashboard_state)
+        return dashboard_state
+
+
+async def clone_or_update_query_async(window: RequestWindow, dashboard_state, q, target_client: Client, parent, target_index = None):
+    q_creation = get_query_payload(q, target_client, parent)
+    new_query = None
+    if q['id'] in dashboard_state["queries"]:
+        query_state = dashboard_state["queries"][q['id']]
+        existing_query_id = query_state["new_id"]
+        existing_query, fetch = get_known_query(q, query_state, q_creation, target_index)
+        if fetch:
+            existing_query = await window.request(target_client, "GET", "/api/2.0/preview/sql/queries/" + existing_query_id)
+            if 'id' not in existing_query or 'moved_to_trash_at' in existing_query:
+                existing_query = None
+        if existing_query is not None:
+            if query_state.get("hash") == content_hash(q_creation):
+                logger.debug(f"     query {existing_query_id} unchanged, skipping update")
+                new_query = existing_query
+            else:
+                logger.debug(f"     updating the existing query {existing_query_id}")
+                new_query = await window.request(target_client, "POST", "/api/2.0/preview/sql/queries/" + existing_query_id, json=q_creation)
+            if "visualizations" not in new_query:
+                raise Exception(f"can't update query or query without vis. Shouldn't happen: {new_query} - {q_creation} - {existing_query_id}")
+    if not new_query:
+        logger.debug(f"     cloning query {q_creation}...")
+        new_query = await window.request(target_client, "POST", "/api/2.0/preview/sql/queries", json=q_creation)
+    return new_query
+
+
+async def clone_query_visualization_async(window: RequestWindow, client: Client, query, target_query):
+    orig_default_table = get_first_vis(query)
+    mapping = {}
+    if orig_default_table:
+        target_default_table = get_first_vis(target_query)
+        #The target query can be created without default table: it's then created with the other visualizations
+        if target_default_table is not None:
+            mapping[orig_default_table["id"]] = target_default_table["id"]
+            logger.debug(f"         updating default Viz {target_default_table['id']}...")
+            await window.request(client, "POST", "/api/2.0/preview/sql/visualizations/"+target_default_table["id"], json=get_default_visualization_payload(orig_default_table))
+    await create_visualizations_async(window, client, sorted(query["visualizations"], key=lambda x: x["id"]), target_query["id"], mapping)
+    return mapping
+
+
+async def update_query_visualization_async(window: RequestWindow, client: Client, query, target_query, query_state):
+    mapping, to_update, to_create, to_delete = get_visualization_changes(query, target_query, query_state)
+
+    async def update_visualization(v, target_id):
+        logger.debug(f"         updating Viz {v['id']} - {target_id}...")
+        data = get_visualization_payload(v, target_query["id"])
+        del data["query_id"]
+        await window.update(client, "visualizations", target_id, data)
+    await asyncio.gather(*[update_visualization(v, target_id) for v, target_id in to_update],
+                         *[window.request(client, "DELETE", "/api/2.0/preview/sql/visualizations/"+target_id) for target_id in to_delete])
+    await create_visualizations_async(window, client, sorted(to_create, key=lambda x: x["id"]), target_query["id"], mapping)
+    return mapping
+
+
+async def create_visualizations_async(window: RequestWindow, client: Client, visualizations, target_query_id, mapping):
+    #Created concurrently (one after the other with load_dashboard.ordered_visualizations), mapped in the order of the list
+    if load_dashboard.ordered_visualizations:
+        new_ids = [await create_visualization_async(window, client, v, target_query_id) for v in visualizations]
+    else:
+        new_ids = await asyncio.gather(*[create_visualization_async(window, client, v, target_query_id) for v in visualizations])
+    for v, new_id in zip(visualizations, new_ids):
+        mapping[v["id"]] = new_id
+
+
+async def create_visualization_async(window: RequestWindow, client: Client, v, target_query_id):
+    logger.debug(f"         cloning Viz {v['id']}...")
+    data = get_visualization_payload(v, target_query_id)
+    new_v = await window.request(client, "POST", "/api/2.0/preview/sql/visualizations", json=data)
+    if "id" not in new_v:
+        raise Exception(f"couldn't create visualization - shouldn't happen {new_v} - {data}")
+    return new_v["id"]
+
+
+async def set_permissions_async(window: RequestWindow, client: Client, item, target, state, target_index = None):
+    #Same as load_dashboard.set_permissions, through the window
+    if not is_permissions_change(client, target["id"], state):
+        logger.debug(f"     {item} {target['id']} permissions unchanged, skipping update")
+        return get_permissions_hash(client)
+    with instrumentation.phase("permissions"):
+        if state.get("new_id") == target["id"] and state.get("permissions_hash") is None:
+            acl = target_index.get_acl(item, target["id"]) if target_index is not None else None
+            if acl is None:
+                acl = await window.request(client, "GET", f"/api/2.0/preview/sql/permissions/{item}/"+target["id"])
+            if is_acl_applied(acl, client):
+                logger.debug(f"     {item} {target['id']} permissions already set")
+                return get_permissions_hash(client)
+        status_code, permissions = await window.request_with_status(client, "POST", f"/api/2.0/preview/sql/permissions/{item}/"+target["id"], json=client.permissions)
+        if status_code >= 400:
+            logger.warning(f"couldn't set the permissions of {item} {target['id']}: {status_code} {permissions}")
+            return None
+    logger.debug(f"     {item} permissions set to {permissions}")
+    return get_permissions_hash(client)
+
+
+async def duplicate_dashboard_async(window: RequestWindow, client: Client, dashboard, dashboard_state, parent, target_index = None, journal = None):
+    data = get_dashboard_payload(dashboard, client, parent)
+    new_dashboard = None
+    previous_state = {"new_id": dashboard_state.get("new_id"), "permissions_hash": dashboard_state.get("permissions_hash")}
+    if "new_id" in dashboard_state:
+        existing_dashboard, fetch = get_known_dashboard(dashboard, dashboard_state, data, target_index)
+        if fetch:
+            existing_dashboard = await window.request(client, "GET", "/api/2.0/preview/sql/dashboards/"+dashboard_state["new_id"])
+            if "options" not in existing_dashboard or "moved_to_trash_at" in existing_dashboard["options"]:
+                existing_dashboard = None
+        if existing_dashboard is not None:
+            if dashboard_state.get("hash") == content_hash(data):
+                logger.debug("  dashboard exists and didn't change")
+                new_dashboard = existing_dashboard
+            else:
+                logger.debug("  dashboard exists, updating it")
+                new_dashboard = await window.update(client, "dashboards", dashboard_state["new_id"], data)
+            if "widgets" not in new_dashboard:
+                logger.debug(f"ERROR: dashboard doesn't have widget, shouldn't happen - {new_dashboard}")
+        else:
+            logger.debug("    couldn't find the dashboard defined in the state, it probably has been deleted.")
+    if new_dashboard is None:
+        logger.debug(f"  creating new dashboard...")
+        new_dashboard = await window.request(client, "POST", "/api/2.0/preview/sql/dashboards", json=data)
+        if "id" not in new_dashboard:
+            raise Exception(f"couldn't create dashboard: {new_dashboard} - {data}")
+        dashboard_state["new_id"] = new_dashboard["id"]
+        if journal is not None:
+            journal.new_dashboard(new_dashboard["id"])
+
+    widgets, to_update, to_create, to_delete = get_widget_changes(dashboard, dashboard_state, new_dashboard)
+
+    async def update_widget(widget, target_id):
+        logger.debug(f"          updating widget {target_id}...")
+        data = get_widget_payload(widget, dashboard_state, new_dashboard["id"])
+        await window.update(client, "widgets", target_id, {"text": data["text"], "options": data["options"], "width": data["width"]})
+
+    async def load_widget(widget):
+        logger.debug(f"          cloning widget {widget}...")
+        data = get_widget_payload(widget, dashboard_state, new_dashboard["id"])
+        new_widget = await window.request(client, "POST", "/api/2.0/preview/sql/widgets", json=data)
+        if "id" not in new_widget:
+            print(f"Warning - widget wasn't properly created: {new_widget} - {data}")
+        else:
+            widgets[widget["id"]] = new_widget["id"]
+
+    async def load_widgets():
+        with instrumentation.phase("widgets"):
+            await asyncio.gather(*[window.request(client, "DELETE", "/api/2.0/preview/sql/widgets/"+widget_id) for widget_id in to_delete])
+            await asyncio.gather(*[update_widget(widget, target_id) for widget, target_id in to_update],
+                                 *[load_widget(widget) for widget in to_create])
+
+    #The widgets don't wait for the dashboard permissions
+    if client.permisions_defined():
+        _, permissions_hash = await asyncio.gather(load_widgets(), set_permissions_async(window, client, "dashboards", new_dashboard, previous_state, target_index))
+        if permissions_hash is not None:
+            dashboard_state["permissions_hash"] = permissions_hash
+    else:
+        await load_widgets()
+
+    dashboard_state["hash"] = content_hash(data)
+    dashboard_state["updated_at"] = new_dashboard.get("updated_at")
+    dashboard_state["widgets"] = widgets
+    dashboard_state["widget_hashes"] = {widget_id: h for widget_id, h in get_widget_hashes(dashboard, dashboard_state, new_dashboard["id"]).items() if widget_id in widgets}
+    return new_dashboard
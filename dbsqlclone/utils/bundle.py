@@ -0,0 +1,155 @@
+from .client import Client
+import json
+import threading
+import zipfile
+import logging
+
+from .dump_dashboard import QueryCache, get_dashboard_definition_by_id
+from . import dump_dashboard
+from . import load_dashboard
+
+logger = logging.getLogger('dbsqlclone.bundle')
+
+bundle_format = "dbsqlclone-bundle"
+bundle_version = 1
+
+
+class BundleWriter():
+    """
+    Writes dashboard definitions in a single compressed archive: a manifest plus one record per dashboard, query and
+    visualization. Queries and visualizations shared by multiple dashboards are stored once, and the widgets reference
+    them instead of embedding a copy. Thread safe, close() writes the manifest.
+    """
+    def __init__(self, bundle_file):
+        self.zip = zipfile.ZipFile(bundle_file, "w", compression=zipfile.ZIP_DEFLATED)
+        self.lock = threading.Lock()
+        self.manifest = {"format": bundle_format, "version": bundle_version, "dashboards": {}}
+        self.records = set()
+
+    def add_dashboard(self, definition, dashboard_id = None):
+        if dashboard_id is None:
+            dashboard_id = definition["id"]
+        queries = {q["id"]: q for q in definition["queries"]}
+        visualizations = {v["id"]: v for q in definition["queries"] for v in q["visualizations"]}
+        dashboard = dict(definition["dashboard"], widgets=[pack_widget(w, queries, visualizations) for w in definition["dashboard"]["widgets"]])
+        with self.lock:
+            for q in definition["queries"]:
+                #is_parameter_query depends on the dashboard, it's saved in the manifest
+                query = {k: v for k, v in q.items() if k != "is_parameter_query"}
+                query["visualizations"] = [v["id"] for v in q["visualizations"]]
+                self.write_record("queries", q["id"], query)
+            for v in visualizations.values():
+                self.write_record("visualizations", v["id"], v)
+            self.write_record("dashboards", dashboard_id, dashboard)
+            self.manifest["dashboards"][dashboard_id] = {
+                "name": dashboard.get("name"),
+                "queries": [q["id"] for q in definition["queries"]],
+                "parameter_queries": [q["id"] for q in definition["queries"] if q.get("is_parameter_query")]
+            }
+
+    def write_record(self, record_type, id, record):
+        name = f"{record_type}/{id}.json"
+        if name not in self.records:
+            self.records.add(name)
+            self.zip.writestr(name, json.dumps(record, separators=(",", ":")))
+
+    def close(self):
+        with self.lock:
+            self.zip.writestr("manifest.json", json.dumps(self.manifest, separators=(",", ":")))
+            self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DashboardBundle():
+    """
+    Reads a bundle lazily: only the manifest is parsed when opened, get_dashboard only reads the records of the
+    requested dashboard. Returns the same definition as get_dashboard_definition_by_id.
+    """
+    def __init__(self, bundle_file):
+        self.zip = zipfile.ZipFile(bundle_file, "r")
+        self.lock = threading.Lock()
+        self.manifest = json.loads(self.zip.read("manifest.json"))
+        assert self.manifest.get("format") == bundle_format, f"{bundle_file} isn't a dashboard bundle"
+        assert self.manifest["version"] <= bundle_version, f"unsupported bundle version {self.manifest['version']}"
+
+    def get_dashboard_ids(self):
+        return list(self.manifest["dashboards"].keys())
+
+    def read_record(self, record_type, id):
+        with self.lock:
+            return json.loads(self.zip.read(f"{record_type}/{id}.json"))
+
+    def get_dashboard(self, dashboard_id):
+        entry = self.manifest["dashboards"][dashboard_id]
+        parameter_queries = set(entry["parameter_queries"])
+        visualizations = {}
+        queries = {}
+        for query_id in entry["queries"]:
+            q = self.read_record("queries", query_id)
+            for vis_id in q["visualizations"]:
+                if vis_id not in visualizations:
+                    visualizations[vis_id] = self.read_record("visualizations", vis_id)
+            q["visualizations"] = [visualizations[vis_id] for vis_id in q["visualizations"]]
+            q["is_parameter_query"] = query_id in parameter_queries
+            queries[query_id] = q
+        dashboard = self.read_record("dashboards", dashboard_id)
+        dashboard["widgets"] = [unpack_widget(w, queries, visualizations) for w in dashboard["widgets"]]
+        return {"queries": [queries[query_id] for query_id in entry["queries"]], "id": dashboard_id, "dashboard": dashboard}
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+#Replaces the visualization and query embedded in the widget by references when they're identical to the saved records
+def pack_widget(widget, queries, visualizations):
+    if "visualization" not in widget:
+        return widget
+    vis = widget["visualization"]
+    query = vis.get("query", {})
+    if vis["id"] not in visualizations or query.get("id") not in queries or \
+            visualizations[vis["id"]] != {k: v for k, v in vis.items() if k != "query"} or \
+            any(queries[query["id"]].get(k) != v for k, v in query.items()):
+        return widget
+    return dict(widget, visualization={"$ref": vis["id"], "query": {"$ref": query["id"], "fields": list(query.keys())}})
+
+
+def unpack_widget(widget, queries, visualizations):
+    if "visualization" not in widget or "$ref" not in widget["visualization"]:
+        return widget
+    ref = widget["visualization"]
+    query = queries[ref["query"]["$ref"]]
+    query = {k: query[k] for k in ref["query"]["fields"]}
+    return dict(widget, visualization=dict(visualizations[ref["$ref"]], query=query))
+
+
+def is_bundle(path):
+    return zipfile.is_zipfile(path)
+
+
+def dump_dashboards_to_bundle(source_client: Client, dashboard_ids, bundle_file, progress = None, dump_cache = None):
+    """Dumps the dashboards in the bundle, progress.done(dashboard_id, error) is called after each dashboard (see dump_dashboards)."""
+    query_cache = QueryCache()
+    with BundleWriter(bundle_file) as writer:
+        def dump(dashboard_id):
+            writer.add_dashboard(get_dashboard_definition_by_id(source_client, dashboard_id, query_cache, dump_cache))
+        dump_dashboard.run_dumps(dump, dashboard_ids, progress)
+
+
+def load_dashboards_from_bundle(target_client: Client, bundle_file, workspace_state, dashboard_ids = None, progress = None):
+    """Loads the dashboards of the bundle (all of them if dashboard_ids is None), same as load_dashboard.load_dashboards."""
+    with DashboardBundle(bundle_file) as bundle:
+        if dashboard_ids is None:
+            dashboard_ids = bundle.get_dashboard_ids()
+        return load_dashboard.load_definitions(target_client, ((dashboard_id, bundle.get_dashboard(dashboard_id)) for dashboard_id in dashboard_ids),
+                                               workspace_state, progress)
@@ -0,0 +1,231 @@
+import collections
+import json
+import sqlite3
+import threading
+import time
+import logging
+
+from dbsqlclone.utils.client import Client
+from . import instrumentation
+from .dump_dashboard import is_definition_unchanged
+
+logger = logging.getLogger('dbsqlclone.catalog')
+
+#The queries and dashboards are listed entirely at least every full_refresh_interval seconds, even if the workspace
+#returns them ordered by updated_at (the objects deleted outside of the clone tool can only be seen this way)
+full_refresh_interval = 24 * 3600
+#The data sources are fetched again after data_sources_max_age seconds (or when the endpoint isn't in the catalog)
+data_sources_max_age = 24 * 3600
+
+schema = """
+CREATE TABLE IF NOT EXISTS items (workspace TEXT, item TEXT, id TEXT, name TEXT, updated_at TEXT, data TEXT, PRIMARY KEY (workspace, item, id));
+CREATE TABLE IF NOT EXISTS tags (workspace TEXT, item TEXT, tag TEXT, id TEXT, PRIMARY KEY (workspace, item, tag, id));
+CREATE TABLE IF NOT EXISTS refreshes (workspace TEXT, item TEXT, watermark TEXT, full_refresh_at REAL, PRIMARY KEY (workspace, item));
+CREATE TABLE IF NOT EXISTS data_sources (workspace TEXT PRIMARY KEY, data TEXT, fetched_at REAL);
+CREATE TABLE IF NOT EXISTS documents (workspace TEXT, kind TEXT, id TEXT, data TEXT, PRIMARY KEY (workspace, kind, id));
+"""
+
+
+class Catalog():
+    """
+    Local catalog of the workspaces, kept between the runs in a SQLite file (one file can hold multiple workspaces):
+    the data sources, the queries and dashboards as returned by the listings with an index of their tags, and the
+    dashboard definitions. Set it as client.catalog: the listings, the data sources and the definitions are then read from it.
+    Each listing refreshes it incrementally: the objects are listed by -updated_at, down to the ones older than the previous
+    refresh. The objects are listed entirely if the workspace doesn't return them in this order, if their number doesn't match
+    the catalog (ex: deleted outside of the clone tool) or every full_refresh_interval. The objects deleted with a Cleanup
+    are removed from the catalog.
+    """
+    def __init__(self, catalog_file = "catalog.db"):
+        self.catalog_file = catalog_file
+        try:
+            self.db = self.connect()
+        except sqlite3.DatabaseError as e:
+            #Never overwrite the file: it could be another file passed by mistake (ex: the state file)
+            raise Exception(f"{catalog_file} isn't a catalog ({e}). Use another file, or delete it to start a new catalog.")
+        self.lock = threading.RLock()
+        #A single refresh of each (workspace, item) at a time, the other listings wait for it
+        self.refresh_locks = collections.defaultdict(threading.Lock)
+        #(workspace, item) refreshed by this run
+        self.refreshed = set()
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        db = sqlite3.connect(self.catalog_file, check_same_thread=False)
+        db.executescript(schema)
+        return db
+
+    def refresh(self, client: Client, item, once = False):
+        """
+        Updates the queries or dashboards (item) of the workspace which changed since the previous refresh.
+        If once is set, the catalog isn't refreshed again if it already was during this run.
+        """
+        with self.refresh_locks[(client.url, item)]:
+            if once and (client.url, item) in self.refreshed:
+                return
+            with self.lock:
+                row = self.db.execute("SELECT watermark, full_refresh_at FROM refreshes WHERE workspace=? AND item=?", (client.url, item)).fetchone()
+            if row is None or row[1] < time.time() - full_refresh_interval or not self.refresh_changes(client, item, json.loads(row[0])):
+                self.refresh_all(client, item)
+            self.refreshed.add((client.url, item))
+
+    def refresh_changes(self, client: Client, item, watermark):
+        """Lists the objects updated since the watermark. Returns False if the catalog must be listed entirely instead."""
+        from .clone_dashboard import page_size
+        if watermark is None:
+            return False
+        changed = []
+        previous = None
+        page = 1
+        count = None
+        with instrumentation.phase("list", item=item):
+            while True:
+                with client.get("/api/2.0/preview/sql/"+item, params={"page_size": page_size, "page": page, "order": "-updated_at"}) as r:
+                    listing = r.json()
+                if page == 1:
+                    count = listing.get("count")
+                results = listing.get("results", [])
+                older = False
+                #The whole page is checked, to make sure the workspace sorted it
+                for i in results:
+                    updated_at = i.get("updated_at")
+                    if updated_at is None or (previous is not None and updated_at > previous):
+                        logger.debug(f"{item} of {client.url} aren't listed by updated_at, listing all of them")
+                        return False
+                    previous = updated_at
+                    #Objects updated at the watermark are listed again: they could have been updated after the previous refresh
+                    if updated_at >= watermark:
+                        changed.append(i)
+                    else:
+                        older = True
+                if older or len(results) == 0 or len(results) < listing.get("page_size", page_size):
+                    break
+                page += 1
+        with self.lock, self.db:
+            self.upsert(client, item, changed)
+            if len(changed) > 0:
+                self.db.execute("UPDATE refreshes SET watermark=? WHERE workspace=? AND item=?", (json.dumps(changed[0]["updated_at"]), client.url, item))
+            total = self.db.execute("SELECT count(*) FROM items WHERE workspace=? AND item=?", (client.url, item)).fetchone()[0]
+        logger.debug(f"catalog: {len(changed)} {item} changed in {client.url}")
+        if count is not None and count != total:
+            logger.debug(f"catalog: {total} {item} in the catalog of {client.url} but {count} in the workspace, listing all of them")
+            return False
+        return True
+
+    def refresh_all(self, client: Client, item):
+        from .clone_dashboard import iter_pages
+        items = list(iter_pages(client, item))
+        updated_at = [i["updated_at"] for i in items if i.get("updated_at") is not None]
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM items WHERE workspace=? AND item=?", (client.url, item))
+            self.db.execute("DELETE FROM tags WHERE workspace=? AND item=?", (client.url, item))
+            self.upsert(client, item, items)
+            #The definitions of the deleted dashboards aren't needed anymore
+            if item == "dashboards":
+                self.db.execute("DELETE FROM documents WHERE workspace=? AND id NOT IN (SELECT id FROM items WHERE workspace=? AND item=?)",
+                                (client.url, client.url, item))
+            self.db.execute("INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?)",
+                            (client.url, item, json.dumps(max(updated_at) if len(updated_at) > 0 else None), time.time()))
+        logger.debug(f"catalog: listed {len(items)} {item} from {client.url}")
+
+    def upsert(self, client: Client, item, items):
+        for i in items:
+            self.db.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)",
+                            (client.url, item, i["id"], i.get("name"), json.dumps(i.get("updated_at")), json.dumps(i)))
+            self.db.execute("DELETE FROM tags WHERE workspace=? AND item=? AND id=?", (client.url, item, i["id"]))
+            self.db.executemany("INSERT OR IGNORE INTO tags VALUES (?, ?, ?, ?)", [(client.url, item, tag, i["id"]) for tag in i.get("tags") or []])
+
+    def get_items(self, client: Client, item, tags = None):
+        """Refreshes the catalog, returns the queries or dashboards (item) having any of the tags, all of them if tags is None."""
+        self.refresh(client, item)
+        with self.lock:
+            if tags is None:
+                rows = self.db.execute("SELECT data FROM items WHERE workspace=? AND item=? ORDER BY name, id", (client.url, item))
+            else:
+                tags = list(tags)
+                rows = self.db.execute(f"SELECT data FROM items WHERE workspace=? AND item=? AND id IN "
+                                       f"(SELECT id FROM tags WHERE workspace=? AND item=? AND tag IN ({', '.join('?' * len(tags))})) "
+                                       f"ORDER BY name, id", [client.url, item, client.url, item] + tags)
+            return [json.loads(data) for data, in rows.fetchall()]
+
+    def get_updated_at(self, client: Client, item, ids = None):
+        """id -> updated_at of the queries or dashboards (item), only the ones in ids if set. The catalog is refreshed once per run."""
+        self.refresh(client, item, once=True)
+        with self.lock:
+            if ids is None:
+                rows = self.db.execute("SELECT id, updated_at FROM items WHERE workspace=? AND item=?", (client.url, item))
+            else:
+                ids = list(ids)
+                rows = self.db.execute(f"SELECT id, updated_at FROM items WHERE workspace=? AND item=? AND id IN ({', '.join('?' * len(ids))})",
+                                       [client.url, item] + ids)
+            return {id: json.loads(updated_at) for id, updated_at in rows.fetchall()}
+
+    def remove(self, client: Client, item, id):
+        """Removes a deleted object from the catalog."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM items WHERE workspace=? AND item=? AND id=?", (client.url, item, id))
+            self.db.execute("DELETE FROM tags WHERE workspace=? AND item=? AND id=?", (client.url, item, id))
+            if item == "dashboards":
+                self.db.execute("DELETE FROM documents WHERE workspace=? AND id=?", (client.url, id))
+
+    def get_data_sources(self, client: Client):
+        """Data sources of the workspace saved by set_data_sources, None if they're missing or older than data_sources_max_age."""
+        with self.lock:
+            row = self.db.execute("SELECT data, fetched_at FROM data_sources WHERE workspace=?", (client.url,)).fetchone()
+        if row is None or row[1] < time.time() - data_sources_max_age:
+            return None
+        return json.loads(row[0])
+
+    def set_data_sources(self, client: Client, data_sources):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO data_sources VALUES (?, ?, ?)", (client.url, json.dumps(data_sources), time.time()))
+
+    def get_document(self, client: Client, kind, id):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM documents WHERE workspace=? AND kind=? AND id=?", (client.url, kind, id)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_document(self, client: Client, kind, id, document):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)", (client.url, kind, id, json.dumps(document)))
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, client: Client, dashboard_id):
+        """The definition saved by put if neither the dashboard nor its queries changed since, None otherwise (dump cache of the client)."""
+        definition = self.get_document(client, "definition", dashboard_id)
+        hit = is_definition_unchanged(definition, self.get_updated_at(client, "dashboards", [dashboard_id]).get(dashboard_id),
+                                      lambda query_ids: self.get_updated_at(client, "queries", query_ids))
+        self.count(hit)
+        return definition if hit else None
+
+    def put(self, client: Client, definition):
+        self.put_document(client, "definition", definition["id"], definition)
+
+    def get_dashboard(self, client: Client, dashboard_id):
+        """The dashboard (with its widgets) saved by put_dashboard if its updated_at didn't change, None otherwise."""
+        dashboard = self.get_document(client, "dashboard", dashboard_id)
+        hit = dashboard is not None and dashboard.get("updated_at") is not None and \
+            self.get_updated_at(client, "dashboards", [dashboard_id]).get(dashboard_id) == dashboard["updated_at"]
+        self.count(hit)
+        return dashboard if hit else None
+
+    def put_dashboard(self, client: Client, dashboard):
+        self.put_document(client, "dashboard", dashboard["id"], dashboard)
+
+    def close(self):
+        with self.lock:
+            logger.debug(f"catalog: {self.hits} definitions reused, {self.misses} fetched")
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
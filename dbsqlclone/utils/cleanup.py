@@ -0,0 +1,104 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+
+from dbsqlclone.utils.client import Client
+from . import instrumentation
+
+logger = logging.getLogger('dbsqlclone.cleanup')
+
+#Max number of deletions running at the same time for a workspace, shared by all its cleanups
+max_workers = 8
+#Logs the progress every progress_every deletions
+progress_every = 50
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(client: Client):
+    """Thread pool of the workspace deletions: every cleanup of the same workspace shares its max_workers budget."""
+    with _executors_lock:
+        if client.url not in _executors:
+            _executors[client.url] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cleanup")
+        return _executors[client.url]
+
+
+class Cleanup():
+    """
+    Deletes target objects (queries, dashboards, visualizations, widgets) concurrently on the workspace executor.
+    Objects listed by a streaming listing are deleted as soon as they're listed, without waiting for the listing to end.
+    Keeps the result of each deletion: wait() returns {"deleted", "failed": [{"item", "id", "name", "error"}]}.
+    """
+    def __init__(self, client: Client, name = "cleanup"):
+        self.client = client
+        self.name = name
+        self.executor = get_executor(client)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.submitted = 0
+        self.deleted = 0
+        self.failed = []
+
+    def delete(self, item, id, name = None):
+        """Schedules the deletion of the object, returns its Future (True if deleted, False if it failed)."""
+        with self.lock:
+            self.submitted += 1
+            future = self.executor.submit(instrumentation.bind(self.run), item, id, name)
+            self.futures.append(future)
+        return future
+
+    def run(self, item, id, name):
+        logger.debug(f"deleting {item} {id} - {name}")
+        error = None
+        try:
+            with self.client.delete(f"/api/2.0/preview/sql/{item}/{id}") as r:
+                #Already deleted (ex: visualizations of a deleted query)
+                if r.status_code >= 400 and r.status_code != 404:
+                    error = f"{r.status_code} {r.text}"
+        except Exception as e:
+            error = str(e)
+        if error is None and self.client.catalog is not None and item in ["queries", "dashboards"]:
+            self.client.catalog.remove(self.client, item, id)
+        with self.lock:
+            if error is not None:
+                self.failed.append({"item": item, "id": id, "name": name, "error": error})
+            else:
+                self.deleted += 1
+            done = self.deleted + len(self.failed)
+        if error is not None:
+            print(f"Warning - couldn't delete {item} {id} ({name}): {error}")
+        elif done % progress_every == 0:
+            logger.info(f"{self.name} on {self.client.url}: {done}/{self.submitted} deleted")
+        return error is None
+
+    def delete_listed(self, item, list_items, ids_to_skip = {}):
+        """
+        Deletes the objects returned by list_items() (an iterator, ex: clone_dashboard.iter_all_item), except ids_to_skip.
+        As deleting shifts the next pages of the listing, lists again until a listing doesn't return any new object.
+        """
+        attempted = set()
+        with instrumentation.phase("cleanup", item=item):
+            while True:
+                futures = []
+                for i in list_items():
+                    if i['id'] not in ids_to_skip and i['id'] not in attempted:
+                        attempted.add(i['id'])
+                        futures.append(self.delete(item, i["id"], i.get("name")))
+                wait(futures)
+                if len(futures) == 0:
+                    break
+
+    def wait(self):
+        """Waits for all the deletions, returns the report."""
+        while True:
+            with self.lock:
+                futures = [f for f in self.futures if not f.done()]
+            if len(futures) == 0:
+                break
+            wait(futures)
+        with self.lock:
+            report = {"deleted": self.deleted, "failed": list(self.failed)}
+        if self.submitted > 0:
+            logger.info(f"{self.name} on {self.client.url}: {report['deleted']} deleted, {len(report['failed'])} failed")
+        return report
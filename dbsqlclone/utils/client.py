@@ -1,5 +1,25 @@
+import threading
+import time
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import rate_limiter
+from .rate_limiter import get_rate_limiter, backoff_delay, parse_retry_after
+from . import instrumentation
+
+logger = logging.getLogger('dbsqlclone.client')
+
+#503 and 429 are rejected before being processed and can be retried for any method.
+#Other errors are only retried for idempotent calls, retrying a POST could create duplicates.
+always_retry_status = {429, 503}
+idempotent_retry_status = {500, 502, 504}
+idempotent_methods = {"GET", "DELETE"}
+
+
 class Client():
-    def __init__(self, url, token, permissions = [], endpoint_id = None, dashboard_tags = None):
+    def __init__(self, url, token, permissions = [], endpoint_id = None, dashboard_tags = None, pool_size = None, timeout = 120, max_retries = 6):
         self.url = url
         self.headers = {"Authorization": "Bearer " + token, 'Content-type': 'application/json'}
         self.permissions = None
@@ -8,6 +28,92 @@ class Client():
         self.data_source_id = None
         self.endpoint_id = endpoint_id
         self.dashboard_tags = dashboard_tags
+        #Size of the keep-alive connection pool. Defaults to the max number of threads the dump/load pools can run at once.
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.rate_limiter = get_rate_limiter(url)
+        #Local catalog of the workspace listings kept between the runs (see catalog.Catalog), None to always list the workspace
+        self.catalog = None
+        self._session = None
+        self._session_lock = threading.Lock()
 
     def permisions_defined(self):
-        return self.permissions is not None and len(self.permissions["access_control_list"]) > 0
\ No newline at end of file
+        return self.permissions is not None and len(self.permissions["access_control_list"]) > 0
+
+    def get_pool_size(self):
+        if self.pool_size is not None:
+            return self.pool_size
+        from . import dump_dashboard, async_load_dashboard, scheduler, cleanup
+        #The loads of all the dashboards share the scheduler threads, the deletions run on the cleanup threads
+        pool_size = max(dump_dashboard.max_workers * dump_dashboard.query_max_workers,
+                        scheduler.max_workers + cleanup.max_workers,
+                        async_load_dashboard.max_in_flight)
+        #No more requests than the rate limiter concurrency can be in flight
+        return min(pool_size, self.rate_limiter.max_concurrency)
+
+    @property
+    def session(self):
+        #Lazily created so that the pool size picks up any change made to the module max_workers after the client creation
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.headers.update(self.headers)
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.get_pool_size())
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            wait_start = time.time()
+            self.rate_limiter.acquire()
+            start = time.time()
+            try:
+                r = self.session.request(method, self.url + path, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.rate_limiter.release()
+                instrumentation.record_request(method, path, type(e).__name__, start, time.time() - start, start - wait_start, attempt,
+                                               workspace=self.url)
+                if method not in idempotent_methods or attempt >= self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.debug(f"{method} {path} failed with {e}, retrying in {delay:.1f}s")
+            else:
+                self.rate_limiter.release(throttled=r.status_code == 429)
+                if instrumentation.enabled():
+                    #Reads the body first to include the download in the latency
+                    bytes_received = len(r.content)
+                    instrumentation.record_request(method, path, r.status_code, start, time.time() - start, start - wait_start, attempt,
+                                                   len(r.request.body or b""), bytes_received, self.url)
+                retryable = r.status_code in always_retry_status or \
+                            (r.status_code in idempotent_retry_status and method in idempotent_methods)
+                if not retryable or attempt >= self.max_retries:
+                    return r
+                retry_after = parse_retry_after(r)
+                #The Retry-After of the workspace is capped: a wrong or huge value can't block the run
+                delay = min(retry_after, rate_limiter.max_backoff) if retry_after is not None else backoff_delay(attempt)
+                if r.status_code == 429:
+                    self.rate_limiter.pause(delay)
+                logger.debug(f"{method} {path} returned {r.status_code}, retrying in {delay:.1f}s")
+                r.close()
+            attempt += 1
+            time.sleep(delay)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
@@ -1,96 +1,409 @@
 from typing import List
 
-import requests
-import json
+import copy
+import math
+import threading
 
 from dbsqlclone.utils import load_dashboard
 from dbsqlclone.utils.client import Client
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import collections
-from dbsqlclone.utils.dump_dashboard import dump_dashboards
+from dbsqlclone.utils import dump_dashboard
+from dbsqlclone.utils import planner
+from dbsqlclone.utils import instrumentation
+from dbsqlclone.utils.dump_dashboard import QueryCache, DumpCache, get_dashboard_definition_by_id, write_dashboard
+from dbsqlclone.utils.state_store import StateStore, save_state_file
+from dbsqlclone.utils.scheduler import Scheduler, Task
+from dbsqlclone.utils.cleanup import Cleanup
 import logging
 
 logger = logging.getLogger('dbsqlclone.clone')
 
+#Number of items per listing page, and number of pages fetched at the same time while listing
+page_size = 250
+prefetch_pages = 4
+#Number of ACLs fetched at the same time when indexing a target
+acl_max_workers = 8
+
 def get_all_dashboards(client: Client, tags = []):
     return get_all_item(client, "dashboards", tags)
 
 def get_all_queries(client: Client, tags = []):
     return get_all_item(client, "queries", tags)
 
+def iter_all_dashboards(client: Client, tags = []):
+    return iter_all_item(client, "dashboards", tags)
+
+def iter_all_queries(client: Client, tags = []):
+    return iter_all_item(client, "queries", tags)
+
 def delete_dashboard(client: Client, tags=[], ids_to_skip={}):
+    """Deletes the dashboards having any of the tags, except ids_to_skip. Returns the cleanup report (see Cleanup.wait)."""
     logger.debug(f"cleaning up dashboards with tags in {tags}...")
-    for d in get_all_dashboards(client, tags):
-        if d['id'] not in ids_to_skip:
-            logger.debug(f"deleting dashboard {d['id']} - {d['name']}")
-            with requests.delete(client.url+"/api/2.0/preview/sql/dashboards/"+d["id"], headers = client.headers, timeout=120) as r:
-                r.json()
+    cleanup = Cleanup(client, "dashboards cleanup")
+    cleanup.delete_listed("dashboards", lambda: iter_all_dashboards(client, tags), ids_to_skip)
+    return cleanup.wait()
 
 def delete_queries(client: Client, tags=[], ids_to_skip={}):
+    """Deletes the queries having any of the tags, except ids_to_skip. Returns the cleanup report (see Cleanup.wait)."""
     logger.debug(f"cleaning up queries with tags in {tags}...")
-    queries_to_delete = get_all_queries(client, tags)
-    params = [(client, q) for q in queries_to_delete if q['id'] not in ids_to_skip]
-    with ThreadPoolExecutor(max_workers=load_dashboard.max_workers) as executor:
-        collections.deque(executor.map(lambda args, f=delete_query: f(*args), params))
+    cleanup = Cleanup(client, "queries cleanup")
+    cleanup.delete_listed("queries", lambda: iter_all_queries(client, tags), ids_to_skip)
+    return cleanup.wait()
 
-def delete_query(client: Client, q):
-    logger.debug(f"deleting query {q['id']} - {q['name']}")
-    with requests.delete(client.url+"/api/2.0/preview/sql/queries/"+q["id"], headers = client.headers, timeout=120) as r:
-        return r.json()
+def delete_resources(client: Client, tags=[], query_ids_to_skip={}, dashboard_ids_to_skip={}):
+    """
+    Deletes the queries and the dashboards having any of the tags, except the ids to skip. Both listings are streamed
+    at the same time, their deletions share the workspace cleanup budget (cleanup.max_workers).
+    """
+    logger.debug(f"cleaning up queries and dashboards with tags in {tags}...")
+    cleanup = Cleanup(client)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        listings = [executor.submit(instrumentation.bind(cleanup.delete_listed), "queries", lambda: iter_all_queries(client, tags), query_ids_to_skip),
+                    executor.submit(instrumentation.bind(cleanup.delete_listed), "dashboards", lambda: iter_all_dashboards(client, tags), dashboard_ids_to_skip)]
+        collections.deque(f.result() for f in listings)
+    return cleanup.wait()
 
 def get_all_item(client: Client, item, tags = []):
-    assert item == "queries" or item == "dashboards"
-    page_size = 250
-    def get_all_dashboards(dashboards, page):
-        with requests.get(client.url+"/api/2.0/preview/sql/"+item, headers = client.headers, params={"page_size": page_size, "page": page}, timeout=120) as r:
-            r = r.json()
+    return list(iter_all_item(client, item, tags))
+
+def iter_all_item(client: Client, item, tags = []):
+    """Yields the items having any of the tags, page after page."""
+    tags = set(tags)
+    if len(tags) == 0:
+        return
+    if client.catalog is not None:
+        yield from client.catalog.get_items(client, item, tags)
+        return
+    params = {}
+    #The API filters on all the tags: it can only be used when a single tag is requested.
+    if len(tags) == 1:
+        params["tags"] = next(iter(tags))
+    for d in iter_pages(client, item, params):
         #Filter to keep only dashboard with the proper tags
-        dashboards_tags = [d for d in r["results"] if len(set(d["tags"]) & set(tags)) > 0]
-        dashboards.extend(dashboards_tags)
-        if len(r["results"]) >= page_size:
-            dashboards = get_all_dashboards(dashboards, page+1)
-        return dashboards
-    return get_all_dashboards([], 1)
+        if not tags.isdisjoint(d["tags"]):
+            yield d
+
+def iter_pages(client: Client, item, params = {}):
+    """
+    Yields all the items returned by the listing, page after page. The first page gives the number of items,
+    the next pages are then fetched prefetch_pages at a time, never past the last one.
+    """
+    assert item == "queries" or item == "dashboards"
+    params = {**params, "page_size": page_size}
+
+    @instrumentation.bind
+    def get_page(page):
+        with instrumentation.phase("list", item=item, page=page):
+            with client.get("/api/2.0/preview/sql/"+item, params={**params, "page": page}) as r:
+                return r.json()
+
+    first_page = get_page(1)
+    results = first_page.get("results", [])
+    yield from results
+    #The workspace can return smaller pages than requested
+    size = first_page.get("page_size", page_size)
+    if len(results) < size or len(results) == 0:
+        return
+    last_page = math.ceil(first_page["count"] / size) if "count" in first_page else math.inf
+    executor = ThreadPoolExecutor(max_workers=prefetch_pages)
+    try:
+        pages = collections.deque()
+        next_page = 2
+        while next_page <= last_page and len(pages) < prefetch_pages:
+            pages.append(executor.submit(get_page, next_page))
+            next_page += 1
+        while len(pages) > 0:
+            #The listing can shrink while it's read (ex: cleanup): a page past the last one returns an error without results
+            results = pages.popleft().result().get("results", [])
+            yield from results
+            if len(results) < size:
+                break
+            if next_page <= last_page:
+                pages.append(executor.submit(get_page, next_page))
+                next_page += 1
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+class TargetIndex():
+    """
+    Queries and dashboards existing in a target workspace, listed once before loading: id -> {"exists", "trashed", "updated_at"}.
+    Used by the loader to check the objects referenced in the state instead of sending one GET per object.
+    Objects created after the listing aren't in the index.
+    When workspace_state is set, the ACLs of the existing objects the state doesn't have the permissions hash of
+    (saved by a previous version) are also fetched in parallel, instead of one GET in each permission task.
+    """
+    def __init__(self, client: Client, workspace_state = None):
+        self.items = {}
+        for item in ["queries", "dashboards"]:
+            self.items[item] = {}
+            for i in client.catalog.get_items(client, item) if client.catalog is not None else iter_pages(client, item):
+                trashed = "moved_to_trash_at" in i or "moved_to_trash_at" in (i.get("options") or {})
+                self.items[item][i["id"]] = {"exists": True, "trashed": trashed, "updated_at": i.get("updated_at")}
+        logger.debug(f"indexed {len(self.items['queries'])} queries and {len(self.items['dashboards'])} dashboards from {client.url}")
+        self.acls = {}
+        if workspace_state is not None and client.permisions_defined():
+            self.acls = self.get_acls(client, workspace_state)
+
+    def get_acls(self, client: Client, workspace_state):
+        objects = set()
+        for dashboard_state in workspace_state.values():
+            states = [("dashboards", dashboard_state)] + [("queries", q) for q in dashboard_state.get("queries", {}).values()]
+            objects.update((item, state["new_id"]) for item, state in states
+                           if "new_id" in state and state.get("permissions_hash") is None and self.exists(item, state["new_id"]))
+        if len(objects) == 0:
+            return {}
+
+        @instrumentation.bind
+        def get_acl(item, id):
+            try:
+                with client.get(f"/api/2.0/preview/sql/permissions/{item}/"+id) as r:
+                    return r.json() if r.status_code == 200 else None
+            except Exception as e:
+                #The permission task fetches it again
+                logger.debug(f"couldn't fetch the ACL of {item} {id}: {e}")
+                return None
+        with instrumentation.phase("permissions"):
+            with ThreadPoolExecutor(max_workers=acl_max_workers) as executor:
+                acls = dict(zip(objects, executor.map(lambda o: get_acl(*o), objects)))
+        logger.debug(f"fetched {len(objects)} ACLs from {client.url}")
+        return {o: acl for o, acl in acls.items() if acl is not None}
+
+    def get_acl(self, item, id):
+        """ACL fetched with the index, None if it wasn't."""
+        return self.acls.get((item, id))
+
+    def get(self, item, id):
+        return self.items[item].get(id, {"exists": False, "trashed": False, "updated_at": None})
+
+    def exists(self, item, id):
+        entry = self.get(item, id)
+        return entry["exists"] and not entry["trashed"]
+
+def get_target_index(client: Client, workspace_state):
+    """Lists the target when the state references existing objects. Returns None (per-object checks) if the listing fails."""
+    if workspace_state is None or len(workspace_state) == 0:
+        return None
+    try:
+        return TargetIndex(client, workspace_state)
+    except Exception as e:
+        logger.warning(f"couldn't index the target {client.url}, checking the existing objects one by one: {e}")
+        return None
+
+def dump_and_load_dashboards(source_client: Client, target_client: Client, dashboard_ids, workspace_state, dump_folder = None):
+    """
+    Streaming dump -> load pipeline: each dashboard definition is sent to the loader as soon as it's dumped,
+    without going through the disk. Dashboard N loads while dashboard N+1 is still being dumped.
+    If dump_folder is set, the definitions are also saved in this folder.
+    """
+    if workspace_state is None:
+        workspace_state = {}
+    failures = dump_and_load_dashboards_to_targets(source_client, [(target_client, workspace_state)], dashboard_ids, dump_folder)
+    if len(failures[target_client.url]) > 0:
+        raise failures[target_client.url][0][1]
+    return workspace_state
+
+def dump_and_load_dashboards_to_targets(source_client: Client, targets, dashboard_ids, dump_folder = None,
+                                        on_target_complete = None, max_workers_per_target = None,
+                                        state_store: StateStore = None, resume = False, should_load = None, dump_cache: DumpCache = None):
+    """
+    Fan-out pipeline: each source dashboard is dumped once and cloned to all the targets at the same time.
+    targets is a list of (target_client, workspace_state). Each target has its own Scheduler of max_workers_per_target
+    threads (scheduler.max_workers by default), running the tasks of all its dashboards, so a slow or failing target
+    doesn't stall the others.
+    on_target_complete(target_client, workspace_state, failures) is called as soon as all the dashboards of a target are loaded.
+    If state_store is set, every mapping is recorded in its journal as soon as it's created. With resume, the dashboards
+    completed by the interrupted run (according to the journal) are skipped.
+    should_load(target_client, dashboard, dashboard_state) can skip the load of a dumped dashboard to a target.
+    dump_cache reuses the definitions of the dashboards which didn't change since the previous run.
+    Returns the failures of each target url as a list of (dashboard_id, exception).
+    """
+    query_cache = QueryCache()
+    failures = {target_client.url: [] for target_client, _ in targets}
+
+    def dump(dashboard_id):
+        dashboard = get_dashboard_definition_by_id(source_client, dashboard_id, query_cache, dump_cache)
+        if dump_folder is not None:
+            write_dashboard(dashboard, dashboard_id, dump_folder)
+        return dashboard
+
+    def is_completed(target_client, dashboard_id):
+        return resume and state_store is not None and \
+               state_store.is_completed(get_workspace_state_id(source_client, target_client), dashboard_id)
+
+    def load(scheduler, target_client, workspace_state, target_index, dashboard):
+        dashboard_state = workspace_state[dashboard["id"]] if dashboard["id"] in workspace_state else {}
+        journal = None
+        if state_store is not None:
+            journal = state_store.get_journal(get_workspace_state_id(source_client, target_client), dashboard["id"])
+        #The definition is modified while being cloned, each target needs its own copy
+        return dashboard["id"], load_dashboard.schedule_dashboard(scheduler, copy.deepcopy(dashboard), target_client, dashboard_state,
+                                                                  target_index=target_index, journal=journal)
+
+    def complete(target, loads):
+        target_client, workspace_state = target
+        for dashboard_id, loaded in loads:
+            try:
+                workspace_state[dashboard_id] = loaded.result()
+            except Exception as e:
+                logger.error(f"couldn't clone dashboard {dashboard_id} to {target_client.url}", exc_info=e)
+                failures[target_client.url].append((dashboard_id, e))
+        if on_target_complete is not None:
+            try:
+                on_target_complete(target_client, workspace_state, failures[target_client.url])
+            except Exception as e:
+                logger.exception(f"couldn't complete the clone to {target_client.url}")
+                failures[target_client.url].append((None, e))
+
+    schedulers = [Scheduler(max_workers_per_target) for _ in targets]
+    loads = [[] for _ in targets]
+    try:
+        #Each target is listed once while the first dashboards are being dumped
+        target_indexes = [scheduler.submit([Task(lambda target_client=target_client, workspace_state=workspace_state: get_target_index(target_client, workspace_state),
+                                                 name="target index")])[0]
+                          for scheduler, (target_client, workspace_state) in zip(schedulers, targets)]
+        with ThreadPoolExecutor(max_workers=dump_dashboard.max_workers) as dump_executor:
+            #Dashboards already cloned to all the targets by the interrupted run aren't dumped again
+            dashboard_ids = [dashboard_id for dashboard_id in dashboard_ids
+                             if not all(is_completed(target_client, dashboard_id) for target_client, _ in targets)]
+            dumps = {dump_executor.submit(dump, dashboard_id): dashboard_id for dashboard_id in dashboard_ids}
+            for dumped in as_completed(dumps):
+                try:
+                    dashboard = dumped.result()
+                except Exception as e:
+                    logger.exception(f"couldn't dump dashboard {dumps[dumped]} from {source_client.url}")
+                    for target_client, _ in targets:
+                        failures[target_client.url].append((dumps[dumped], e))
+                    continue
+                for i, (target_client, workspace_state) in enumerate(targets):
+                    if is_completed(target_client, dashboard["id"]):
+                        logger.debug(f"dashboard {dashboard['id']} already cloned to {target_client.url}, skipping it")
+                        continue
+                    if should_load is not None and not should_load(target_client, dashboard, workspace_state.get(dashboard["id"], {})):
+                        logger.debug(f"dashboard {dashboard['id']} doesn't have any change for {target_client.url}, skipping it")
+                        continue
+                    loads[i].append(load(schedulers[i], target_client, workspace_state, target_indexes[i], dashboard))
+        with ThreadPoolExecutor(max_workers=max(1, len(targets))) as completion_executor:
+            collections.deque(completion_executor.map(complete, targets, loads))
+    finally:
+        for scheduler in schedulers:
+            scheduler.close()
+    return failures
+
+def get_workspace_state_id(source_client: Client, target_client: Client):
+    return source_client.url+"-"+target_client.url
+
+#Get all the queries and dashboards referenced in the state
+def get_state_resource_ids(workspace_state):
+    new_queries = set()
+    new_dashboards = set()
+    for origin_dashboard_id in workspace_state:
+        #An interrupted clone can leave a dashboard without new_id
+        if "new_id" in workspace_state[origin_dashboard_id]:
+            new_dashboards.add(workspace_state[origin_dashboard_id]["new_id"])
+        for origin_query_id in workspace_state[origin_dashboard_id].get("queries", {}):
+            new_queries.add(workspace_state[origin_dashboard_id]["queries"][origin_query_id]["new_id"])
+    return new_queries, new_dashboards
+
+def save_state(state, state_file = "state.json"):
+    save_state_file(state, state_file)
 
 def delete_and_clone_dashboards_with_tags(source_client: Client, target_client: Client, tags: List,
-                                          delete_target_dashboards: bool, state):
+                                          delete_target_dashboards: bool, state, dump_folder = None, state_file = "state.json",
+                                          resume = False, plan = None, dump_cache_file = None, dump_cache = None):
+    failures = delete_and_clone_dashboards_with_tags_to_targets(source_client, [target_client], tags, delete_target_dashboards,
+                                                                state, dump_folder, state_file, resume=resume, plan=plan,
+                                                                dump_cache_file=dump_cache_file, dump_cache=dump_cache)
+    if len(failures[target_client.url]) > 0:
+        raise failures[target_client.url][0][1]
+
+def delete_and_clone_dashboards_with_tags_to_targets(source_client: Client, target_clients: List[Client], tags: List,
+                                                     delete_target_dashboards: bool, state, dump_folder = None,
+                                                     state_file = "state.json", max_workers_per_target = None, resume = False,
+                                                     plan = None, dump_cache_file = None, dump_cache = None):
+    """
+    Clones the source dashboards having any of the tags to all the targets at the same time, dumping the source only once.
+    Every mapping is recorded in the state file journal as soon as it's created, and the records of an interrupted run
+    are applied to the state first (state can be None to load it from state_file). With resume, the dashboards completed
+    by the interrupted run are skipped.
+    plan is a plan saved by planner.plan_dashboards_with_tags: the dashboards with the longest critical path start first, and
+    the dashboards without any planned change are skipped (unless the source or the state changed since the plan).
+    dump_cache_file keeps the source definitions between the runs: the dashboards whose updated_at and queries updated_at
+    didn't change aren't fetched again from the source. dump_cache can be set instead, ex: the catalog.Catalog of the source.
+    Each target state section is saved as soon as the target is complete. A failing target doesn't stop the others:
+    returns the failures of each target url as a list of (dashboard_id, exception).
+    """
     assert len(tags) > 0
+    state_store = StateStore(state_file)
+    state = state_store.load() if state is None else state_store.replay(state)
     logger.debug(f"fetching existing dashboard with tags in {tags}...")
-    workspace_state_id = source_client.url+"-"+target_client.url
-
     dashboards_to_clone = get_all_dashboards(source_client, tags)
-    if workspace_state_id not in state:
-        state[workspace_state_id] = {}
-    workspace_state = state[workspace_state_id]
-
-    logger.debug(f"start cloning {len(dashboards_to_clone)} dashboards...")
+    logger.debug(f"start cloning {len(dashboards_to_clone)} dashboards to {len(target_clients)} targets...")
     dashboard_to_clone_ids = [d["id"] for d in dashboards_to_clone]
+    if dump_cache_file is not None:
+        dump_cache = DumpCache(dump_cache_file)
+        dump_cache.set_listing(source_client, "dashboards", dashboards_to_clone)
+    should_load = None
+    if plan is not None:
+        dashboard_to_clone_ids = planner.get_plan_order(plan, dashboard_to_clone_ids)
+        should_load = lambda target_client, dashboard, dashboard_state: planner.needs_load(plan, target_client, dashboard, dashboard_state)
 
-    dump_dashboards(source_client, dashboard_to_clone_ids)
-    state[workspace_state_id] = load_dashboards(target_client, dashboard_to_clone_ids, workspace_state)
+    #The state saved on disk only gets the sections of the completed targets, the others are still being modified.
+    saved_state = copy.deepcopy(state)
+    saved_state_lock = threading.Lock()
+    targets = []
+    for target_client in target_clients:
+        workspace_state_id = get_workspace_state_id(source_client, target_client)
+        if workspace_state_id not in state:
+            state[workspace_state_id] = {}
+        targets.append((target_client, state[workspace_state_id]))
 
-    # Cleanup all existing resources, but skip the queries used in the new dashboard (to support update)
-    if delete_target_dashboards:
-        new_queries = set()
-        new_dashboards = set()
-        for origin_dashboard_id in state[workspace_state_id]:
-            new_dashboards.add(state[workspace_state_id][origin_dashboard_id]["new_id"])
-            for origin_query_id in state[workspace_state_id][origin_dashboard_id]["queries"]:
-                new_queries.add(state[workspace_state_id][origin_dashboard_id]["queries"][origin_query_id]["new_id"])
-        delete_queries(target_client, tags, new_queries)
-        delete_dashboard(target_client, tags, new_dashboards)
+    def complete_target(target_client, workspace_state, failures):
+        # Cleanup all existing resources, but skip the queries used in the new dashboard (to support update)
+        if delete_target_dashboards:
+            if len(failures) > 0:
+                logger.warning(f"{len(failures)} dashboards failed for {target_client.url}, skipping the cleanup of the target.")
+            else:
+                new_queries, new_dashboards = get_state_resource_ids(workspace_state)
+                report = delete_resources(target_client, tags, new_queries, new_dashboards)
+                if len(report["failed"]) > 0:
+                    logger.warning(f"{len(report['failed'])} objects couldn't be deleted from {target_client.url}")
+        logger.debug(f"import complete for {target_client.url}. Saving state for further update/analysis.")
+        with saved_state_lock:
+            saved_state[get_workspace_state_id(source_client, target_client)] = copy.deepcopy(workspace_state)
+            state_store.save(saved_state)
 
-    logger.debug("-----------------------")
-    logger.debug("import complete. Saving state for further update/analysis.")
-    logger.debug(state)
-    with open('state.json', 'w') as file:
-        file.write(json.dumps(state, indent=4, sort_keys=True))
+    try:
+        failures = dump_and_load_dashboards_to_targets(source_client, targets, dashboard_to_clone_ids, dump_folder,
+                                                       complete_target, max_workers_per_target, state_store, resume, should_load, dump_cache)
+        if isinstance(dump_cache, DumpCache):
+            dump_cache.save()
+        #The journal is only needed to resume the failed dashboards
+        if all(len(target_failures) == 0 for target_failures in failures.values()):
+            state_store.checkpoint(saved_state)
+        return failures
+    finally:
+        state_store.close()
 
 
-def set_data_source_id_from_endpoint_id(client):
+def get_data_sources(client: Client, cached = True):
+    """Data sources of the workspace, read from the catalog of the client if it has them."""
+    if cached and client.catalog is not None:
+        data_sources = client.catalog.get_data_sources(client)
+        if data_sources:
+            return data_sources
     logger.debug("Fetching endpoints to extract data_source id...")
-    with requests.get(client.url+"/api/2.0/preview/sql/data_sources", headers=client.headers, timeout=120) as r:
+    with client.get("/api/2.0/preview/sql/data_sources") as r:
         data_sources = r.json()
+    if client.catalog is not None:
+        client.catalog.set_data_sources(client, data_sources)
+    return data_sources
+
+def set_data_source_id_from_endpoint_id(client):
+    data_sources = get_data_sources(client)
+    #The endpoint could have been created after the data sources were saved in the catalog
+    if client.catalog is not None and client.endpoint_id is not None and not any(d.get("endpoint_id") == client.endpoint_id for d in data_sources):
+        data_sources = get_data_sources(client, cached=False)
     assert len(data_sources) > 0, "No endpoints available. Please create at least 1 endpoint before cloning the dashboards."
     if client.endpoint_id is None:
         logger.debug(f"No endpoint id found. Using the first endpoint available: {data_sources[0]}")
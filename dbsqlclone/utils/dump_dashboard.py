@@ -1,21 +1,160 @@
-import requests
 from .client import Client
 import json
-from concurrent.futures import ThreadPoolExecutor
-import collections
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+import copy
 import os
+import threading
 import logging
 
+from . import instrumentation
+
 logger = logging.getLogger('dbsqlclone.dump')
 
+max_workers = 10
+#Number of queries fetched in parallel for a single dashboard
+query_max_workers = 8
+
+
+class QueryCache():
+    """
+    Query definitions fetched during a run, shared by all the dashboards of the run (thread safe).
+    A query requested while it's being fetched by another thread waits for the same response:
+    each query is fetched at most once per workspace.
+    """
+    def __init__(self):
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def get_query(self, client: Client, query_id):
+        #Each caller gets its own copy as the definitions are modified when cloned
+        return copy.deepcopy(self.fetch_query(client, query_id))
+
+    def fetch_query(self, client: Client, query_id):
+        """Returns the cached definition itself, must not be modified."""
+        key = (client.url, query_id)
+        with self.lock:
+            future = self.queries.get(key)
+            fetch = future is None
+            if fetch:
+                future = Future()
+                self.queries[key] = future
+        if fetch:
+            try:
+                with client.get("/api/2.0/preview/sql/queries/" + query_id) as r:
+                    future.set_result(r.json())
+            except BaseException as e:
+                #Don't keep the failure, the next call will try again
+                with self.lock:
+                    del self.queries[key]
+                future.set_exception(e)
+        return future.result()
+
+
+def is_definition_unchanged(definition, dashboard_updated_at, get_queries_updated_at):
+    """
+    True if the listings show the same updated_at for the dashboard of the definition (dashboard_updated_at) and all its queries.
+    get_queries_updated_at(query_ids) returns the listed {id: updated_at}, it's only called if the dashboard didn't change.
+    The widgets and the visualizations aren't part of the listings: editing them doesn't change these updated_at.
+    """
+    if definition is None or dashboard_updated_at is None or definition["dashboard"].get("updated_at") != dashboard_updated_at:
+        return False
+    queries_updated_at = get_queries_updated_at([q["id"] for q in definition["queries"]])
+    return all(q.get("updated_at") is not None and queries_updated_at.get(q["id"]) == q["updated_at"] for q in definition["queries"])
+
+
+class DumpCache():
+    """
+    Dashboard definitions dumped by the previous runs, saved in cache_file: {source url: {dashboard id: definition}}.
+    A definition is reused when the listings show the same updated_at for the dashboard and all its queries,
+    otherwise it's fetched again. The dashboards updated_at come from set_listing, the queries are listed once per run.
+    Limitation: a widget or visualization edit doesn't change the updated_at of its dashboard or query, the cached
+    definition keeps the previous widgets and visualizations until the dashboard or the query itself is updated.
+    Delete the cache file to fetch everything again.
+    """
+    def __init__(self, cache_file = "dump_cache.json"):
+        self.cache_file = cache_file
+        self.definitions = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r") as r:
+                    self.definitions = json.load(r)
+            except ValueError as e:
+                print(f"Warning - ignoring the invalid dump cache {cache_file}: {e}")
+        #(source url, item) -> {id: updated_at} from the listings of this run
+        self.listings = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def set_listing(self, client: Client, item, items):
+        """Records the updated_at of the listed dashboards or queries (item)."""
+        with self.lock:
+            self.listings[(client.url, item)] = {i["id"]: i.get("updated_at") for i in items}
+
+    def get_queries_updated_at(self, client: Client):
+        #Listed on the first use only: a run without any cached definition doesn't list the queries
+        with self.lock:
+            if (client.url, "queries") not in self.listings:
+                from .clone_dashboard import iter_pages
+                with instrumentation.phase("list", item="queries"):
+                    if client.catalog is not None:
+                        self.listings[(client.url, "queries")] = client.catalog.get_updated_at(client, "queries")
+                    else:
+                        self.listings[(client.url, "queries")] = {q["id"]: q.get("updated_at") for q in iter_pages(client, "queries")}
+            return self.listings[(client.url, "queries")]
 
-def dump_dashboards(source_client: Client, dashboard_ids):
-    params = [(source_client, id) for id in dashboard_ids]
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        collections.deque(executor.map(lambda args, f=dump_dashboard: f(*args), params))
+    def get(self, client: Client, dashboard_id):
+        """Returns a copy of the cached definition if neither the dashboard nor its queries changed, None otherwise."""
+        with self.lock:
+            definition = self.definitions.get(client.url, {}).get(dashboard_id)
+            updated_at = self.listings.get((client.url, "dashboards"), {}).get(dashboard_id)
+        hit = is_definition_unchanged(definition, updated_at, lambda query_ids: self.get_queries_updated_at(client))
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return copy.deepcopy(definition) if hit else None
 
-def dump_dashboard(source_client: Client, dashboard_id, folder_prefix="./dashboards/"):
-    dashboard = get_dashboard_definition_by_id(source_client, dashboard_id)
+    def put(self, client: Client, definition):
+        with self.lock:
+            self.definitions.setdefault(client.url, {})[definition["id"]] = copy.deepcopy(definition)
+
+    def save(self):
+        """Saves the cache, without the dashboards which weren't in the listings of this run."""
+        with self.lock:
+            for (url, item), listing in self.listings.items():
+                if item == "dashboards" and url in self.definitions:
+                    self.definitions[url] = {id: d for id, d in self.definitions[url].items() if id in listing}
+            logger.debug(f"dump cache: {self.hits} dashboards reused, {self.misses} fetched")
+            with open(self.cache_file+".tmp", "w") as file:
+                json.dump(self.definitions, file, separators=(",", ":"))
+            os.replace(self.cache_file+".tmp", self.cache_file)
+
+
+def dump_dashboards(source_client: Client, dashboard_ids, folder_prefix="./dashboards/", progress = None, dump_cache: DumpCache = None):
+    """
+    Dumps the dashboards in the folder with max_workers threads sharing the same query cache.
+    progress.done(dashboard_id, error) is called after each dashboard (see instrumentation.Progress),
+    without progress the first failure is raised.
+    """
+    query_cache = QueryCache()
+    run_dumps(lambda dashboard_id: dump_dashboard(source_client, dashboard_id, folder_prefix, query_cache, dump_cache), dashboard_ids, progress)
+
+def run_dumps(dump, dashboard_ids, progress = None):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dumps = {executor.submit(instrumentation.bind(dump), dashboard_id): dashboard_id for dashboard_id in dashboard_ids}
+        for dumped in as_completed(dumps):
+            if progress is None:
+                dumped.result()
+            else:
+                progress.done(dumps[dumped], dumped.exception())
+
+def dump_dashboard(source_client: Client, dashboard_id, folder_prefix="./dashboards/", query_cache: QueryCache = None, dump_cache: DumpCache = None):
+    dashboard = get_dashboard_definition_by_id(source_client, dashboard_id, query_cache, dump_cache)
+    write_dashboard(dashboard, dashboard_id, folder_prefix)
+
+def write_dashboard(dashboard, dashboard_id, folder_prefix="./dashboards/"):
     if not folder_prefix.endswith("/"):
         folder_prefix += "/"
     if not os.path.exists(folder_prefix):
@@ -23,35 +162,66 @@ def dump_dashboard(source_client: Client, dashboard_id, folder_prefix="./dashboa
     with open(f'{folder_prefix}dashboard-{dashboard_id}.json', 'w') as file:
         file.write(json.dumps(dashboard, indent=4, sort_keys=True))
 
-def get_dashboard_definition_by_id(source_client: Client, dashboard_id):
-    logger.debug(f"getting dashboard definition from {dashboard_id}...")
-    result = {"queries": [], "id": dashboard_id}
-    dashboard = requests.get(source_client.url+"/api/2.0/preview/sql/dashboards/"+dashboard_id, headers = source_client.headers).json()
-    result["dashboard"] = dashboard
-    query_ids = list()
-    param_query_ids = set()
-
-    def recursively_append_param_queries(q):
-        for p in q["options"]["parameters"]:
-            if "queryId" in p:
-                query_ids.insert(0, p["queryId"])
-                param_query_ids.add(p["queryId"])
-                #get the details of the underlying query to recursively append children queries from parameters if any
-                child_q = requests.get(source_client.url + "/api/2.0/preview/sql/queries/" + p["queryId"], headers=source_client.headers).json()
-                recursively_append_param_queries(child_q)
-    #fetch all the queries required for the widgets, recursively
-    for widget in dashboard["widgets"]:
+def get_param_query_ids(q):
+    return [p["queryId"] for p in q.get("options", {}).get("parameters", []) if "queryId" in p]
+
+#Fetches all the queries of the dashboard in the cache, level by level: the widget queries, then their parameter
+#queries, then the parameters of these ones... Each level is fetched in parallel.
+def prefetch_dashboard_queries(source_client: Client, dashboard, query_cache: QueryCache):
+    level = []
+    for widget in dashboard.get("widgets", []):
         if "visualization" in widget:
-            #First we need to add the queries from the parameters to make sure we clone them too
-            if "options" in widget["visualization"]["query"] and \
-                    "parameters" in widget["visualization"]["query"]["options"]:
-                recursively_append_param_queries(widget["visualization"]["query"])
-            query_ids.append(widget["visualization"]["query"]["id"])
-
-    #removes duplicated but keep order (we need to start with the param queries first)
-    query_ids = list(dict.fromkeys(query_ids))
-    for query_id in query_ids:
-        q = requests.get(source_client.url + "/api/2.0/preview/sql/queries/" + query_id, headers=source_client.headers).json()
-        q["is_parameter_query"] = query_id in param_query_ids
-        result["queries"].append(q)
-    return result
\ No newline at end of file
+            level.append(widget["visualization"]["query"]["id"])
+            level.extend(get_param_query_ids(widget["visualization"]["query"]))
+    fetched = set()
+    with ThreadPoolExecutor(max_workers=query_max_workers) as executor:
+        while len(level) > 0:
+            level = [query_id for query_id in dict.fromkeys(level) if query_id not in fetched]
+            fetched.update(level)
+            queries = executor.map(instrumentation.bind(lambda query_id: query_cache.fetch_query(source_client, query_id)), level)
+            level = [param_query_id for q in queries for param_query_id in get_param_query_ids(q)]
+
+def get_dashboard_definition_by_id(source_client: Client, dashboard_id, query_cache: QueryCache = None, dump_cache: DumpCache = None):
+    """Returns the definition of the dashboard and its queries. dump_cache (a DumpCache or a catalog.Catalog) reuses the unchanged definitions."""
+    with instrumentation.phase("dump", dashboard=dashboard_id):
+        if dump_cache is not None:
+            result = dump_cache.get(source_client, dashboard_id)
+            if result is not None:
+                logger.debug(f"dashboard {dashboard_id} and its queries didn't change, using the cached definition")
+                return result
+        logger.debug(f"getting dashboard definition from {dashboard_id}...")
+        if query_cache is None:
+            query_cache = QueryCache()
+        result = {"queries": [], "id": dashboard_id}
+        dashboard = source_client.get("/api/2.0/preview/sql/dashboards/"+dashboard_id).json()
+        result["dashboard"] = dashboard
+        prefetch_dashboard_queries(source_client, dashboard, query_cache)
+        query_ids = list()
+        param_query_ids = set()
+
+        def recursively_append_param_queries(q):
+            for p in q["options"]["parameters"]:
+                if "queryId" in p:
+                    query_ids.insert(0, p["queryId"])
+                    param_query_ids.add(p["queryId"])
+                    #get the details of the underlying query to recursively append children queries from parameters if any
+                    child_q = query_cache.get_query(source_client, p["queryId"])
+                    recursively_append_param_queries(child_q)
+        #fetch all the queries required for the widgets, recursively
+        for widget in dashboard["widgets"]:
+            if "visualization" in widget:
+                #First we need to add the queries from the parameters to make sure we clone them too
+                if "options" in widget["visualization"]["query"] and \
+                        "parameters" in widget["visualization"]["query"]["options"]:
+                    recursively_append_param_queries(widget["visualization"]["query"])
+                query_ids.append(widget["visualization"]["query"]["id"])
+
+        #removes duplicated but keep order (we need to start with the param queries first)
+        query_ids = list(dict.fromkeys(query_ids))
+        for query_id in query_ids:
+            q = query_cache.get_query(source_client, query_id)
+            q["is_parameter_query"] = query_id in param_query_ids
+            result["queries"].append(q)
+        if dump_cache is not None:
+            dump_cache.put(source_client, result)
+        return result
\ No newline at end of file
@@ -0,0 +1,244 @@
+import contextlib
+import contextvars
+import json
+import math
+import re
+import threading
+import time
+import logging
+
+logger = logging.getLogger('dbsqlclone.instrumentation')
+
+#Hooks receiving the events: objects with on_request(event) and on_phase(event) methods (see Metrics)
+_hooks = []
+_hooks_lock = threading.Lock()
+#Phase, dashboard and query being processed by the current thread/task
+_context = contextvars.ContextVar("dbsqlclone_context", default={})
+
+
+def add_hook(hook):
+    with _hooks_lock:
+        _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+
+def enabled():
+    return len(_hooks) > 0
+
+
+def get_context():
+    return _context.get()
+
+
+@contextlib.contextmanager
+def phase(name, **tags):
+    """
+    Tags all the requests sent within the block with the phase (list, dump, warmup, query, visualizations, dashboard,
+    widgets, permissions, cleanup...) and the given tags (dashboard, query). Nested phases inherit the parent tags.
+    """
+    parent = _context.get()
+    context = {**parent, **tags, "phase": name}
+    token = _context.set(context)
+    start = time.time()
+    try:
+        yield context
+    finally:
+        _context.reset(token)
+        if enabled():
+            emit("on_phase", {**context, "parent_phase": parent.get("phase"), "start": start,
+                              "duration": time.time() - start, "thread": threading.get_ident()})
+
+
+@contextlib.contextmanager
+def tags(**tags):
+    """Same as phase without recording a phase: for the code scheduling work which runs later (see Scheduler)."""
+    token = _context.set({**_context.get(), **tags})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind(f):
+    """Wraps f to run with the current phase and tags, to keep them in the thread pools."""
+    context = contextvars.copy_context()
+    def run(*args, **kwargs):
+        return context.copy().run(f, *args, **kwargs)
+    return run
+
+
+def get_endpoint(path):
+    #Removes the ids to group the calls by endpoint: /api/2.0/preview/sql/queries/{id}
+    path = re.sub(r"/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", "/{id}", path.split("?")[0])
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+def record_request(method, path, status, start, latency, wait = 0, attempt = 0, bytes_sent = 0, bytes_received = 0, workspace = None):
+    """Called by the client for every http call (each retry is a separate call)."""
+    if not enabled():
+        return
+    emit("on_request", {**_context.get(), "workspace": workspace, "method": method, "endpoint": get_endpoint(path), "path": path, "status": status,
+                        "start": start, "latency": latency, "wait": wait, "attempt": attempt, "bytes_sent": bytes_sent,
+                        "bytes_received": bytes_received, "thread": threading.get_ident()})
+
+
+def emit(method, event):
+    for hook in list(_hooks):
+        try:
+            getattr(hook, method)(event)
+        except Exception as e:
+            logger.warning(f"instrumentation hook {hook} failed: {e}")
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Metrics():
+    """
+    Hook collecting every request and phase of the run. Summarizes the calls per endpoint (count, errors, retries,
+    p50/p95 latency, bytes, time spent waiting for the rate limiter) and saves a Chrome trace (chrome://tracing, Perfetto).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.phases = []
+        self.start = time.time()
+
+    def on_request(self, event):
+        with self.lock:
+            self.requests.append(event)
+
+    def on_phase(self, event):
+        with self.lock:
+            self.phases.append(event)
+
+    def get_summary(self):
+        with self.lock:
+            requests, phases = list(self.requests), list(self.phases)
+        endpoints = {}
+        for r in requests:
+            endpoints.setdefault(f"{r['method']} {r['endpoint']}", []).append(r)
+        summary = {"duration": time.time() - self.start, "requests": len(requests), "endpoints": {}, "phases": {}}
+        for endpoint, calls in sorted(endpoints.items()):
+            latencies = [r["latency"] for r in calls]
+            summary["endpoints"][endpoint] = {
+                "count": len(calls),
+                "errors": len([r for r in calls if not isinstance(r["status"], int) or r["status"] >= 400]),
+                "retries": len([r for r in calls if r["attempt"] > 0]),
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "max": max(latencies),
+                "wait": sum(r["wait"] for r in calls),
+                "bytes_sent": sum(r["bytes_sent"] for r in calls),
+                "bytes_received": sum(r["bytes_received"] for r in calls)
+            }
+        for p in phases:
+            entry = summary["phases"].setdefault(p["phase"], {"count": 0, "duration": 0})
+            entry["count"] += 1
+            entry["duration"] += p["duration"]
+        return summary
+
+    def print_summary(self):
+        summary = self.get_summary()
+        print(f"{summary['requests']} requests in {summary['duration']:.1f}s")
+        print(f"{'endpoint':<55}{'count':>7}{'errors':>7}{'retries':>8}{'p50':>8}{'p95':>8}{'max':>8}{'wait':>8}{'KB':>9}")
+        for endpoint, e in summary["endpoints"].items():
+            print(f"{endpoint:<55}{e['count']:>7}{e['errors']:>7}{e['retries']:>8}{e['p50']:>8.3f}{e['p95']:>8.3f}{e['max']:>8.3f}"
+                  f"{e['wait']:>8.1f}{(e['bytes_sent'] + e['bytes_received']) / 1024:>9.1f}")
+        for name, p in summary["phases"].items():
+            print(f"phase {name:<20} {p['count']:>6} x, {p['duration']:.1f}s cumulated")
+
+    def get_trace(self):
+        """Chrome trace format: one complete event per request and phase, a separate one for the rate limiter wait."""
+        with self.lock:
+            requests, phases = list(self.requests), list(self.phases)
+        events = []
+        def us(t):
+            return int((t - self.start) * 1e6)
+        for p in phases:
+            args = {k: v for k, v in p.items() if k not in ["start", "duration", "thread", "phase"]}
+            events.append({"name": p["phase"], "cat": "phase", "ph": "X", "ts": us(p["start"]), "dur": int(p["duration"] * 1e6),
+                           "pid": 1, "tid": p["thread"], "args": args})
+        for r in requests:
+            if r["wait"] > 0:
+                events.append({"name": "rate limit wait", "cat": "wait", "ph": "X", "ts": us(r["start"] - r["wait"]),
+                               "dur": int(r["wait"] * 1e6), "pid": 1, "tid": r["thread"]})
+            args = {k: v for k, v in r.items() if k not in ["start", "latency", "thread", "wait"]}
+            events.append({"name": f"{r['method']} {r['endpoint']}", "cat": "request", "ph": "X", "ts": us(r["start"]),
+                           "dur": int(r["latency"] * 1e6), "pid": 1, "tid": r["thread"], "args": args})
+        return {"traceEvents": sorted(events, key=lambda e: e["ts"]), "displayTimeUnit": "ms"}
+
+    def save_trace(self, trace_file):
+        with open(trace_file, "w") as w:
+            json.dump(self.get_trace(), w, default=str)
+
+
+class Progress():
+    """
+    Hook following a bulk export/import: counts the dashboards completed (done) and the requests sent, prints the
+    progress at most every interval seconds, and report() prints the throughput and the failures at the end.
+    """
+    def __init__(self, action, total, interval = 10):
+        self.action = action
+        self.total = total
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_print = self.start
+        self.completed = 0
+        self.failures = []
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def on_request(self, event):
+        with self.lock:
+            self.requests += 1
+            self.bytes += event["bytes_sent"] + event["bytes_received"]
+            if not isinstance(event["status"], int) or event["status"] >= 400:
+                self.errors += 1
+
+    def on_phase(self, event):
+        pass
+
+    def done(self, dashboard_id, error = None):
+        with self.lock:
+            self.completed += 1
+            if error is not None:
+                self.failures.append((dashboard_id, error))
+            now = time.time()
+            should_print = now - self.last_print >= self.interval or self.completed == self.total
+            if should_print:
+                self.last_print = now
+            completed, failed = self.completed, len(self.failures)
+        if error is not None:
+            print(f"ERROR - dashboard {dashboard_id} couldn't be {self.action}: {error}")
+        if should_print:
+            print(f"{self.action} {completed}/{self.total} dashboards ({failed} failed) in {now - self.start:.1f}s")
+
+    def get_report(self):
+        with self.lock:
+            duration = time.time() - self.start
+            return {"action": self.action, "total": self.total, "completed": self.completed, "failed": len(self.failures),
+                    "duration": duration, "requests": self.requests, "request_errors": self.errors, "bytes": self.bytes,
+                    "dashboards_per_sec": self.completed / duration if duration > 0 else 0,
+                    "requests_per_sec": self.requests / duration if duration > 0 else 0}
+
+    def report(self):
+        r = self.get_report()
+        print(f"{r['action']} {r['completed'] - r['failed']}/{r['total']} dashboards in {r['duration']:.1f}s: "
+              f"{r['dashboards_per_sec']:.2f} dashboards/s, {r['requests']} requests ({r['requests_per_sec']:.1f}/s, "
+              f"{r['request_errors']} errors), {r['bytes'] / 1024 / 1024:.1f} MB")
+        for dashboard_id, error in self.failures:
+            print(f"    failed: {dashboard_id} - {error}")
+        return r
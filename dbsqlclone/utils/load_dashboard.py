@@ -1,54 +1,181 @@
 import time
+import copy
+import hashlib
+import os
+import threading
 
-import requests
 from dbsqlclone.utils.client import Client
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
 import json
 import collections
 import logging
 
-from .dump_dashboard import get_dashboard_definition_by_id
-from .clone_dashboard import delete_query
+from .dump_dashboard import get_dashboard_definition_by_id, QueryCache
+from . import instrumentation
+from .scheduler import Scheduler, Task
+from .cleanup import Cleanup
 
 logger = logging.getLogger('dbsqlclone.load')
 
 max_workers = 3
+#Max time to wait for the param queries job, and time to wait for other dashboards to batch their param queries in the same job
+warmup_timeout = 1800
+warmup_batch_delay = 2
+#The visualizations of a query are created concurrently (the state mapping is still filled in the order of their ids).
+#Set it to True to create them one after the other in the order of their ids: their order on the query screen is kept,
+#but each query then takes one call duration per visualization instead of one in total.
+ordered_visualizations = False
 
-def load_dashboards(target_client: Client, dashboard_ids, workspace_state):
+def load_dashboards(target_client: Client, dashboard_ids, workspace_state, folder_prefix="./dashboards/", progress = None):
+    return load_definitions(target_client, ((dashboard_id, read_dashboard(dashboard_id, folder_prefix)) for dashboard_id in dashboard_ids),
+                            workspace_state, progress)
+
+def load_dashboard_files(target_client: Client, files, workspace_state, progress = None):
+    """Same as load_dashboards for a list of json files saved by dump_dashboard (dashboard-<id>.json)."""
+    return load_definitions(target_client, ((get_dashboard_file_id(file), read_dashboard_file(file)) for file in files),
+                            workspace_state, progress)
+
+def load_definitions(target_client: Client, definitions, workspace_state, progress = None):
+    """
+    Loads the (dashboard_id, definition) of the iterable, read lazily, on a single scheduler.
+    progress.done(dashboard_id, error) is called as soon as each dashboard is loaded (see instrumentation.Progress),
+    without progress the first failure is raised. Returns the workspace state.
+    """
     if workspace_state is None:
         workspace_state = {}
-    params = [(target_client, dashboard_id, workspace_state[dashboard_id] if dashboard_id in workspace_state else {}) for dashboard_id in dashboard_ids]
-
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        for (dashboard_id, dashboard_state) in executor.map(lambda args, f=load_dashboard: f(*args), params):
-            workspace_state[dashboard_id] = dashboard_state
+    #Lists the target once instead of checking every object of the state
+    from .clone_dashboard import get_target_index
+    target_index = get_target_index(target_client, workspace_state)
+    #All the dashboards share the same scheduler: a dashboard waiting for its param queries doesn't hold any thread
+    with Scheduler() as scheduler:
+        loads = []
+        for dashboard_id, dashboard in definitions:
+            load = schedule_dashboard(scheduler, dashboard, target_client,
+                                      workspace_state[dashboard_id] if dashboard_id in workspace_state else {}, target_index=target_index)
+            if progress is not None:
+                load.add_done_callback(lambda load, dashboard_id=dashboard_id: progress.done(dashboard_id, load.exception()))
+            loads.append((dashboard_id, load))
+        for dashboard_id, load in loads:
+            if progress is None or load.exception() is None:
+                workspace_state[dashboard_id] = load.result()
     return workspace_state
 
-def load_dashboard(target_client: Client, dashboard_id, dashboard_state, folder_prefix="./dashboards/"):
+def read_dashboard(dashboard_id, folder_prefix="./dashboards/"):
     if not folder_prefix.endswith("/"):
         folder_prefix += "/"
-    with open(f'{folder_prefix}dashboard-{dashboard_id}.json', 'r') as r:
-        dashboard = json.loads(r.read())
-        dashboard_state = clone_dashboard(dashboard, target_client, dashboard_state)
-        return dashboard_id, dashboard_state
+    return read_dashboard_file(f'{folder_prefix}dashboard-{dashboard_id}.json')
+
+def read_dashboard_file(file):
+    with open(file, 'r') as r:
+        return json.loads(r.read())
+
+def get_dashboard_file_id(file):
+    #dashboard-<id>.json
+    name = os.path.basename(file)
+    if name.startswith("dashboard-") and name.endswith(".json"):
+        return name[len("dashboard-"):-len(".json")]
+    return os.path.splitext(name)[0]
+
+def load_dashboard(target_client: Client, dashboard_id, dashboard_state, folder_prefix="./dashboards/", target_index = None, scheduler: Scheduler = None):
+    dashboard = read_dashboard(dashboard_id, folder_prefix)
+    dashboard_state = clone_dashboard(dashboard, target_client, dashboard_state, target_index=target_index, scheduler=scheduler)
+    return dashboard_id, dashboard_state
 
 #Try to match the existing query based on the name. This is to avoid having to delete/recreate the queries everytime
-def recreate_dashboard_state(target_client, dashboard, dashboard_id):
+def recreate_dashboard_state(target_client, dashboard, dashboard_id, query_cache: QueryCache = None):
     #Get the definition of the existing dashboard
-    existing_dashboard = get_dashboard_definition_by_id(target_client, dashboard_id)
-    state = {"queries": {}, "visualizations": {}, "new_id": existing_dashboard["dashboard"]["id"]}
-    queries_not_matching = []
-    for q in existing_dashboard["queries"]:
-        matching_query = next((existing_q for existing_q in dashboard["queries"] if q['name'] == existing_q['name']), None)
-        if matching_query is None:
-            queries_not_matching.append(q)
-        else:
-            state["queries"][matching_query['id']] = {"new_id": q['id']}
+    existing_dashboard = get_dashboard_definition_by_id(target_client, dashboard_id, query_cache)
+    queries, queries_not_matching = match_queries(dashboard["queries"], existing_dashboard["queries"])
+    state = {"queries": queries, "visualizations": {}, "new_id": existing_dashboard["dashboard"]["id"]}
     return state, queries_not_matching
 
 
+#Same as recreate_dashboard_state for multiple dashboards. existing_dashboard_ids contains the target dashboard id of each
+#source dashboard id. The target queries are listed once: only the target dashboards are fetched, not their queries.
+#Returns the workspace state and the target queries not matching any source query.
+def recreate_workspace_state(target_client: Client, dashboards, existing_dashboard_ids):
+    from .clone_dashboard import iter_pages
+    catalog = target_client.catalog
+    target_queries = {q["id"]: q for q in (catalog.get_items(target_client, "queries") if catalog is not None else iter_pages(target_client, "queries"))}
+    query_cache = QueryCache()
+
+    def get_existing_queries(existing_dashboard):
+        existing_queries = {}
+        level = [w["visualization"]["query"] for w in existing_dashboard["widgets"] if "visualization" in w]
+        while len(level) > 0:
+            level = [q for q in level if q["id"] not in existing_queries]
+            existing_queries.update((q["id"], q) for q in level)
+            #Param queries missing from the listing (ex: trashed) are fetched one by one
+            level = [target_queries[query_id] if query_id in target_queries else query_cache.fetch_query(target_client, query_id)
+                     for q in level for query_id in get_param_query_ids(q)]
+        return list(existing_queries.values())
+
+    def recreate(dashboard):
+        existing_dashboard = catalog.get_dashboard(target_client, existing_dashboard_ids[dashboard["id"]]) if catalog is not None else None
+        if existing_dashboard is not None:
+            #The queries of the widgets can be updated without changing the dashboard: the listing has their last version
+            for w in existing_dashboard["widgets"]:
+                if "visualization" in w and w["visualization"]["query"]["id"] in target_queries:
+                    w["visualization"]["query"] = target_queries[w["visualization"]["query"]["id"]]
+        else:
+            with target_client.get("/api/2.0/preview/sql/dashboards/"+existing_dashboard_ids[dashboard["id"]]) as r:
+                existing_dashboard = r.json()
+            if catalog is not None:
+                catalog.put_dashboard(target_client, existing_dashboard)
+        existing_queries = get_existing_queries(existing_dashboard)
+        queries, _ = match_queries(dashboard["queries"], existing_queries)
+        return dashboard["id"], {"queries": queries, "visualizations": {}, "new_id": existing_dashboard["id"]}, existing_queries
+
+    workspace_state = {}
+    existing_queries = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for dashboard_id, dashboard_state, queries in executor.map(recreate, [d for d in dashboards if d["id"] in existing_dashboard_ids]):
+            workspace_state[dashboard_id] = dashboard_state
+            existing_queries.update((q["id"], q) for q in queries)
+    #A target query can be used by multiple dashboards: it's kept if any of them matched it
+    matched = set(q["new_id"] for dashboard_state in workspace_state.values() for q in dashboard_state["queries"].values())
+    return workspace_state, [q for q in existing_queries.values() if q["id"] not in matched]
+
+
+#Fingerprint of the query text, ignoring the formatting
+def get_query_fingerprint(q):
+    return content_hash(" ".join(q.get("query", "").split()))
+
+
+def match_queries(queries, existing_queries):
+    """
+    Matches the source queries with the existing target queries having the same name, preferring the ones having
+    the same query text. Each target query is matched once: queries having duplicated names are matched in order.
+    Returns the state of the matching queries and the target queries not matching.
+    """
+    by_fingerprint = {}
+    by_name = {}
+    for existing_q in existing_queries:
+        by_fingerprint.setdefault((existing_q["name"], get_query_fingerprint(existing_q)), collections.deque()).append(existing_q)
+        by_name.setdefault(existing_q["name"], collections.deque()).append(existing_q)
+    matched = set()
+
+    def next_match(candidates):
+        while candidates:
+            existing_q = candidates.popleft()
+            if existing_q["id"] not in matched:
+                matched.add(existing_q["id"])
+                return existing_q
+        return None
+
+    state = {}
+    for key in [lambda q: by_fingerprint.get((q["name"], get_query_fingerprint(q))), lambda q: by_name.get(q["name"])]:
+        for q in queries:
+            if q["id"] not in state:
+                existing_q = next_match(key(q))
+                if existing_q is not None:
+                    state[q["id"]] = {"new_id": existing_q["id"]}
+    return state, [q for q in existing_queries if q["id"] not in matched]
+
+
 #Override the existing_dashboard_id queries by trying to match them by name. If the name change, will create a new query and delete the existing one.
 def clone_dashboard_without_saved_state(dashboard, target_client: Client, existing_dashboard_id, parent: str = None):
+    from .clone_dashboard import delete_query
     dashboard_state, queries_not_matching = recreate_dashboard_state(target_client, dashboard, existing_dashboard_id)
     logger.debug(dashboard_state)
     state = clone_dashboard(dashboard, target_client, dashboard_state, parent)
@@ -57,95 +184,367 @@ def clone_dashboard_without_saved_state(dashboard, target_client: Client, existi
         delete_query(target_client, q)
     return state
 
-def clone_dashboard(dashboard, target_client: Client, dashboard_state: dict = None, parent: str = None):
+def clone_dashboard(dashboard, target_client: Client, dashboard_state: dict = None, parent: str = None, target_index = None, journal = None,
+                    scheduler: Scheduler = None):
+    """
+    Clones the dashboard and its queries, or updates the existing clone of the state. All the calls run as tasks of the
+    scheduler shared by the dashboards cloned to the target (a scheduler of max_workers threads is used if None).
+    Returns the dashboard state.
+    """
+    if scheduler is not None:
+        return schedule_dashboard(scheduler, dashboard, target_client, dashboard_state, parent, target_index, journal).result()
+    with Scheduler(max_workers) as scheduler:
+        return schedule_dashboard(scheduler, dashboard, target_client, dashboard_state, parent, target_index, journal).result()
+
+
+def schedule_dashboard(scheduler: Scheduler, dashboard, target_client: Client, dashboard_state: dict = None, parent: str = None,
+                       target_index = None, journal = None):
+    """
+    Submits the clone of the dashboard to the scheduler as a graph of tasks: one task per query, per query visualizations,
+    per permission, for the param queries job, the dashboard (with a task per widget) and the final state.
+    target_index can be a Future (the listing is still running): the tasks wait for it.
+    Returns the task of the final state, resolved with the dashboard state.
+    """
+    from . import planner
     if dashboard_state is None:
         dashboard_state = {}
     if "queries" not in dashboard_state:
         dashboard_state["queries"] = {}
+    #The tasks run with the dashboard tags
+    with instrumentation.tags(dashboard=dashboard.get("id", dashboard["dashboard"].get("id"))):
+        index_dependency = target_index if isinstance(target_index, Future) else None
 
-    def load_query(q):
-        #We need to replace the param queries with the newly created one
-        if "parameters" in q["options"]:
-            for p in q["options"]["parameters"]:
-                if "queryId" in p:
-                    p["queryId"] = dashboard_state["queries"][p["queryId"]]["new_id"]
-                    if "parentQueryId" in p:
-                        del p["parentQueryId"]
-                    #if "value" in p:
-                    #    del p["value"]
-                    #if "$$value" in p:
-                    #    del p["$$value"]
-        new_query = clone_or_update_query(dashboard_state, q, target_client, parent)
-        if "id" not in new_query:
-            print(f"Warning - query wasn't properly created, import might fail: {new_query}")
-        else:
+        def get_target_index():
+            return target_index.result() if isinstance(target_index, Future) else target_index
+
+        previous_states = {}
+        permission_tasks = []
+        #Source query id (None for the dashboard) -> hash of the permissions applied to its target
+        permission_hashes = {}
+        #Source query id -> task loading the query and its visualizations, resolved with True if it's been created or changed
+        query_tasks = {}
+        tasks = []
+
+        def load_query(q):
+            with instrumentation.phase("query", query=q["id"]):
+                replace_param_query_ids(q, dashboard_state)
+                previous_states[q["id"]] = dashboard_state["queries"].get(q["id"], {})
+                new_query = clone_or_update_query(dashboard_state, q, target_client, parent, get_target_index())
+                if "id" not in new_query:
+                    print(f"Warning - query wasn't properly created, import might fail: {new_query}")
+                elif journal is not None and new_query["id"] != previous_states[q["id"]].get("new_id"):
+                    #Recorded as soon as it's created, the final state is recorded once its visualizations are created
+                    journal.query(q["id"], get_created_query_state(q, new_query))
+                return new_query
+
+        def load_visualizations(q, query_task):
+            new_query = query_task.result()
+            query_state = previous_states[q["id"]]
+            if "id" not in new_query:
+                return False
+            with instrumentation.phase("visualizations", query=q["id"]):
+                if new_query["id"] == query_state.get("new_id"):
+                    visualizations, to_create = update_query_visualization(target_client, q, new_query, query_state)
+                else:
+                    visualizations, to_create = clone_query_visualization(target_client, q, new_query)
+            #The new visualizations are created concurrently, as children of this task
+            creates = []
+            for v in to_create:
+                creates.append(Task(lambda v=v: create_visualization(target_client, v, new_query["id"]),
+                                    creates[-1:] if ordered_visualizations else [], name=f"create visualization {v['id']}"))
+            state_task = Task(lambda: save_query_state(q, new_query, visualizations, dict(zip([v["id"] for v in to_create], creates))),
+                              creates, 0, name=f"query state {q['id']}")
+            scheduler.submit(creates + [state_task])
+            return state_task
+
+        def save_query_state(q, new_query, visualizations, creates):
+            query_state = previous_states[q["id"]]
+            #Same order as the ids of the source visualizations
+            for visualization_id, create in creates.items():
+                visualizations[visualization_id] = create.result()
+            dashboard_state["queries"][q["id"]] = get_query_state(q, new_query, visualizations, target_client, parent)
+            if new_query["id"] == query_state.get("new_id") and "permissions_hash" in query_state:
+                #Updated by the state task once the permissions task is complete
+                dashboard_state["queries"][q["id"]]["permissions_hash"] = query_state["permissions_hash"]
+            if journal is not None and dashboard_state["queries"][q["id"]] != query_state:
+                journal.query(q["id"], dashboard_state["queries"][q["id"]])
+            #True if the query has been created or its content changed
+            return dashboard_state["queries"][q["id"]].get("hash") != query_state.get("hash") or \
+                   dashboard_state["queries"][q["id"]].get("new_id") != query_state.get("new_id")
+
+        def add_query(q, depends_on):
+            #The queries used as parameters must be loaded first, they're referenced by their new id
+            for query_id in get_param_query_ids(q):
+                if query_id in queries and query_id not in query_tasks:
+                    add_query(queries[query_id], [])
+            depends_on = depends_on + [query_tasks[query_id] for query_id in get_param_query_ids(q) if query_id in query_tasks]
+            query_task = Task(lambda: load_query(q), depends_on + [index_dependency], name=f"query {q['id']}")
+            query_tasks[q["id"]] = Task(lambda: load_visualizations(q, query_task), [query_task],
+                                        len(q["visualizations"]) + 1 if ordered_visualizations else 2, name=f"visualizations {q['id']}")
+            tasks.extend([query_task, query_tasks[q["id"]]])
             if target_client.permisions_defined():
-                with requests.post(target_client.url+"/api/2.0/preview/sql/permissions/queries/"+new_query["id"], headers = target_client.headers, json=target_client.permissions) as r:
-                    permissions = r.json()
-                logger.debug(f"     Permissions set to {permissions}")
-            visualizations = clone_query_visualization(target_client, q, new_query)
-            dashboard_state["queries"][q["id"]] = {"new_id": new_query["id"], "visualizations": visualizations}
-
-    #First loads the queries used as parameters. They need to be loaded first as the other will depend on these
-    tasks = []
-    for q in dashboard["queries"] :
-        if "is_parameter_query" not in q or q["is_parameter_query"]:
-            load_query(q)
-            task = {
-                "task_key": "run_param_query_"+dashboard_state["queries"][q["id"]]["new_id"],
-                "sql_task": {
-                    "query": {
-                        "query_id": dashboard_state["queries"][q["id"]]["new_id"]
-                    },
-                    "warehouse_id": target_client.endpoint_id
-                }
-            }
-            #Make sure they are sequential as we can have table creation concurrent exception otherwise.
-            if len(tasks) > 0:
-                task["depends_on"] = {"task_key": tasks[len(tasks)-1]["task_key"]}
-            tasks.append(task)
-    #Params requests now need to be run first. Starts a job to run them all and wait for the job...
-    if len(tasks) > 0:
-        print("Your dashboard has widgets. Widget queries need to be run first to be able to load other queries.")
-        print("DBSQL-CLONE will now submit a job run to start the param queries. This will take a few minutes without serverless (few sec with serverless)...")
-        print(f"You can check the progress in {target_client.url}#job/runs")
-        from datetime import datetime
-        now = datetime.now()
-        dt_string = now.strftime("%d-%m-%Y-%H-%M-%S")
-        settings = {
-            "run_name": "dbdemos_init_param_queries_"+dt_string,
-            "tasks": tasks
+                def apply_permissions():
+                    permission_hashes[q["id"]] = set_permissions(target_client, "queries", query_task.result(), previous_states[q["id"]], get_target_index())
+                #Permissions aren't needed by any other task: they run in the background lane
+                permission_task = Task(apply_permissions, [query_task], name=f"permissions {q['id']}", background=True)
+                permission_tasks.append(permission_task)
+                tasks.append(permission_task)
+            return query_tasks[q["id"]]
+
+        queries = {q["id"]: q for q in dashboard["queries"]}
+        #First loads the queries used as parameters. They need to be loaded first as the other will depend on these
+        param_queries = [q for q in dashboard["queries"] if "is_parameter_query" not in q or q["is_parameter_query"]]
+        for q in param_queries:
+            if q["id"] not in query_tasks:
+                add_query(q, [])
+
+        def run_warmup():
+            #Param queries which didn't change since the last run already have their results, no need to run them again
+            warmup_tasks = [get_param_query_task(target_client, q, dashboard_state["queries"][q["id"]]["new_id"])
+                            for q in param_queries if query_tasks[q["id"]].result()]
+            if len(warmup_tasks) == 0:
+                return None
+            #The job runs in the background, batched with the other dashboards ones. Doesn't hold a thread while running.
+            return get_param_queries_warmup(target_client).submit(warmup_tasks)
+        warmup = None
+        if len(param_queries) > 0:
+            warmup = Task(run_warmup, [query_tasks[q["id"]] for q in param_queries], planner.warmup_duration / planner.call_duration,
+                          name="warmup")
+            tasks.append(warmup)
+
+        #Then loads everything else, no matter the order. Only the queries using a param query wait for the job.
+        for q in dashboard["queries"]:
+            if "is_parameter_query" in q and not q["is_parameter_query"]:
+                add_query(q, [warmup] if len(get_param_query_ids(q)) > 0 else [])
+
+        previous_dashboard_state = {}
+
+        def load_dashboard():
+            #Doesn't wait for the queries: the widgets are created as soon as their visualization is mapped
+            with instrumentation.phase("dashboard"):
+                previous_dashboard_state.update(new_id=dashboard_state.get("new_id"), permissions_hash=dashboard_state.get("permissions_hash"))
+                return create_or_update_dashboard(target_client, dashboard["dashboard"], dashboard_state, parent, get_target_index(), journal)
+        dashboard_task = Task(load_dashboard, [index_dependency], name="dashboard")
+        if target_client.permisions_defined():
+            def apply_dashboard_permissions():
+                permission_hashes[None] = set_permissions(target_client, "dashboards", dashboard_task.result(), previous_dashboard_state, get_target_index())
+            #Not a child of the dashboard task: the widgets (which wait for the dashboard task) don't wait for the permissions
+            permission_task = Task(apply_dashboard_permissions, [dashboard_task], name="dashboard permissions", background=True)
+            permission_tasks.append(permission_task)
+            tasks.append(permission_task)
+
+        def get_widget_query_task(widget):
+            return query_tasks.get(widget["visualization"]["query"]["id"]) if "visualization" in widget else None
+
+        def load_widget(widget, widgets, new_dashboard):
+            new_widget_id = create_widget(target_client, widget, dashboard_state, new_dashboard["id"])
+            if new_widget_id is not None:
+                widgets[widget["id"]] = new_widget_id
+
+        def load_widgets():
+            new_dashboard = dashboard_task.result()
+            widgets = {}
+            if len(new_dashboard.get("widgets", [])) == 0:
+                #Nothing to reconcile in the target: each widget is created once its query visualizations are loaded
+                scheduler.submit([Task(lambda widget=widget: load_widget(widget, widgets, new_dashboard), [get_widget_query_task(widget)],
+                                       name=f"create widget {widget['id']}") for widget in dashboard["dashboard"]["widgets"]])
+                return widgets
+            #The target widgets are matched with the mapping of all the visualizations
+            return scheduler.submit([Task(lambda: update_widgets(new_dashboard), list(query_tasks.values()),
+                                          1 + len(dashboard["dashboard"]["widgets"]), name="update widgets")])[0]
+
+        def update_widgets(new_dashboard):
+            #Only the widgets changed since the previous run are updated/re-created, as children of this task
+            widgets, to_update, to_create, to_delete = get_widget_changes(dashboard["dashboard"], dashboard_state, new_dashboard)
+            deletes = [Task(lambda widget_id=widget_id: delete_widget(target_client, widget_id), name=f"delete widget {widget_id}")
+                       for widget_id in to_delete]
+            children = list(deletes)
+            children += [Task(lambda widget=widget, target_id=target_id: update_widget(target_client, widget, target_id, dashboard_state, new_dashboard["id"]),
+                              deletes, name=f"update widget {widget['id']}") for widget, target_id in to_update]
+            children += [Task(lambda widget=widget: load_widget(widget, widgets, new_dashboard), deletes, name=f"create widget {widget['id']}")
+                         for widget in to_create]
+            scheduler.submit(children)
+            return widgets
+        widgets_task = Task(load_widgets, [dashboard_task], 1 + len(dashboard["dashboard"]["widgets"]), name="widgets")
+
+        def complete_dashboard():
+            new_dashboard, widgets = dashboard_task.result(), widgets_task.result()
+            dashboard_state["hash"] = content_hash(get_dashboard_payload(dashboard["dashboard"], target_client, parent))
+            dashboard_state["updated_at"] = new_dashboard.get("updated_at")
+            dashboard_state["widgets"] = widgets
+            dashboard_state["widget_hashes"] = {widget_id: h for widget_id, h in get_widget_hashes(dashboard["dashboard"], dashboard_state, new_dashboard["id"]).items()
+                                                if widget_id in widgets}
+            for query_id, permissions_hash in permission_hashes.items():
+                query_state = dashboard_state if query_id is None else dashboard_state["queries"].get(query_id)
+                if query_state is not None and permissions_hash is not None:
+                    query_state["permissions_hash"] = permissions_hash
+            if journal is not None:
+                journal.dashboard(dashboard_state)
+            return dashboard_state
+        state_task = Task(complete_dashboard, [widgets_task] + list(query_tasks.values()) + permission_tasks, 0, name="state")
+        scheduler.submit([dashboard_task] + tasks + [widgets_task, state_task])
+        return state_task
+
+#Canonical hash of the payload sent to the API, saved in the state to skip the objects that didn't change
+def content_hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def get_query_state(q, new_query, visualizations, target_client: Client, parent):
+    return {"new_id": new_query["id"],
+            "visualizations": visualizations,
+            "hash": content_hash(get_query_payload(q, target_client, parent)),
+            "visualization_hashes": get_visualization_hashes(q, new_query["id"]),
+            "updated_at": new_query.get("updated_at")}
+
+
+#State of a query which has just been created, before its visualizations: only its default table is mapped. Without hash,
+#a run resuming from it updates the query and matches its visualizations instead of creating the query again.
+def get_created_query_state(q, new_query):
+    visualizations = {}
+    orig_default_table, target_default_table = get_first_vis(q), get_first_vis(new_query)
+    if orig_default_table is not None and target_default_table is not None:
+        visualizations[orig_default_table["id"]] = target_default_table["id"]
+    return {"new_id": new_query["id"], "visualizations": visualizations}
+
+
+#True if the index shows the target object wasn't modified since it was saved in the state
+def is_up_to_date(target_index, item, state):
+    if target_index is None or state.get("updated_at") is None:
+        return False
+    entry = target_index.get(item, state["new_id"])
+    return entry["exists"] and not entry["trashed"] and entry["updated_at"] == state["updated_at"]
+
+
+#We need to replace the param queries with the newly created one
+def replace_param_query_ids(q, dashboard_state):
+    if "parameters" in q["options"]:
+        for p in q["options"]["parameters"]:
+            if "queryId" in p:
+                p["queryId"] = dashboard_state["queries"][p["queryId"]]["new_id"]
+                if "parentQueryId" in p:
+                    del p["parentQueryId"]
+                #if "value" in p:
+                #    del p["value"]
+                #if "$$value" in p:
+                #    del p["$$value"]
+
+
+def get_param_query_ids(q):
+    return [p["queryId"] for p in q["options"].get("parameters", []) if "queryId" in p]
+
+
+def get_param_query_task_key(new_query_id):
+    return "run_param_query_"+new_query_id
+
+
+#Task running a cloned param query. It depends on the tasks of the param queries it's using (q parameters must
+#already reference the cloned queries), the dependencies not part of the same job run are removed when submitted.
+def get_param_query_task(target_client: Client, q, new_query_id):
+    return {
+        "task_key": get_param_query_task_key(new_query_id),
+        "depends_on": [{"task_key": get_param_query_task_key(query_id)} for query_id in get_param_query_ids(q)],
+        "sql_task": {
+            "query": {
+                "query_id": new_query_id
+            },
+            "warehouse_id": target_client.endpoint_id
         }
-        with requests.post(target_client.url+"/api/2.1/jobs/runs/submit", headers = target_client.headers, json=settings) as r:
-            run = r.json()
-            if 'error_code' in run:
-                print(f"ERROR initializing the param queries job: {run} - params= {settings}. Downstream import will likely fail.")
-        for i in range(100):
-            i =+ 1
-            with requests.get(target_client.url+"/api/2.1/jobs/runs/get", headers = target_client.headers, params=run) as r:
-                if i >= 99 or "result_state" in r.json()["state"]:
-                    if i >= 99:
-                        print(f"ERROR initializing param queries. it looks like your init job is still running: {run} .")
-                    elif r.json()["state"]["result_state"] != "SUCCESS":
-                        print("ERROR initializing param queries. This will likely make next import to run as param query results are needed before using them in a new query.")
-                        print(f"To fix this issue, try to manually run the queries as defined in the job run {run}")
-                    else:
-                        print("Param queries initialization successful. Resume dashboard import...")
-                    break
+    }
+
+
+class ParamQueriesWarmup():
+    """
+    Runs the param query tasks of all the dashboards being cloned in a target in a single job run.
+    The tasks submitted within warmup_batch_delay seconds are batched together. The job runs and is polled
+    in a background thread, submit returns a Future resolved with True once the run succeeded.
+    """
+    def __init__(self, target_client: Client):
+        self.target_client = target_client
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def submit(self, tasks):
+        with self.lock:
+            if self.batch is None:
+                self.batch = ({}, Future())
+                threading.Thread(target=self.run_batch, args=(self.batch,), daemon=True).start()
+            batch_tasks, future = self.batch
+            for task in tasks:
+                #The same param query can be used by multiple dashboards
+                if task["task_key"] in batch_tasks:
+                    depends_on = batch_tasks[task["task_key"]]["depends_on"]
+                    depends_on.extend(d for d in task["depends_on"] if d not in depends_on)
                 else:
-                    print(f"Waiting for parameter queries to run as they're needed to import the next queries ({run})...")
-                    time.sleep(10)
+                    batch_tasks[task["task_key"]] = copy.deepcopy(task)
+            return future
 
+    def run_batch(self, batch):
+        time.sleep(warmup_batch_delay)
+        with self.lock:
+            #Next submissions will start a new batch
+            self.batch = None
+        tasks, future = batch
+        try:
+            with instrumentation.phase("warmup", tasks=len(tasks)):
+                future.set_result(run_param_queries_job(self.target_client, list(tasks.values())))
+        except BaseException as e:
+            future.set_exception(e)
 
 
-    #Then loads everything else, no matter the order
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        collections.deque(executor.map(load_query, [q for q in dashboard["queries"] if "is_parameter_query" in q and not q["is_parameter_query"]]))
+_warmups = {}
+_warmups_lock = threading.Lock()
 
-    duplicate_dashboard(target_client, dashboard["dashboard"], dashboard_state, parent)
-    return dashboard_state
 
-def clone_or_update_query(dashboard_state, q, target_client, parent):
+def get_param_queries_warmup(target_client: Client):
+    key = (target_client.url, target_client.endpoint_id)
+    with _warmups_lock:
+        if key not in _warmups:
+            _warmups[key] = ParamQueriesWarmup(target_client)
+        return _warmups[key]
+
+
+def run_param_queries_job(target_client: Client, tasks):
+    """Submits a job running the param query tasks and waits for it with an increasing polling interval, up to warmup_timeout seconds."""
+    task_keys = set(task["task_key"] for task in tasks)
+    for task in tasks:
+        task["depends_on"] = [d for d in task["depends_on"] if d["task_key"] in task_keys]
+        if len(task["depends_on"]) == 0:
+            del task["depends_on"]
+    print(f"Widget queries need to be run first to be able to load other queries. Submitting a job run with {len(tasks)} param queries.")
+    print("This will take a few minutes without serverless (few sec with serverless)...")
+    print(f"You can check the progress in {target_client.url}#job/runs")
+    from datetime import datetime
+    settings = {
+        "run_name": "dbdemos_init_param_queries_"+datetime.now().strftime("%d-%m-%Y-%H-%M-%S"),
+        "tasks": tasks
+    }
+    with target_client.post("/api/2.1/jobs/runs/submit", json=settings) as r:
+        run = r.json()
+    if 'run_id' not in run:
+        print(f"ERROR initializing the param queries job: {run} - params= {settings}. Downstream import will likely fail.")
+        return False
+    deadline = time.monotonic() + warmup_timeout
+    delay = 2
+    while True:
+        with target_client.get("/api/2.1/jobs/runs/get", params={"run_id": run["run_id"]}) as r:
+            state = r.json().get("state", {})
+        if "result_state" in state:
+            if state["result_state"] != "SUCCESS":
+                print("ERROR initializing param queries. This will likely make next import to run as param query results are needed before using them in a new query.")
+                print(f"To fix this issue, try to manually run the queries as defined in the job run {run}")
+                return False
+            print("Param queries initialization successful. Resume dashboard import...")
+            return True
+        if time.monotonic() + delay > deadline:
+            print(f"ERROR initializing param queries. it looks like your init job is still running: {run} .")
+            return False
+        logger.debug(f"Waiting for parameter queries to run as they're needed to import the next queries ({run})...")
+        time.sleep(delay)
+        delay = min(delay * 1.5, 30)
+
+
+def get_query_payload(q, target_client: Client, parent):
     q_creation = {
         "data_source_id": target_client.data_source_id,
         "query": q["query"],
@@ -158,41 +557,175 @@ def clone_or_update_query(dashboard_state, q, target_client, parent):
     #Folder where the query will be installed
     if parent is not None:
         q_creation['parent'] = parent
+    return q_creation
+
+
+#The target query as saved in the state, when neither the query nor its visualizations changed
+def get_state_query(q, query_state):
+    return {"id": query_state["new_id"],
+            "updated_at": query_state["updated_at"],
+            "visualizations": [dict(v, id=query_state["visualizations"][v["id"]]) for v in q["visualizations"]]}
+
+
+def get_known_query(q, query_state, q_creation, target_index = None):
+    """
+    What is known about the target query of the state without calling the API. Returns (existing_query, fetch):
+    existing_query is None if the query doesn't exist anymore, its content as saved in the state if neither the query
+    nor its visualizations changed, or only its id if it exists but must be updated. fetch is True if the query must
+    be fetched to know if it still exists.
+    """
+    existing_query_id = query_state["new_id"]
+    if target_index is None:
+        return None, True
+    if not target_index.exists("queries", existing_query_id):
+        return None, False
+    unchanged = query_state.get("hash") == content_hash(q_creation)
+    if unchanged and is_up_to_date(target_index, "queries", query_state) and \
+            query_state.get("visualizations", {}).keys() == set(v["id"] for v in q["visualizations"]) and \
+            query_state.get("visualization_hashes") == get_visualization_hashes(q, existing_query_id):
+        return get_state_query(q, query_state), False
+    if not unchanged:
+        #The index already tells the query exists, the update returns its content
+        return {"id": existing_query_id}, False
+    return None, True
+
+
+def clone_or_update_query(dashboard_state, q, target_client, parent, target_index = None):
+    q_creation = get_query_payload(q, target_client, parent)
     new_query = None
     if q['id'] in dashboard_state["queries"]:
-        existing_query_id = dashboard_state["queries"][q['id']]["new_id"]
-        # check if the query still exists (it might have been manually deleted by mistake)
-        with requests.get(target_client.url + "/api/2.0/preview/sql/queries/" + existing_query_id, headers=target_client.headers) as r:
-            existing_query = r.json()
-        if 'id' in existing_query and 'moved_to_trash_at' not in existing_query:
-            logger.debug(f"     updating the existing query {existing_query_id}")
-            with requests.post(target_client.url + "/api/2.0/preview/sql/queries/" + existing_query_id, headers=target_client.headers, json=q_creation) as r:
-                new_query = r.json()
+        query_state = dashboard_state["queries"][q['id']]
+        existing_query_id = query_state["new_id"]
+        existing_query, fetch = get_known_query(q, query_state, q_creation, target_index)
+        if fetch:
+            # check if the query still exists (it might have been manually deleted by mistake)
+            with target_client.get("/api/2.0/preview/sql/queries/" + existing_query_id) as r:
+                existing_query = r.json()
+            if 'id' not in existing_query or 'moved_to_trash_at' in existing_query:
+                existing_query = None
+        if existing_query is not None:
+            if query_state.get("hash") == content_hash(q_creation):
+                logger.debug(f"     query {existing_query_id} unchanged, skipping update")
+                new_query = existing_query
+            else:
+                logger.debug(f"     updating the existing query {existing_query_id}")
+                with target_client.post("/api/2.0/preview/sql/queries/" + existing_query_id, json=q_creation) as r:
+                    new_query = r.json()
             if "visualizations" not in new_query:
                 raise Exception(f"can't update query or query without vis. Shouldn't happen: {new_query} - {q_creation} - {existing_query_id}")
-            # Delete all query visualization to reset its settings
-            for v in new_query["visualizations"]:
-                logger.debug(f"     deleting query visualization {v['id']}")
-                with requests.delete(target_client.url + "/api/2.0/preview/sql/visualizations/" + v["id"], headers=target_client.headers) as r:
-                    r.json()
     if not new_query:
         logger.debug(f"     cloning query {q_creation}...")
-        with requests.post(target_client.url + "/api/2.0/preview/sql/queries", headers=target_client.headers,json=q_creation) as r:
+        with target_client.post("/api/2.0/preview/sql/queries", json=q_creation) as r:
             new_query = r.json()
             logger.debug(f"     new query created: {new_query} {r.text} {r.status_code}...")
     return new_query
 
 
+# Sort both lists to retain visualization order on the query screen
+def get_first_vis(q):
+    orig_table_visualizations = sorted(
+        [i for i in q["visualizations"] if i["type"] == "TABLE"],
+        key=lambda x: x["id"],
+    )
+    if len(orig_table_visualizations) > 0:
+        return orig_table_visualizations[0]
+    return None
+
+
+def get_default_visualization_payload(v):
+    return {
+        "name": v["name"],
+        "description": v["description"],
+        "options": v["options"]
+    }
+
+
+def get_visualization_payload(v, target_query_id):
+    return {
+        "name": v["name"],
+        "description": v["description"],
+        "options": v["options"],
+        "type": v["type"],
+        "query_plan": v["query_plan"],
+        "query_id": target_query_id,
+    }
+
+
+def get_visualization_hashes(query, target_query_id):
+    return {v["id"]: content_hash(get_visualization_payload(v, target_query_id)) for v in query["visualizations"]}
+
+
+def get_visualization_changes(query, target_query, query_state):
+    """
+    Reconciles the source visualizations with the target ones. They are matched using the state mapping first,
+    then by type and name, then by type in id order. The target default table (created with the query) is never matched nor deleted.
+    Returns the mapping of the visualizations kept in the target, and the ones to update, create and delete.
+    """
+    previous_mapping = query_state.get("visualizations", {})
+    previous_targets = set(previous_mapping.values())
+    default_vis = get_first_vis({"visualizations": [v for v in target_query["visualizations"] if v["id"] not in previous_targets]})
+    targets = {v["id"]: v for v in target_query["visualizations"] if default_vis is None or v["id"] != default_vis["id"]}
+    previous_hashes = query_state.get("visualization_hashes", {})
+    sources = sorted(query["visualizations"], key=lambda x: x["id"])
+    mapping = {v["id"]: previous_mapping[v["id"]] for v in sources if previous_mapping.get(v["id"]) in targets}
+    unmatched_targets = sorted([v for v in targets.values() if v["id"] not in set(mapping.values())], key=lambda x: x["id"])
+    for key in [lambda v: (v["type"], v["name"]), lambda v: v["type"]]:
+        for v in sources:
+            if v["id"] not in mapping:
+                match = next((t for t in unmatched_targets if key(t) == key(v)), None)
+                if match is not None:
+                    mapping[v["id"]] = match["id"]
+                    unmatched_targets.remove(match)
+    to_update = []
+    for v in sources:
+        if v["id"] in mapping:
+            data = get_visualization_payload(v, target_query["id"])
+            if v["id"] in previous_hashes and previous_mapping.get(v["id"]) == mapping[v["id"]]:
+                changed = previous_hashes[v["id"]] != content_hash(data)
+            else:
+                #No hash for this visualization in the state, compare with the target content
+                target = targets[mapping[v["id"]]]
+                changed = any(data[k] != target.get(k) for k in ["name", "description", "options", "type"])
+            if changed:
+                to_update.append((v, mapping[v["id"]]))
+    to_create = [v for v in sources if v["id"] not in mapping]
+    to_delete = [t["id"] for t in unmatched_targets]
+    return mapping, to_update, to_create, to_delete
+
+
+#Update an existing query visualizations: only the changed ones are updated and the removed ones deleted.
+#Returns the mapping of the existing visualizations and the ones to create.
+def update_query_visualization(client: Client, query, target_query, query_state):
+    mapping, to_update, to_create, to_delete = get_visualization_changes(query, target_query, query_state)
+    #The removed visualizations are deleted in the background while the others are updated
+    cleanup = Cleanup(client, "visualizations cleanup")
+    for target_id in to_delete:
+        cleanup.delete("visualizations", target_id)
+    for v, target_id in to_update:
+        logger.debug(f"         updating Viz {v['id']} - {target_id}...")
+        data = get_visualization_payload(v, target_query["id"])
+        del data["query_id"]
+        with client.post("/api/2.0/preview/sql/visualizations/"+target_id, json=data) as r:
+            updated_v = r.json()
+        #Raised before the state is saved: the visualization hash isn't recorded and the update is retried by the next run
+        if r.status_code >= 400 or updated_v.get("id") != target_id:
+            raise Exception(f"couldn't update visualization {target_id}: {r.status_code} {updated_v}")
+    cleanup.wait()
+    return mapping, sorted(to_create, key=lambda x: x["id"])
+
+
+def create_visualization(client: Client, v, target_query_id):
+    logger.debug(f"         cloning Viz {v['id']}...")
+    data = get_visualization_payload(v, target_query_id)
+    with client.post("/api/2.0/preview/sql/visualizations", json=data) as r:
+        new_v = r.json()
+    if "id" not in new_v:
+        raise Exception(f"couldn't create visualization - shouldn't happen {new_v} - {data}")
+    return new_v["id"]
+
+
+#Returns the mapping of the default visualization and the visualizations to create.
 def clone_query_visualization(client: Client, query, target_query):
-    # Sort both lists to retain visualization order on the query screen
-    def get_first_vis(q):
-        orig_table_visualizations = sorted(
-            [i for i in q["visualizations"] if i["type"] == "TABLE"],
-            key=lambda x: x["id"],
-        )
-        if len(orig_table_visualizations) > 0:
-            return orig_table_visualizations[0]
-        return None
     #Update the default(first) visualization to match the existing one:
     # Sort this table like orig_table_visualizations.
     # The first elements in these lists should mirror one another.
@@ -200,90 +733,239 @@ def clone_query_visualization(client: Client, query, target_query):
     mapping = {}
     if orig_default_table:
         target_default_table = get_first_vis(target_query)
-        default_table_viz_data = {
-            "name": orig_default_table["name"],
-            "description": orig_default_table["description"],
-            "options": orig_default_table["options"]
-        }
+        #The target query can be created without default table: it's then created with the other visualizations
         if target_default_table is not None:
             mapping[orig_default_table["id"]] = target_default_table["id"]
-        logger.debug(f"         updating default Viz {target_default_table['id']}...")
-        with requests.post(client.url+"/api/2.0/preview/sql/visualizations/"+target_default_table["id"], headers = client.headers, json=default_table_viz_data) as r:
-            r.json()
-    #Then create the other visualizations
-    for v in sorted(query["visualizations"], key=lambda x: x["id"]):
-        logger.debug(f"         cloning Viz {v['id']}...")
-        data = {
-            "name": v["name"],
-            "description": v["description"],
-            "options": v["options"],
-            "type": v["type"],
-            "query_plan": v["query_plan"],
-            "query_id": target_query["id"],
-        }
-        with requests.post(client.url+"/api/2.0/preview/sql/visualizations", headers = client.headers, json=data) as r:
-            new_v = r.json()
-        if "id" not in new_v:
-            raise Exception(f"couldn't create visualization - shouldn't happen {new_v} - {data}")
-        mapping[v["id"]] = new_v["id"]
-    return mapping
+            default_table_viz_data = get_default_visualization_payload(orig_default_table)
+            logger.debug(f"         updating default Viz {target_default_table['id']}...")
+            with client.post("/api/2.0/preview/sql/visualizations/"+target_default_table["id"], json=default_table_viz_data) as r:
+                r.json()
+    #Then returns the other visualizations to create, sorted by id
+    return mapping, sorted(query["visualizations"], key=lambda x: x["id"])
 
 
-def duplicate_dashboard(client: Client, dashboard, dashboard_state, parent):
+def get_dashboard_payload(dashboard, client: Client, parent):
     data = {"name": dashboard["name"],
             "tags": dashboard["tags"],
             "data_source_id": client.data_source_id}
     #Folder where the dashboard will be installed
     if parent is not None:
         data['parent'] = parent
+    return data
+
+
+def get_widget_payload(widget, dashboard_state, new_dashboard_id):
+    visualization_id_clone = None
+    if "visualization" in widget:
+        query_id = widget["visualization"]["query"]["id"]
+        visualization_id = widget["visualization"]["id"]
+        visualization_id_clone = dashboard_state["queries"][query_id]["visualizations"][visualization_id]
+    return {
+        "dashboard_id": new_dashboard_id,
+        "visualization_id": visualization_id_clone,
+        "text": widget["text"],
+        "options": widget["options"],
+        "width": widget["width"]
+    }
+
+
+def get_widget_changes(dashboard, dashboard_state, target_dashboard):
+    """
+    Reconciles the source widgets with the target ones. They are matched using the state mapping first, then
+    by visualization (or text for text widgets), preferring the widget at the same position.
+    Widgets can only be updated in place when their visualization and width didn't change, the others are re-created.
+    Returns the mapping of the widgets kept in the target, and the widgets to update, create and delete.
+    """
+    targets = {w["id"]: w for w in target_dashboard.get("widgets", [])}
+    previous_mapping = dashboard_state.get("widgets", {})
+    previous_hashes = dashboard_state.get("widget_hashes", {})
+    payloads = {w["id"]: get_widget_payload(w, dashboard_state, target_dashboard["id"]) for w in dashboard["widgets"]}
+
+    def get_target_visualization_id(target):
+        return target.get("visualization", {}).get("id", target.get("visualization_id"))
+
+    def can_update(data, target):
+        return get_target_visualization_id(target) == data["visualization_id"] and target.get("width") == data["width"]
+
+    mapping = {}
+    for widget in dashboard["widgets"]:
+        target_id = previous_mapping.get(widget["id"])
+        if target_id in targets and (previous_hashes.get(widget["id"]) == content_hash(payloads[widget["id"]]) or
+                                     can_update(payloads[widget["id"]], targets[target_id])):
+            mapping[widget["id"]] = target_id
+    unmatched_targets = [w for w in targets.values() if w["id"] not in set(mapping.values())]
+    for widget in dashboard["widgets"]:
+        if widget["id"] not in mapping:
+            data = payloads[widget["id"]]
+            candidates = [t for t in unmatched_targets if can_update(data, t) and
+                          (data["visualization_id"] is not None or t.get("text") == data["text"])]
+            match = next((t for t in candidates if t.get("options", {}).get("position") == data["options"].get("position")),
+                         next(iter(candidates), None))
+            if match is not None:
+                mapping[widget["id"]] = match["id"]
+                unmatched_targets.remove(match)
+    to_update = []
+    for widget in dashboard["widgets"]:
+        if widget["id"] in mapping:
+            data = payloads[widget["id"]]
+            target = targets[mapping[widget["id"]]]
+            if widget["id"] in previous_hashes and previous_mapping.get(widget["id"]) == mapping[widget["id"]]:
+                changed = previous_hashes[widget["id"]] != content_hash(data)
+            else:
+                changed = target.get("text") != data["text"] or target.get("options") != data["options"]
+            if changed:
+                to_update.append((widget, mapping[widget["id"]]))
+    to_create = [w for w in dashboard["widgets"] if w["id"] not in mapping]
+    to_delete = [w["id"] for w in unmatched_targets]
+    return mapping, to_update, to_create, to_delete
+
+
+def get_widget_hashes(dashboard, dashboard_state, new_dashboard_id):
+    return {w["id"]: content_hash(get_widget_payload(w, dashboard_state, new_dashboard_id)) for w in dashboard["widgets"]}
+
+
+def is_widgets_unchanged(dashboard, dashboard_state):
+    try:
+        return dashboard_state.get("widget_hashes") == get_widget_hashes(dashboard, dashboard_state, dashboard_state["new_id"])
+    except KeyError:
+        #A widget uses a query which isn't loaded yet: the dashboard is created before its queries are loaded
+        return False
+
+
+#The target dashboard as saved in the state, when neither the dashboard nor its widgets changed
+def get_state_dashboard(dashboard_state):
+    return {"id": dashboard_state["new_id"],
+            "updated_at": dashboard_state["updated_at"],
+            "options": {},
+            "widgets": [{"id": widget_id} for widget_id in dashboard_state["widgets"].values()]}
+
+
+def get_known_dashboard(dashboard, dashboard_state, data, target_index = None):
+    """Same as get_known_query for the dashboard of the state and its widgets."""
+    if target_index is None:
+        return None, True
+    if not target_index.exists("dashboards", dashboard_state["new_id"]):
+        return None, False
+    unchanged = dashboard_state.get("hash") == content_hash(data)
+    if unchanged and is_up_to_date(target_index, "dashboards", dashboard_state) and \
+            dashboard_state.get("widgets", {}).keys() == set(w["id"] for w in dashboard["widgets"]) and \
+            is_widgets_unchanged(dashboard, dashboard_state):
+        return get_state_dashboard(dashboard_state), False
+    if not unchanged:
+        #The index already tells the dashboard exists, the update returns its content
+        return {"id": dashboard_state["new_id"], "options": {}}, False
+    return None, True
+
+
+def create_or_update_dashboard(client: Client, dashboard, dashboard_state, parent, target_index = None, journal = None):
+    """Creates the target dashboard, or updates the one of the state. Returns the target dashboard."""
+    data = get_dashboard_payload(dashboard, client, parent)
 
     new_dashboard = None
     if "new_id" in dashboard_state:
-        with requests.get(client.url+"/api/2.0/preview/sql/dashboards/"+dashboard_state["new_id"], headers = client.headers) as r:
-            existing_dashboard = r.json()
-        if "options" in existing_dashboard and "moved_to_trash_at" not in existing_dashboard["options"]:
-            logger.debug("  dashboard exists, updating it")
-            with requests.post(client.url+"/api/2.0/preview/sql/dashboards/"+dashboard_state["new_id"], headers = client.headers, json=data) as r:
-                new_dashboard = r.json()
+        existing_dashboard, fetch = get_known_dashboard(dashboard, dashboard_state, data, target_index)
+        if fetch:
+            with client.get("/api/2.0/preview/sql/dashboards/"+dashboard_state["new_id"]) as r:
+                existing_dashboard = r.json()
+            if "options" not in existing_dashboard or "moved_to_trash_at" in existing_dashboard["options"]:
+                existing_dashboard = None
+        if existing_dashboard is not None:
+            if dashboard_state.get("hash") == content_hash(data):
+                logger.debug("  dashboard exists and didn't change")
+                new_dashboard = existing_dashboard
+            else:
+                logger.debug("  dashboard exists, updating it")
+                with client.post("/api/2.0/preview/sql/dashboards/"+dashboard_state["new_id"], json=data) as r:
+                    new_dashboard = r.json()
+                if r.status_code >= 400 or new_dashboard.get("id") != dashboard_state["new_id"]:
+                    raise Exception(f"couldn't update dashboard {dashboard_state['new_id']}: {r.status_code} {new_dashboard}")
             if "widgets" not in new_dashboard:
                 logger.debug(f"ERROR: dashboard doesn't have widget, shouldn't happen - {new_dashboard}")
-            else:
-                #Drop all the widgets and re-create them
-                for widget in new_dashboard["widgets"]:
-                    logger.debug(f"    deleting widget {widget['id']} from existing dashboard {new_dashboard['id']}")
-                    with requests.delete(client.url+"/api/2.0/preview/sql/widgets/"+widget['id'], headers = client.headers) as r:
-                        r.json()
         else:
             logger.debug("    couldn't find the dashboard defined in the state, it probably has been deleted.")
     if new_dashboard is None:
         logger.debug(f"  creating new dashboard...")
-        with requests.post(client.url+"/api/2.0/preview/sql/dashboards", headers = client.headers, json=data) as r:
+        with client.post("/api/2.0/preview/sql/dashboards", json=data) as r:
             new_dashboard = r.json()
+        if "id" not in new_dashboard:
+            raise Exception(f"couldn't create dashboard: {r.status_code} {new_dashboard} - {data}")
         dashboard_state["new_id"] = new_dashboard["id"]
-    if client.permisions_defined():
-        with requests.post(client.url+"/api/2.0/preview/sql/permissions/dashboards/"+new_dashboard["id"], headers = client.headers, json=client.permissions) as r:
+        if journal is not None:
+            journal.new_dashboard(new_dashboard["id"])
+    return new_dashboard
+
+
+def get_permissions_hash(client: Client):
+    return content_hash(client.permissions)
+
+
+#True if the ACL already contains all the client permissions (other entries, like the owner, are ignored)
+def is_acl_applied(acl, client: Client):
+    current = acl.get("access_control_list", [])
+    return all(any(all(a.get(k) == v for k, v in p.items()) for a in current) for p in client.permissions["access_control_list"])
+
+
+#True if the permissions must be sent to the target: the state doesn't show they've already been applied to this object
+def is_permissions_change(client: Client, target_id, state):
+    return state.get("new_id") != target_id or state.get("permissions_hash") != get_permissions_hash(client)
+
+
+def set_permissions(client: Client, item, target, state, target_index = None):
+    """
+    Applies the client permissions to the target query or dashboard (item is queries or dashboards), unless the state
+    shows they've already been applied to this object. When the state has no permissions hash, the current ACL is
+    checked first (the one fetched with the target_index if any). Returns the permissions hash to save in the state,
+    None if the target doesn't exist or the ACL was rejected (nothing is saved: the next run sends it again).
+    """
+    if "id" not in target:
+        return None
+    if not is_permissions_change(client, target["id"], state):
+        logger.debug(f"     {item} {target['id']} permissions unchanged, skipping update")
+        return get_permissions_hash(client)
+    with instrumentation.phase("permissions"):
+        if state.get("new_id") == target["id"] and state.get("permissions_hash") is None:
+            acl = target_index.get_acl(item, target["id"]) if target_index is not None else None
+            if acl is None:
+                with client.get(f"/api/2.0/preview/sql/permissions/{item}/"+target["id"]) as r:
+                    acl = r.json()
+            if is_acl_applied(acl, client):
+                logger.debug(f"     {item} {target['id']} permissions already set")
+                return get_permissions_hash(client)
+        with client.post(f"/api/2.0/preview/sql/permissions/{item}/"+target["id"], json=client.permissions) as r:
             permissions = r.json()
-        logger.debug(f"     Dashboard permissions set to {permissions}")
-
-    def load_widget(widget):
-        logger.debug(f"          cloning widget {widget}...")
-        visualization_id_clone = None
-        if "visualization" in widget:
-            query_id = widget["visualization"]["query"]["id"]
-            visualization_id = widget["visualization"]["id"]
-            visualization_id_clone = dashboard_state["queries"][query_id]["visualizations"][visualization_id]
-        data = {
-            "dashboard_id": new_dashboard["id"],
-            "visualization_id": visualization_id_clone,
-            "text": widget["text"],
-            "options": widget["options"],
-            "width": widget["width"]
-        }
-        with requests.post(client.url+"/api/2.0/preview/sql/widgets", headers = client.headers, json=data) as r:
+        if r.status_code >= 400:
+            logger.warning(f"couldn't set the permissions of {item} {target['id']}: {r.status_code} {permissions}")
+            return None
+    logger.debug(f"     {item} permissions set to {permissions}")
+    return get_permissions_hash(client)
+
+
+def delete_widget(client: Client, widget_id):
+    logger.debug(f"    deleting widget {widget_id}")
+    with instrumentation.phase("widgets"):
+        with client.delete("/api/2.0/preview/sql/widgets/"+widget_id) as r:
             r.json()
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        collections.deque(executor.map(load_widget, dashboard["widgets"]))
 
+def update_widget(client: Client, widget, target_id, dashboard_state, new_dashboard_id):
+    logger.debug(f"          updating widget {target_id}...")
+    data = get_widget_payload(widget, dashboard_state, new_dashboard_id)
+    with instrumentation.phase("widgets"):
+        with client.post("/api/2.0/preview/sql/widgets/"+target_id, json={"text": data["text"], "options": data["options"], "width": data["width"]}) as r:
+            updated_widget = r.json()
+    #The widget hashes are saved with the dashboard state: a failed update fails the dashboard, it's retried by the next run
+    if r.status_code >= 400 or updated_widget.get("id") != target_id:
+        raise Exception(f"couldn't update widget {target_id}: {r.status_code} {updated_widget}")
 
-    return new_dashboard
\ No newline at end of file
+
+def create_widget(client: Client, widget, dashboard_state, new_dashboard_id):
+    """Returns the id of the new widget, None if it couldn't be created."""
+    logger.debug(f"          cloning widget {widget}...")
+    data = get_widget_payload(widget, dashboard_state, new_dashboard_id)
+    with instrumentation.phase("widgets"):
+        with client.post("/api/2.0/preview/sql/widgets", json=data) as r:
+            new_widget = r.json()
+    if "id" not in new_widget:
+        print(f"Warning - widget wasn't properly created: {new_widget} - {data}")
+        return None
+    return new_widget["id"]
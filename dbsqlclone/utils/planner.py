@@ -0,0 +1,295 @@
+import copy
+import json
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from dbsqlclone.utils.client import Client
+from dbsqlclone.utils import clone_dashboard
+from dbsqlclone.utils import dump_dashboard
+from dbsqlclone.utils import rate_limiter
+from dbsqlclone.utils.dump_dashboard import QueryCache, get_dashboard_definition_by_id
+from dbsqlclone.utils.load_dashboard import replace_param_query_ids, get_param_query_ids, get_query_payload, content_hash, \
+    get_known_query, get_known_dashboard, get_first_vis, get_visualization_changes, get_visualization_hashes, \
+    get_dashboard_payload, get_widget_changes, get_widget_hashes, get_permissions_hash, is_acl_applied, is_permissions_change
+
+logger = logging.getLogger('dbsqlclone.plan')
+
+#Estimations used to compute the plan duration
+call_duration = 0.5
+warmup_duration = 60
+#Id given in the plan to the objects which will be created
+planned_id_prefix = "planned-"
+
+
+def get_operation_id(dashboard_id, type, source_id):
+    return f"{dashboard_id}/{type}/{source_id}"
+
+
+def plan_dashboard(dashboard, target_client: Client, dashboard_state: dict = None, target_index = None, parent: str = None):
+    """
+    Computes the operations clone_dashboard would run, without any write. The objects which can't be decided from
+    the state and the target index are fetched, like the loader does.
+    Returns the operations, the number of objects fetched and the dashboard state expected after the clone.
+    An operation is {"id", "dashboard", "type", "action", "source_id", "target_id", "depends_on", "calls"},
+    action being create, update, delete, set (permissions), run (param queries job) or skip.
+    """
+    dashboard = copy.deepcopy(dashboard)
+    state = copy.deepcopy(dashboard_state) if dashboard_state is not None else {}
+    state.setdefault("queries", {})
+    dashboard_id = dashboard["id"]
+    operations = []
+    reads = 0
+
+    def add(type, source_id, action, target_id = None, depends_on = [], calls = 1):
+        operation = {"id": get_operation_id(dashboard_id, type, source_id), "dashboard": dashboard_id, "type": type,
+                     "action": action, "source_id": source_id, "target_id": target_id, "depends_on": depends_on,
+                     "calls": 0 if action == "skip" else calls}
+        operations.append(operation)
+        return operation["id"]
+
+    def get_target(path):
+        nonlocal reads
+        reads += 1
+        with target_client.get(path) as r:
+            return r.json()
+
+    def plan_permissions(type, item, source_id, target_id, item_state, depends_on):
+        #Same decision as set_permissions: the ACL is fetched when the state doesn't have its hash
+        action = "set"
+        if not target_id.startswith(planned_id_prefix):
+            if not is_permissions_change(target_client, target_id, item_state):
+                action = "skip"
+            elif item_state.get("new_id") == target_id and item_state.get("permissions_hash") is None:
+                if is_acl_applied(get_target(f"/api/2.0/preview/sql/permissions/{item}/" + target_id), target_client):
+                    action = "skip"
+        add(type, source_id, action, target_id, depends_on)
+        return get_permissions_hash(target_client)
+
+    warmup_id = get_operation_id(dashboard_id, "warmup", dashboard_id)
+    warmup_tasks = []
+
+    def plan_query(q):
+        param_query_ids = get_param_query_ids(q)
+        replace_param_query_ids(q, state)
+        q_creation = get_query_payload(q, target_client, parent)
+        query_state = state["queries"].get(q["id"], {})
+        existing_query = None
+        if "new_id" in query_state:
+            existing_query, fetch = get_known_query(q, query_state, q_creation, target_index)
+            if fetch or (existing_query is not None and "visualizations" not in existing_query):
+                existing_query = get_target("/api/2.0/preview/sql/queries/" + query_state["new_id"])
+                if 'id' not in existing_query or 'moved_to_trash_at' in existing_query:
+                    existing_query = None
+        depends_on = [get_operation_id(dashboard_id, "query", query_id) for query_id in param_query_ids]
+        if not q.get("is_parameter_query", True) and len(param_query_ids) > 0 and len(warmup_tasks) > 0:
+            depends_on.append(warmup_id)
+        if existing_query is None:
+            new_id = planned_id_prefix + q["id"]
+            query_id = add("query", q["id"], "create", None, depends_on)
+            default_vis = get_first_vis(q)
+            if default_vis is not None:
+                add("visualization", default_vis["id"] + "/default", "update", None, [query_id])
+            mapping = {}
+            for v in q["visualizations"]:
+                mapping[v["id"]] = planned_id_prefix + v["id"]
+                add("visualization", v["id"], "create", None, [query_id])
+        else:
+            new_id = existing_query["id"]
+            changed = query_state.get("hash") != content_hash(q_creation)
+            query_id = add("query", q["id"], "update" if changed else "skip", new_id, depends_on)
+            mapping, to_update, to_create, to_delete = get_visualization_changes(q, existing_query, query_state)
+            updated = set(v["id"] for v, _ in to_update)
+            for v in q["visualizations"]:
+                if v["id"] in mapping:
+                    add("visualization", v["id"], "update" if v["id"] in updated else "skip", mapping[v["id"]], [query_id])
+                else:
+                    mapping[v["id"]] = planned_id_prefix + v["id"]
+                    add("visualization", v["id"], "create", None, [query_id])
+            for target_id in to_delete:
+                add("visualization", "target-" + target_id, "delete", target_id, [query_id])
+        permissions_hash = query_state.get("permissions_hash") if new_id == query_state.get("new_id") else None
+        if target_client.permisions_defined():
+            permissions_hash = plan_permissions("query_permissions", "queries", q["id"], new_id, query_state, [query_id])
+        state["queries"][q["id"]] = {"new_id": new_id, "visualizations": mapping, "hash": content_hash(q_creation),
+                                     "visualization_hashes": get_visualization_hashes(q, new_id)}
+        if permissions_hash is not None:
+            state["queries"][q["id"]]["permissions_hash"] = permissions_hash
+        return query_id, new_id != query_state.get("new_id") or state["queries"][q["id"]]["hash"] != query_state.get("hash")
+
+    #Same order as the loader: the param queries first, then the other queries
+    for q in dashboard["queries"]:
+        if "is_parameter_query" not in q or q["is_parameter_query"]:
+            query_id, changed = plan_query(q)
+            if changed:
+                warmup_tasks.append(query_id)
+    if len(warmup_tasks) > 0:
+        #Submitted then polled until the end of the run (its duration is estimated with warmup_duration)
+        add("warmup", dashboard_id, "run", None, warmup_tasks)
+    for q in dashboard["queries"]:
+        if "is_parameter_query" in q and not q["is_parameter_query"]:
+            plan_query(q)
+
+    data = get_dashboard_payload(dashboard["dashboard"], target_client, parent)
+    previous_state = {"new_id": state.get("new_id"), "permissions_hash": state.get("permissions_hash")}
+    existing_dashboard = None
+    if "new_id" in state:
+        existing_dashboard, fetch = get_known_dashboard(dashboard["dashboard"], state, data, target_index)
+        if fetch or (existing_dashboard is not None and "widgets" not in existing_dashboard):
+            existing_dashboard = get_target("/api/2.0/preview/sql/dashboards/" + state["new_id"])
+            if "options" not in existing_dashboard or "moved_to_trash_at" in existing_dashboard["options"]:
+                existing_dashboard = None
+    if existing_dashboard is None:
+        state["new_id"] = planned_id_prefix + dashboard_id
+        dashboard_operation_id = add("dashboard", dashboard_id, "create")
+        existing_dashboard = {"id": state["new_id"], "widgets": []}
+    else:
+        changed = state.get("hash") != content_hash(data)
+        dashboard_operation_id = add("dashboard", dashboard_id, "update" if changed else "skip", state["new_id"])
+    if target_client.permisions_defined():
+        state["permissions_hash"] = plan_permissions("dashboard_permissions", "dashboards", dashboard_id, state["new_id"],
+                                                     previous_state, [dashboard_operation_id])
+
+    widgets, to_update, to_create, to_delete = get_widget_changes(dashboard["dashboard"], state, existing_dashboard)
+    updated = set(w["id"] for w, _ in to_update)
+    for widget in dashboard["dashboard"]["widgets"]:
+        depends_on = [dashboard_operation_id]
+        if "visualization" in widget:
+            depends_on.append(get_operation_id(dashboard_id, "visualization", widget["visualization"]["id"]))
+        if widget["id"] in widgets:
+            add("widget", widget["id"], "update" if widget["id"] in updated else "skip", widgets[widget["id"]], depends_on)
+        else:
+            widgets[widget["id"]] = planned_id_prefix + widget["id"]
+            add("widget", widget["id"], "create", None, depends_on)
+    for target_id in to_delete:
+        add("widget", "target-" + target_id, "delete", target_id, [dashboard_operation_id])
+    state["hash"] = content_hash(data)
+    state["widgets"] = widgets
+    state["widget_hashes"] = get_widget_hashes(dashboard["dashboard"], state, state["new_id"])
+    return operations, reads, state
+
+
+def get_critical_path(operations):
+    """Returns the estimated duration (in sec) of the longest dependency chain and the ids of its operations."""
+    by_id = {operation["id"]: operation for operation in operations}
+    paths = {}
+
+    def get_path(operation_id):
+        if operation_id not in paths:
+            operation = by_id[operation_id]
+            duration = warmup_duration if operation["type"] == "warmup" else operation["calls"] * call_duration
+            longest = max([get_path(d) for d in operation["depends_on"] if d in by_id], default=(0, []), key=lambda p: p[0])
+            paths[operation_id] = (longest[0] + duration, longest[1] + [operation_id])
+        return paths[operation_id]
+    #Operations are added after their dependencies: resolving them in order keeps the recursion shallow
+    for operation in operations:
+        get_path(operation["id"])
+    return max(paths.values(), default=(0, []), key=lambda p: p[0])
+
+
+def get_summary(operations, reads, rate = None):
+    if rate is None:
+        rate = rate_limiter.default_rate
+    actions = {}
+    for operation in operations:
+        actions.setdefault(operation["type"], {}).setdefault(operation["action"], 0)
+        actions[operation["type"]][operation["action"]] += 1
+    writes = sum(operation["calls"] for operation in operations)
+    critical_path_seconds, critical_path = get_critical_path(operations)
+    calls = {operation["id"]: operation["calls"] for operation in operations}
+    return {"actions": actions, "writes": writes, "reads": reads,
+            "critical_path_length": len([operation_id for operation_id in critical_path if calls[operation_id] > 0]),
+            "critical_path_seconds": critical_path_seconds,
+            #Bounded by the longest chain, or by the workspace rate limit
+            "estimated_seconds": max(critical_path_seconds, (writes + reads) / rate)}
+
+
+def plan_target(target_client: Client, definitions, workspace_state, tags = [], delete_target_dashboards = False, parent: str = None):
+    """Plans the clone of the source definitions to the target, and the cleanup of the target if delete_target_dashboards."""
+    target_index = clone_dashboard.TargetIndex(target_client)
+    operations = []
+    reads = 0
+    dashboards = {}
+    expected_state = {}
+    for definition in definitions:
+        dashboard_state = workspace_state.get(definition["id"], {})
+        dashboard_operations, dashboard_reads, expected_state[definition["id"]] = \
+            plan_dashboard(definition, target_client, dashboard_state, target_index, parent)
+        changes = len([o for o in dashboard_operations if o["action"] in ["create", "update", "delete", "run", "set"]])
+        if changes == 0:
+            #Dashboards without change are skipped when the plan is executed
+            for operation in dashboard_operations:
+                operation["action"] = "skip"
+                operation["calls"] = 0
+        operations.extend(dashboard_operations)
+        reads += dashboard_reads
+        dashboards[definition["id"]] = {
+            "source_hash": content_hash(definition),
+            "state_hash": content_hash(dashboard_state),
+            "changes": changes,
+            "critical_path_seconds": get_critical_path(dashboard_operations)[0]
+        }
+    if delete_target_dashboards:
+        #The cleanup starts once all the dashboards are loaded
+        loaded = {"id": "loaded", "dashboard": None, "type": "barrier", "action": "skip", "source_id": None, "target_id": None,
+                  "depends_on": [o["id"] for o in operations], "calls": 0}
+        operations.append(loaded)
+        new_queries, new_dashboards = clone_dashboard.get_state_resource_ids(expected_state)
+        for item, type, kept in [("queries", "query", new_queries), ("dashboards", "dashboard", new_dashboards)]:
+            for i in clone_dashboard.get_all_item(target_client, item, tags):
+                if i["id"] not in kept:
+                    operations.append({"id": f"cleanup/{item}/{i['id']}", "dashboard": None, "type": type, "action": "delete",
+                                       "source_id": None, "target_id": i["id"], "depends_on": ["loaded"], "calls": 1})
+    return {"operations": operations, "dashboards": dashboards, "summary": get_summary(operations, reads)}
+
+
+def plan_dashboards_with_tags(source_client: Client, target_clients, tags, delete_target_dashboards: bool, state, parent: str = None):
+    """
+    Dry run of delete_and_clone_dashboards_with_tags_to_targets: computes the operations it would run on each target
+    without any write. The target data_source_id must be set.
+    """
+    if state is None:
+        state = {}
+    dashboards = clone_dashboard.get_all_dashboards(source_client, tags)
+    query_cache = QueryCache()
+    with ThreadPoolExecutor(max_workers=dump_dashboard.max_workers) as executor:
+        definitions = list(executor.map(lambda d: get_dashboard_definition_by_id(source_client, d["id"], query_cache), dashboards))
+    plan = {"source": source_client.url, "tags": tags, "delete_target_dashboards": delete_target_dashboards, "targets": {}}
+    for target_client in target_clients:
+        workspace_state = state.get(clone_dashboard.get_workspace_state_id(source_client, target_client), {})
+        plan["targets"][target_client.url] = plan_target(target_client, definitions, workspace_state, tags, delete_target_dashboards, parent)
+    return plan
+
+
+def save_plan(plan, plan_file):
+    with open(plan_file, "w") as file:
+        json.dump(plan, file, indent=2)
+
+
+def load_plan(plan_file):
+    with open(plan_file, "r") as file:
+        return json.load(file)
+
+
+def print_plan(plan):
+    for target_url, target_plan in plan["targets"].items():
+        summary = target_plan["summary"]
+        print(f"{target_url}: {summary['writes']} writes, {summary['reads']} reads, critical path of {summary['critical_path_length']} "
+              f"operations, estimated duration {round(summary['estimated_seconds'])}s")
+        for type, actions in summary["actions"].items():
+            print(f"    {type}: " + ", ".join(f"{count} {action}" for action, count in sorted(actions.items())))
+
+
+def get_plan_order(plan, dashboard_ids):
+    """Dashboards with the longest critical path first, so that they don't end up last in the pools."""
+    def get_critical_path_seconds(dashboard_id):
+        return max([target_plan["dashboards"].get(dashboard_id, {}).get("critical_path_seconds", float("inf"))
+                    for target_plan in plan["targets"].values()], default=0)
+    return sorted(dashboard_ids, key=get_critical_path_seconds, reverse=True)
+
+
+def needs_load(plan, target_client: Client, dashboard, dashboard_state):
+    """False if the plan has no change for this dashboard, and neither the source nor the state changed since the plan."""
+    entry = plan["targets"].get(target_client.url, {}).get("dashboards", {}).get(dashboard["id"])
+    if entry is None or entry["changes"] > 0:
+        return True
+    return entry["source_hash"] != content_hash(dashboard) or entry["state_hash"] != content_hash(dashboard_state)
@@ -0,0 +1,116 @@
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger('dbsqlclone.rate_limiter')
+
+#Default limits applied to each workspace. Updated dynamically as 429 are received.
+default_rate = 20
+default_burst = 20
+default_max_concurrency = 32
+#Hard ceiling of the rate: without 429, the rate is increased above default_rate up to default_max_rate
+default_max_rate = 100
+#Max seconds to wait before a retry, including the Retry-After sent by the workspace
+max_backoff = 60
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(url):
+    """Returns the limiter of the workspace, shared by every client and thread pool calling this workspace."""
+    url = url.rstrip("/")
+    with _limiters_lock:
+        if url not in _limiters:
+            _limiters[url] = RateLimiter(default_rate, default_burst, default_max_concurrency, default_max_rate)
+        return _limiters[url]
+
+
+def backoff_delay(attempt, base=0.5, cap=None):
+    #Exponential backoff with full jitter
+    return random.uniform(0, min(max_backoff if cap is None else cap, base * (2 ** attempt)))
+
+
+def parse_retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class RateLimiter():
+    """
+    Token bucket (requests/sec) combined with an adaptive concurrency limit.
+    Every 429 halves the rate and the number of requests in flight, every successful window increases them again
+    (AIMD): the rate up to max_rate (probing above the initial rate), the concurrency up to max_concurrency.
+    A Retry-After pauses all the callers of the workspace.
+    """
+    def __init__(self, rate = default_rate, burst = default_burst, max_concurrency = default_max_concurrency, max_rate = default_max_rate):
+        self.max_rate = max(rate, max_rate)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.paused_until = 0
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0
+        self.successes = 0
+        self.throttled = 0
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= self.concurrency:
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                self.condition.wait(wait)
+
+    def release(self, throttled = False):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                #Only decrease once per second, all the requests in flight are likely to be throttled at the same time
+                if now - self.last_decrease > 1:
+                    self.last_decrease = now
+                    self.concurrency = max(1, self.concurrency // 2)
+                    self.rate = max(1, self.rate / 2)
+                    self.successes = 0
+                    logger.debug(f"throttled, reducing to {self.concurrency} concurrent requests at {self.rate:.1f} req/s")
+            else:
+                self.successes += 1
+                if self.successes >= self.concurrency:
+                    self.successes = 0
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    self.rate = min(self.max_rate, self.rate + 1)
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
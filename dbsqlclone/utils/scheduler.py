@@ -0,0 +1,197 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future, CancelledError
+import logging
+
+from . import instrumentation
+
+logger = logging.getLogger('dbsqlclone.scheduler')
+
+#Number of threads running the tasks of a target, shared by all the dashboards cloned to this target
+max_workers = 9
+#Max number of threads running background tasks (ex: permissions) at the same time, while other tasks are running
+max_background_workers = 2
+
+
+class Task(Future):
+    """
+    Unit of work of the Scheduler, and the Future of its result. fn runs once all the depends_on tasks (or any Future)
+    succeeded, the task fails without running if one of them fails. cost is the estimated number of calls of the task.
+    If fn returns a Future, the task completes with it without holding a thread (ex: the param queries job).
+    Tasks submitted while fn is running are its children: the task completes once they're all complete.
+    Background tasks only run when no other task is ready, on at most max_background_workers threads while
+    other tasks are running.
+    """
+    def __init__(self, fn, depends_on = [], cost = 1, name = None, background = False):
+        super().__init__()
+        #Runs with the phase and tags of the code creating the task
+        self.fn = instrumentation.bind(fn)
+        self.depends_on = [d for d in depends_on if d is not None]
+        self.cost = cost
+        self.name = name
+        self.background = background
+        #Estimated number of calls of the longest chain starting with this task
+        self.rank = cost
+        self.waiting = 0
+        self.pending = 1
+        self.value = None
+        self.error = None
+
+    def __repr__(self):
+        return f"Task({self.name}, rank={self.rank})"
+
+
+class Scheduler():
+    """
+    Global work queue: runs the tasks of all the dashboards on a single pool of threads. A task is ready once its
+    dependencies are complete, and the ready task with the longest chain of work after it (critical path) runs first,
+    so the total duration is bounded by the longest dependency chain rather than by the order of the dashboards.
+    """
+    def __init__(self, max_workers = None):
+        if max_workers is None:
+            max_workers = globals()["max_workers"]
+        self.condition = threading.Condition()
+        self.ready = []
+        self.background = []
+        self.running = 0
+        self.background_running = 0
+        self.sequence = itertools.count()
+        self.unfinished = 0
+        self.closed = False
+        self.local = threading.local()
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(max_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, tasks):
+        """Schedules the tasks, which must be listed after the tasks of the list they depend on. Returns the tasks."""
+        tasks = list(tasks)
+        batch = set(id(task) for task in tasks)
+        #Ranks within the batch: dependents are listed after their dependencies
+        for task in reversed(tasks):
+            for dependency in task.depends_on:
+                if id(dependency) in batch:
+                    dependency.rank = max(dependency.rank, dependency.cost + task.rank)
+        parent = getattr(self.local, "task", None)
+        with self.condition:
+            self.unfinished += len(tasks)
+            if parent is not None:
+                #Children run before the remaining work of their parent
+                for task in tasks:
+                    task.rank += parent.rank - parent.cost
+                parent.pending += len(tasks)
+        for task in tasks:
+            if parent is not None:
+                task.add_done_callback(lambda child, parent=parent: self.child_done(parent, child))
+            task.waiting = len(task.depends_on) + 1
+            for dependency in task.depends_on:
+                dependency.add_done_callback(lambda dependency, task=task: self.dependency_done(task, dependency))
+            self.dependency_done(task, None)
+        return tasks
+
+    def dependency_done(self, task, dependency):
+        error = None
+        if dependency is not None:
+            error = CancelledError() if dependency.cancelled() else dependency.exception()
+        with self.condition:
+            if error is not None and task.error is None:
+                task.error = error
+            task.waiting -= 1
+            if task.waiting > 0:
+                return
+            if task.error is None:
+                heapq.heappush(self.background if task.background else self.ready, (-task.rank, next(self.sequence), task))
+                self.condition.notify()
+                return
+        self.finish(task)
+
+    def child_done(self, parent, child):
+        self.finish(parent, error=CancelledError() if child.cancelled() else child.exception())
+
+    def finish(self, task, value = None, error = None):
+        """Completes a step of the task (its run, or one of its children), sets its result once all the steps are complete."""
+        with self.condition:
+            if value is not None:
+                task.value = value
+            if error is not None and task.error is None:
+                task.error = error
+            task.pending -= 1
+            if task.pending > 0:
+                return
+        if task.error is not None:
+            task.set_exception(task.error)
+        else:
+            task.set_result(task.value)
+        self.task_done()
+
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+    def next_task(self):
+        if len(self.ready) > 0:
+            self.running += 1
+            return heapq.heappop(self.ready)[2]
+        #No limit once the other tasks are all waiting (ex: for the param queries job or the background tasks)
+        if len(self.background) > 0 and (self.background_running < max_background_workers or self.running == self.background_running):
+            self.running += 1
+            self.background_running += 1
+            return heapq.heappop(self.background)[2]
+        return None
+
+    def work(self):
+        while True:
+            with self.condition:
+                task = self.next_task()
+                while task is None and not self.closed:
+                    self.condition.wait()
+                    task = self.next_task()
+                if task is None:
+                    return
+            try:
+                self.run(task)
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    if task.background:
+                        self.background_running -= 1
+                    self.condition.notify_all()
+
+    def run(self, task):
+        if not task.set_running_or_notify_cancel():
+            return self.task_done()
+        self.local.task = task
+        try:
+            value = task.fn()
+        except BaseException as e:
+            return self.finish(task, error=e)
+        finally:
+            self.local.task = None
+        if isinstance(value, Future):
+            value.add_done_callback(lambda future: self.continuation_done(task, future))
+        else:
+            self.finish(task, value)
+
+    def continuation_done(self, task, future):
+        if future.cancelled() or future.exception() is not None:
+            self.finish(task, error=CancelledError() if future.cancelled() else future.exception())
+        else:
+            self.finish(task, future.result())
+
+    def close(self):
+        """Waits for all the submitted tasks, then stops the threads."""
+        with self.condition:
+            while self.unfinished > 0:
+                self.condition.wait()
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+import logging
+
+logger = logging.getLogger('dbsqlclone.state')
+
+
+class StateStore():
+    """
+    State file with an append-only journal (state_file + ".journal", one json record per line).
+    Each query and dashboard mapping is appended to the journal as soon as it's created, so a crash never loses it.
+    The state file itself is only rewritten (atomically) on checkpoint, then the journal is cleared.
+    Loading the state replays the journal of an interrupted run on top of the state file.
+    """
+    def __init__(self, state_file = "state.json"):
+        self.state_file = state_file
+        self.journal_file = state_file + ".journal"
+        self.lock = threading.Lock()
+        self.journal = None
+        #Dashboards fully cloned by the interrupted run, per workspace state id
+        self.completed = {}
+
+    def load(self):
+        state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r") as r:
+                state = json.load(r)
+        return self.replay(state)
+
+    def replay(self, state):
+        """Applies the journal records on the state."""
+        if not os.path.exists(self.journal_file):
+            return state
+        count = 0
+        with open(self.journal_file, "r") as r:
+            for line in r:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #Last line partially written when the process was killed
+                    logger.warning(f"ignoring truncated record at the end of {self.journal_file}")
+                    break
+                workspace_state = state.setdefault(record["workspace"], {})
+                dashboard_state = workspace_state.setdefault(record["dashboard"], {})
+                if "query" in record:
+                    dashboard_state.setdefault("queries", {})[record["query"]] = record["state"]
+                elif "new_id" in record:
+                    dashboard_state["new_id"] = record["new_id"]
+                else:
+                    workspace_state[record["dashboard"]] = record["state"]
+                    self.completed.setdefault(record["workspace"], set()).add(record["dashboard"])
+                count += 1
+        logger.debug(f"replayed {count} records from {self.journal_file}")
+        return state
+
+    def is_completed(self, workspace_state_id, dashboard_id):
+        return dashboard_id in self.completed.get(workspace_state_id, set())
+
+    def get_journal(self, workspace_state_id, dashboard_id):
+        return DashboardJournal(self, workspace_state_id, dashboard_id)
+
+    def record(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.lock:
+            if self.journal is None:
+                self.journal = open(self.journal_file, "a")
+            #A single write per record: a crash can only truncate the last line
+            self.journal.write(line)
+            self.journal.flush()
+
+    def save(self, state):
+        """Atomically rewrites the state file. The journal is kept."""
+        with self.lock:
+            save_state_file(state, self.state_file)
+
+    def checkpoint(self, state):
+        """Atomically rewrites the state file and clears the journal: everything it contains is now in the state file."""
+        with self.lock:
+            save_state_file(state, self.state_file)
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            self.completed = {}
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+
+class DashboardJournal():
+    """Records the progress of a single dashboard clone in the store journal."""
+    def __init__(self, store: StateStore, workspace_state_id, dashboard_id):
+        self.store = store
+        self.workspace_state_id = workspace_state_id
+        self.dashboard_id = dashboard_id
+
+    def query(self, query_id, query_state):
+        self.store.record({"workspace": self.workspace_state_id, "dashboard": self.dashboard_id, "query": query_id, "state": query_state})
+
+    def new_dashboard(self, new_id):
+        self.store.record({"workspace": self.workspace_state_id, "dashboard": self.dashboard_id, "new_id": new_id})
+
+    def dashboard(self, dashboard_state):
+        """The dashboard is fully cloned."""
+        self.store.record({"workspace": self.workspace_state_id, "dashboard": self.dashboard_id, "state": dashboard_state})
+
+
+def save_state_file(state, state_file):
+    #Write to a temporary file first so that a crash never leaves a truncated state
+    with open(state_file+".tmp", 'w') as file:
+        json.dump(state, file, separators=(",", ":"))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(state_file+".tmp", state_file)
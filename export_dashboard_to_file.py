@@ -1,7 +1,8 @@
 import argparse
-from utils import clone_dashboard
-from utils.client import Client
-from utils.dump_dashboard import dump_dashboard
+from dbsqlclone.utils import clone_dashboard
+from dbsqlclone.utils.client import Client
+from dbsqlclone.utils.dump_dashboard import dump_dashboard
+from dbsqlclone.utils.bundle import dump_dashboards_to_bundle
 import json
 
 
@@ -15,7 +16,13 @@ def get_client(config_file):
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config_file", default="config_export.json", required=False,
-                    help="configuration file containing credential and dashboard to clone")
+                    help="configuration file containing credential and dashboard to clone. "
+                         "If dashboard_folder ends with .zip, the dashboards are saved in a compressed bundle")
 args = parser.parse_args()
 source_client,dashboard_id_to_save,dashboard_folder_to_save  = get_client(args.config_file)
-dump_dashboard(source_client,dashboard_id_to_save,dashboard_folder_to_save)
+#dashboard_id can also be a list of dashboards to save in the same bundle
+if dashboard_folder_to_save.endswith(".zip"):
+    dashboard_ids = dashboard_id_to_save if isinstance(dashboard_id_to_save, list) else [dashboard_id_to_save]
+    dump_dashboards_to_bundle(source_client, dashboard_ids, dashboard_folder_to_save)
+else:
+    dump_dashboard(source_client,dashboard_id_to_save,dashboard_folder_to_save)
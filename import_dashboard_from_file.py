@@ -1,7 +1,8 @@
 import argparse
-from utils import clone_dashboard
-from utils.load_dashboard import load_dashboard
-from utils.client import Client
+from dbsqlclone.utils import clone_dashboard
+from dbsqlclone.utils.load_dashboard import load_dashboard
+from dbsqlclone.utils.bundle import is_bundle, load_dashboards_from_bundle
+from dbsqlclone.utils.client import Client
 import json
 
 
@@ -22,12 +23,18 @@ def get_client(config_file,pat_token):
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config_file", default="config_import.json", required=False,
-                    help="Configuration file containing credential and dashboard to clone")
+                    help="Configuration file containing credential and dashboard to clone. "
+                         "dashboard_folder can also be a bundle file saved by export_dashboard_to_file.py")
 parser.add_argument("--pat_token", required=True,
                     help="Personal Access Token to for your workspace")
 args = parser.parse_args()
 
 target_clients, dashboard_id_to_load,dashboard_folder  = get_client(args.config_file, args.pat_token)
 workspace_state = {}
-load_dashboard(target_clients[0], dashboard_id_to_load, workspace_state, dashboard_folder)
+if is_bundle(dashboard_folder):
+    #Loads all the dashboards of the bundle if no dashboard_id is set
+    dashboard_ids = [dashboard_id_to_load] if dashboard_id_to_load else None
+    load_dashboards_from_bundle(target_clients[0], dashboard_folder, workspace_state, dashboard_ids)
+else:
+    load_dashboard(target_clients[0], dashboard_id_to_load, workspace_state, dashboard_folder)
                                                          
@@ -10,5 +10,11 @@ setup(
     setup_requires=["wheel"],
     include_package_data=True,
     install_requires=["requests"],
+    entry_points={
+        "console_scripts": [
+            "dbsqlclone-export=dbsqlclone.export_dashboards:main",
+            "dbsqlclone-import=dbsqlclone.import_dashboards:main",
+        ]
+    },
     license_files = ('LICENSE',)
 )
\ No newline at end of file
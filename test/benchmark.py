@@ -0,0 +1,169 @@
+"""
+Offline benchmark: replays the fixture dashboards (test/*.json and dashboards/*.json) against local mock workspaces
+(see mock_server.py) through the dump, clone, update and cleanup scenarios, for several numbers of dashboards and workers.
+Reports the wall time, the number of requests and the requests/sec of each run.
+
+    python test/benchmark.py --sizes 5 20 --workers 1 3 --latency 0.05 --output bench.json
+    python test/benchmark.py --sizes 5 20 --workers 1 3 --latency 0.05 --baseline bench.json
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import seed
+from mock_server import MockWorkspace
+from dbsqlclone.utils.client import Client
+from dbsqlclone.utils import clone_dashboard, dump_dashboard, load_dashboard, rate_limiter, scheduler
+from dbsqlclone.utils import cleanup as cleanup_engine
+
+bench_tag = "bench"
+
+
+def new_workspace(args):
+    workspace = MockWorkspace(latency=args.latency, latency_jitter=args.latency_jitter, throttle_rate=args.throttle_rate,
+                              retry_after=args.retry_after, max_page_size=args.page_size).start()
+    client = Client(workspace.url, "mock-token", endpoint_id="endpoint-1",
+                    permissions=[{"group_name": "users", "permission_level": "CAN_RUN"}])
+    clone_dashboard.set_data_source_id_from_endpoint_id(client)
+    return workspace, client
+
+
+def seed_source(args, size):
+    """Creates a source workspace with size dashboards tagged with bench_tag, cycling over the fixtures."""
+    workspace = MockWorkspace(max_page_size=args.page_size).start()
+    client = Client(workspace.url, "mock-token", endpoint_id="endpoint-1", permissions=None)
+    clone_dashboard.set_data_source_id_from_endpoint_id(client)
+    seed(client, size, bench_tag)
+    #Only the benchmark calls are reported
+    workspace.latency, workspace.latency_jitter = args.latency, args.latency_jitter
+    workspace.throttle_rate, workspace.retry_after = args.throttle_rate, args.retry_after
+    return workspace, client
+
+
+def set_workers(workers):
+    load_dashboard.max_workers = workers
+    cleanup_engine.max_workers = workers
+    scheduler.max_workers = workers
+    dump_dashboard.max_workers = workers
+
+
+def dump(source_client, target_client, state_file):
+    dashboard_ids = [d["id"] for d in clone_dashboard.get_all_dashboards(source_client, [bench_tag])]
+    query_cache = dump_dashboard.QueryCache()
+    with ThreadPoolExecutor(max_workers=dump_dashboard.max_workers) as executor:
+        collections.deque(executor.map(lambda id: dump_dashboard.get_dashboard_definition_by_id(source_client, id, query_cache), dashboard_ids))
+
+
+def clone(source_client, target_client, state_file):
+    failures = clone_dashboard.delete_and_clone_dashboards_with_tags_to_targets(source_client, [target_client], [bench_tag], True,
+                                                                                None, state_file=state_file,
+                                                                                dump_cache_file=state_file + ".dump_cache")
+    assert len(failures[target_client.url]) == 0, failures
+
+
+#The state file and the dump cache of the previous clone are re-used: nothing changed in the source, the clone is a no-op update
+update = clone
+
+
+
+def cleanup(source_client, target_client, state_file):
+    #Deletes everything the clone created in the target
+    report = clone_dashboard.delete_resources(target_client, [bench_tag])
+    assert len(report["failed"]) == 0, report
+
+
+scenarios = {"dump": dump, "clone": clone, "update": update, "cleanup": cleanup}
+
+
+def run(args, size, workers):
+    results = []
+    source, source_client = seed_source(args, size)
+    target, target_client = new_workspace(args)
+    set_workers(workers)
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "state.json")
+        for scenario in args.scenarios:
+            source.reset_stats()
+            target.reset_stats()
+            start = time.perf_counter()
+            scenarios[scenario](source_client, target_client, state_file)
+            duration = time.perf_counter() - start
+            calls = source.calls + target.calls
+            requests = sum(calls.values())
+            results.append({
+                "scenario": scenario, "dashboards": size, "workers": workers, "wall_time": round(duration, 3),
+                "requests": requests, "requests_per_sec": round(requests / duration, 1) if duration > 0 else 0,
+                "throttled": source.throttled + target.throttled,
+                "writes": sum(count for (method, path), count in calls.items() if method != "GET"),
+                "calls": {f"{method} {path}": count for (method, path), count in sorted(calls.items())}
+            })
+    for workspace, client in [(source, source_client), (target, target_client)]:
+        client.close()
+        workspace.stop()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns the runs slower than the baseline run of the same scenario/size/workers by more than threshold (ratio)."""
+    baseline = {(r["scenario"], r["dashboards"], r["workers"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        key = (r["scenario"], r["dashboards"], r["workers"])
+        if key in baseline and r["wall_time"] > baseline[key]["wall_time"] * (1 + threshold):
+            regressions.append((r, baseline[key]))
+    return regressions
+
+
+def print_results(results):
+    print(f"{'scenario':<10}{'dashboards':>11}{'workers':>9}{'wall time':>11}{'requests':>10}{'writes':>8}{'req/s':>9}{'429':>6}")
+    for r in results:
+        print(f"{r['scenario']:<10}{r['dashboards']:>11}{r['workers']:>9}{r['wall_time']:>10.2f}s{r['requests']:>10}"
+              f"{r['writes']:>8}{r['requests_per_sec']:>9}{r['throttled']:>6}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 20], help="numbers of dashboards to clone")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 3, 6], help="dump max_workers and load scheduler threads to test")
+    parser.add_argument("--scenarios", nargs="+", default=list(scenarios.keys()), choices=list(scenarios.keys()))
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to each mock request")
+    parser.add_argument("--latency_jitter", type=float, default=0.01, help="random extra latency, in seconds")
+    parser.add_argument("--throttle_rate", type=float, default=0, help="fraction of the requests rejected with a 429")
+    parser.add_argument("--retry_after", type=float, default=0.1, help="Retry-After of the 429 responses, in seconds")
+    parser.add_argument("--page_size", type=int, default=250, help="max page size of the mock listings")
+    parser.add_argument("--rate", type=float, default=1000, help="client rate limit (requests/sec) for each workspace")
+    parser.add_argument("--output", help="json file to save the results to")
+    parser.add_argument("--baseline", help="json file of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="max slowdown allowed against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    rate_limiter.default_rate = args.rate
+    rate_limiter.default_burst = args.rate
+    #No need to wait for more warmup tasks, the mock runs complete instantly
+    load_dashboard.warmup_batch_delay = 0.05
+
+    results = []
+    for size in args.sizes:
+        for workers in args.workers:
+            results.extend(run(args, size, workers))
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "w") as w:
+            json.dump(results, w, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline, "r") as r:
+            regressions = compare(results, json.load(r), args.threshold)
+        for r, b in regressions:
+            print(f"REGRESSION {r['scenario']} dashboards={r['dashboards']} workers={r['workers']}: "
+                  f"{r['wall_time']:.2f}s vs {b['wall_time']:.2f}s, {r['requests']} vs {b['requests']} requests")
+        if len(regressions) > 0:
+            sys.exit(1)
@@ -0,0 +1,70 @@
+"""
+Fixtures of the offline tests: every test runs against local mock workspaces (see mock_server.py).
+
+    python -m pytest -q test/
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import root, get_fixtures, seed
+from mock_server import MockWorkspace
+from dbsqlclone.utils.client import Client
+from dbsqlclone.utils import clone_dashboard, load_dashboard, rate_limiter
+
+permissions = [{"group_name": "users", "permission_level": "CAN_RUN"}]
+
+
+@pytest.fixture(autouse=True)
+def fast_run(monkeypatch):
+    #No need to throttle the mock, nor to wait for other dashboards to batch the param queries job
+    monkeypatch.setattr(rate_limiter, "default_rate", 1000)
+    monkeypatch.setattr(rate_limiter, "default_burst", 1000)
+    monkeypatch.setattr(load_dashboard, "warmup_batch_delay", 0.01)
+
+
+def new_workspace(**kwargs):
+    return MockWorkspace(**kwargs).start()
+
+
+def new_client(workspace: MockWorkspace, permissions = permissions):
+    client = Client(workspace.url, "mock-token", endpoint_id="endpoint-1", permissions=permissions)
+    clone_dashboard.set_data_source_id_from_endpoint_id(client)
+    return client
+
+
+@pytest.fixture
+def source():
+    workspace = new_workspace()
+    client = new_client(workspace, None)
+    yield workspace, client
+    client.close()
+    workspace.stop()
+
+
+@pytest.fixture
+def target():
+    workspace = new_workspace()
+    client = new_client(workspace)
+    yield workspace, client
+    client.close()
+    workspace.stop()
+
+
+def without_default_table(monkeypatch):
+    """The target queries are created without default table."""
+    route = MockWorkspace.route
+
+    def no_table_route(self, method, path, params, body):
+        status, response = route(self, method, path, params, body)
+        if method == "POST" and path == "/api/2.0/preview/sql/queries":
+            for v in response["visualizations"]:
+                del self.visualizations[v["id"]]
+            response["visualizations"] = []
+        return status, response
+    monkeypatch.setattr(MockWorkspace, "route", no_table_route)
+
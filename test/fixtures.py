@@ -0,0 +1,33 @@
+"""Fixture dashboards shared by the offline tests (conftest.py) and the benchmark (benchmark.py)."""
+import copy
+import glob
+import json
+import os
+
+from dbsqlclone.utils.client import Client
+from dbsqlclone.utils import load_dashboard
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_fixtures():
+    """Dashboard definitions saved in test/*.json and dashboards/*.json."""
+    fixtures = []
+    for f in sorted(glob.glob(os.path.join(root, "test", "*.json")) + glob.glob(os.path.join(root, "dashboards", "*.json"))):
+        with open(f, "r") as r:
+            dashboard = json.load(r)
+        dashboard.setdefault("id", dashboard["dashboard"]["id"])
+        fixtures.append(dashboard)
+    return fixtures
+
+
+def seed(client: Client, count, tag = "test"):
+    """Clones count fixture dashboards tagged with tag in the workspace of the client, returns their ids."""
+    fixtures = get_fixtures()
+    ids = []
+    for i in range(count):
+        dashboard = copy.deepcopy(fixtures[i % len(fixtures)])
+        dashboard["dashboard"]["name"] = f"{dashboard['dashboard']['name']} {i}"
+        dashboard["dashboard"]["tags"] = [tag]
+        ids.append(load_dashboard.clone_dashboard(dashboard, client, {})["new_id"])
+    return ids
@@ -0,0 +1,238 @@
+"""
+Local stand-in for the Databricks SQL API, used to run the clone without a workspace (see benchmark.py).
+Implements the queries, visualizations, dashboards, widgets, permissions, data_sources and jobs/runs endpoints
+used by dbsqlclone, with configurable latency, 429 injection and pagination.
+"""
+import collections
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class MockWorkspace():
+    """
+    latency: seconds added to every request (+ up to latency_jitter seconds).
+    throttle_rate: fraction of the requests rejected with a 429 (with a Retry-After of retry_after seconds).
+    max_page_size: max number of items returned by a listing page.
+    run_duration: seconds before a submitted job run succeeds.
+    inject() makes the next calls of an endpoint fail with a given status.
+    """
+    def __init__(self, latency = 0, latency_jitter = 0, throttle_rate = 0, retry_after = 0, max_page_size = 250, run_duration = 0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_page_size = max_page_size
+        self.run_duration = run_duration
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.visualizations = {}
+        self.dashboards = {}
+        self.widgets = {}
+        self.runs = {}
+        #permissions path -> acl
+        self.permissions = {}
+        self.data_sources = [{"id": "data-source-1", "endpoint_id": "endpoint-1", "name": "endpoint"}]
+        #[method, path template, status, remaining count, headers]
+        self.faults = []
+        self.reset_stats()
+        self.server = None
+
+    def reset_stats(self):
+        #(method, path template) -> count
+        self.calls = collections.Counter()
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def inject(self, method, path_template, status, count = 1, headers = None):
+        """The next count calls of the endpoint (ex: "/api/2.0/preview/sql/queries/{id}") return status with the headers."""
+        with self.lock:
+            self.faults.append([method, path_template, status, count, headers or {}])
+
+    def get_fault(self, method, path_template):
+        for fault in self.faults:
+            if fault[0] == method and fault[1] == path_template and fault[3] > 0:
+                fault[3] -= 1
+                return fault
+        return None
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def live_count(self, items):
+        return len([i for i in items.values() if "moved_to_trash_at" not in i and "moved_to_trash_at" not in i.get("options", {})])
+
+    def query_view(self, q):
+        q = dict(q)
+        q["visualizations"] = [v for v in self.visualizations.values() if v["query_id"] == q["id"]]
+        return q
+
+    def dashboard_view(self, d):
+        d = dict(d)
+        widgets = []
+        for w in self.widgets.values():
+            if w["dashboard_id"] == d["id"]:
+                w = dict(w)
+                if w.get("visualization_id") is not None:
+                    v = dict(self.visualizations.get(w["visualization_id"], {"id": w["visualization_id"]}))
+                    if v.get("query_id") in self.queries:
+                        v["query"] = {k: val for k, val in self.queries[v["query_id"]].items()}
+                    w["visualization"] = v
+                widgets.append(w)
+        d["widgets"] = widgets
+        return d
+
+    def route(self, method, path, params, body):
+        now = time.time()
+        m = re.fullmatch(r"/api/2.0/preview/sql/(queries|dashboards)", path)
+        if m and method == "GET":
+            items = self.queries if m.group(1) == "queries" else self.dashboards
+            items = [i for i in items.values() if "moved_to_trash_at" not in i]
+            if "tags" in params:
+                items = [i for i in items if params["tags"] in (i.get("tags") or [])]
+            if "order" in params:
+                key = params["order"].lstrip("-")
+                items = sorted(items, key=lambda i: i.get(key) or 0, reverse=params["order"].startswith("-"))
+            size, page = min(int(params.get("page_size", 25)), self.max_page_size), int(params.get("page", 1))
+            if page > 1 and (page - 1) * size >= len(items):
+                return 400, {"error_code": "INVALID_PARAMETER_VALUE", "message": "Page is out of range."}
+            return 200, {"count": len(items), "page": page, "page_size": size, "results": items[(page-1)*size:page*size]}
+        if path == "/api/2.0/preview/sql/queries" and method == "POST":
+            q = dict(body, id=str(uuid.uuid4()), created_at=now, updated_at=now)
+            self.queries[q["id"]] = q
+            #Every query is created with a default table
+            v = {"id": str(uuid.uuid4()), "query_id": q["id"], "type": "TABLE", "name": "Table", "description": "",
+                 "options": {}, "query_plan": None}
+            self.visualizations[v["id"]] = v
+            return 200, self.query_view(q)
+        m = re.fullmatch(r"/api/2.0/preview/sql/(queries|dashboards|visualizations|widgets)/([^/]+)", path)
+        if m:
+            items = {"queries": self.queries, "dashboards": self.dashboards, "visualizations": self.visualizations, "widgets": self.widgets}[m.group(1)]
+            item = items.get(m.group(2))
+            if item is None:
+                return 404, {"error_code": "RESOURCE_DOES_NOT_EXIST", "message": f"{m.group(1)} {m.group(2)} not found"}
+            view = {"queries": self.query_view, "dashboards": self.dashboard_view}.get(m.group(1), dict)
+            if method == "GET":
+                return 200, view(item)
+            if method == "POST":
+                item.update(body)
+                if "updated_at" in item:
+                    item["updated_at"] = now
+                return 200, view(item)
+            if method == "DELETE":
+                if m.group(1) == "queries":
+                    item["moved_to_trash_at"] = now
+                elif m.group(1) == "dashboards":
+                    item["moved_to_trash_at"] = now
+                    item["options"]["moved_to_trash_at"] = now
+                else:
+                    del items[item["id"]]
+                return 200, {}
+        if path == "/api/2.0/preview/sql/visualizations" and method == "POST":
+            v = dict(body, id=str(uuid.uuid4()))
+            self.visualizations[v["id"]] = v
+            return 200, v
+        if path == "/api/2.0/preview/sql/dashboards" and method == "POST":
+            d = dict(body, id=str(uuid.uuid4()), options={}, created_at=now, updated_at=now)
+            self.dashboards[d["id"]] = d
+            return 200, self.dashboard_view(d)
+        if path == "/api/2.0/preview/sql/widgets" and method == "POST":
+            w = dict(body, id=str(uuid.uuid4()))
+            self.widgets[w["id"]] = w
+            return 200, w
+        if path.startswith("/api/2.0/preview/sql/permissions/"):
+            if method == "POST":
+                self.permissions[path] = body
+                return 200, body
+            return 200, self.permissions.get(path, {"access_control_list": []})
+        if path == "/api/2.0/preview/sql/data_sources":
+            return 200, self.data_sources
+        if path == "/api/2.1/jobs/runs/submit" and method == "POST":
+            run_id = len(self.runs) + 1
+            self.runs[run_id] = dict(body, submitted_at=time.monotonic())
+            return 200, {"run_id": run_id}
+        if path == "/api/2.1/jobs/runs/get":
+            run = self.runs.get(int(params.get("run_id", 0)))
+            if run is None:
+                return 404, {"error_code": "RESOURCE_DOES_NOT_EXIST", "message": "run not found"}
+            if time.monotonic() - run["submitted_at"] < self.run_duration:
+                return 200, {"run_id": params["run_id"], "state": {"life_cycle_state": "RUNNING"}}
+            return 200, {"run_id": params["run_id"], "state": {"life_cycle_state": "TERMINATED", "result_state": "SUCCESS"}}
+        return 404, {"error_code": "ENDPOINT_NOT_FOUND", "message": f"No API found for '{method} {path}'"}
+
+
+def get_path_template(path):
+    return re.sub(r"/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", "/{id}", path)
+
+
+def make_handler(workspace: MockWorkspace):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        #Keep-alive connection: without TCP_NODELAY, Nagle + delayed ACK add ~40ms to every response
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status, body, headers = {}):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+            with workspace.lock:
+                workspace.bytes_sent += len(data)
+
+        def handle_request(self, method):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length > 0 else b""
+            with workspace.lock:
+                workspace.calls[(method, get_path_template(url.path))] += 1
+                workspace.bytes_received += len(raw)
+                fault = workspace.get_fault(method, get_path_template(url.path))
+            if fault is not None:
+                return self.send(fault[2], {"error_code": "INJECTED", "message": f"injected {fault[2]}"}, fault[4])
+            if workspace.latency > 0 or workspace.latency_jitter > 0:
+                time.sleep(workspace.latency + random.uniform(0, workspace.latency_jitter))
+            if workspace.throttle_rate > 0 and random.random() < workspace.throttle_rate:
+                with workspace.lock:
+                    workspace.throttled += 1
+                return self.send(429, {"error_code": "REQUEST_LIMIT_EXCEEDED", "message": "Too many requests"},
+                                 {"Retry-After": str(workspace.retry_after)})
+            body = json.loads(raw) if len(raw) > 0 else {}
+            with workspace.lock:
+                status, response = workspace.route(method, url.path, params, body)
+            self.send(status, response)
+
+        def do_GET(self):
+            self.handle_request("GET")
+
+        def do_POST(self):
+            self.handle_request("POST")
+
+        def do_DELETE(self):
+            self.handle_request("DELETE")
+
+    return Handler
@@ -0,0 +1,112 @@
+import copy
+import json
+import threading
+
+from conftest import get_fixtures, without_default_table
+from mock_server import MockWorkspace
+from dbsqlclone.utils import async_load_dashboard
+from dbsqlclone.utils.client import Client
+from dbsqlclone.utils.load_dashboard import get_first_vis
+
+
+def writes(workspace):
+    return {call: count for call, count in workspace.calls.items() if call[0] != "GET"}
+
+
+def test_clone_dashboard(target):
+    workspace, client = target
+    dashboard = get_fixtures()[1]
+    state = async_load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    assert state["new_id"] in workspace.dashboards
+    assert sorted(state["queries"]) == sorted(q["id"] for q in dashboard["queries"])
+    assert len(state["widgets"]) == len(dashboard["dashboard"]["widgets"])
+    assert sorted(state["widgets"].values()) == sorted(workspace.widgets)
+    assert state["permissions_hash"] is not None
+
+    #Nothing changed: nothing is written to the target
+    workspace.reset_stats()
+    async_load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, state)
+    assert writes(workspace) == {}
+
+
+def test_load_dashboards_in_flight_window(monkeypatch, tmp_path, target):
+    workspace, client = target
+    dashboards = get_fixtures()
+    for d in dashboards:
+        with open(tmp_path / f"dashboard-{d['id']}.json", "w") as w:
+            json.dump(d, w)
+    lock = threading.Lock()
+    in_flight = [0, 0]
+    request = Client.request
+
+    def counting_request(self, method, path, *args, **kwargs):
+        if path.startswith("/api/2.1/jobs/"):
+            #The param queries job is polled outside of the window
+            return request(self, method, path, *args, **kwargs)
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        try:
+            return request(self, method, path, *args, **kwargs)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+    monkeypatch.setattr(Client, "request", counting_request)
+    state = async_load_dashboard.load_dashboards(client, [d["id"] for d in dashboards], {}, str(tmp_path), max_in_flight=3)
+    assert sorted(state) == sorted(d["id"] for d in dashboards)
+    assert sorted(s["new_id"] for s in state.values()) == sorted(workspace.dashboards)
+    #All the dashboards share the same window
+    assert in_flight[1] <= 3
+
+
+def test_rejected_permissions(monkeypatch, target):
+    workspace, client = target
+    route = MockWorkspace.route
+
+    def forbidden_route(self, method, path, params, body):
+        if method == "POST" and path.startswith("/api/2.0/preview/sql/permissions/"):
+            return 403, {"error_code": "PERMISSION_DENIED", "message": "injected failure"}
+        return route(self, method, path, params, body)
+    monkeypatch.setattr(MockWorkspace, "route", forbidden_route)
+    state = async_load_dashboard.clone_dashboard(copy.deepcopy(get_fixtures()[1]), client, {})
+    assert "permissions_hash" not in state
+    assert all("permissions_hash" not in q for q in state["queries"].values())
+
+
+def test_without_default_table(monkeypatch, target):
+    workspace, client = target
+    without_default_table(monkeypatch)
+    dashboard = get_fixtures()[1]
+    state = async_load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    assert workspace.calls[("POST", "/api/2.0/preview/sql/visualizations/{id}")] == 0
+    for q in dashboard["queries"]:
+        assert sorted(state["queries"][q["id"]]["visualizations"]) == sorted(v["id"] for v in q["visualizations"])
+
+
+class RecordingJournal():
+    def __init__(self):
+        self.records = []
+
+    def query(self, query_id, query_state):
+        self.records.append(("query", query_id, copy.deepcopy(query_state)))
+
+    def new_dashboard(self, new_id):
+        self.records.append(("new_dashboard", new_id))
+
+    def dashboard(self, dashboard_state):
+        self.records.append(("dashboard", copy.deepcopy(dashboard_state)))
+
+
+def test_query_journaled_when_created(target):
+    workspace, client = target
+    dashboard = get_fixtures()[1]
+    journal = RecordingJournal()
+    state = async_load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {}, journal=journal)
+    for q in dashboard["queries"]:
+        records = [r[2] for r in journal.records if r[0] == "query" and r[1] == q["id"]]
+        #First recorded with its default table only, then with all its visualizations
+        assert len(records) == 2
+        assert "hash" not in records[0]
+        assert records[0]["new_id"] == state["queries"][q["id"]]["new_id"]
+        assert list(records[0]["visualizations"]) == [get_first_vis(q)["id"]]
+        assert records[1] == state["queries"][q["id"]]
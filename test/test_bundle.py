@@ -0,0 +1,64 @@
+import copy
+import json
+import zipfile
+
+from conftest import get_fixtures, seed
+from dbsqlclone.utils import bundle
+from dbsqlclone.utils.bundle import BundleWriter, DashboardBundle
+from dbsqlclone.utils.dump_dashboard import get_dashboard_definition_by_id
+
+
+def test_pack_unpack(tmp_path, source):
+    workspace, client = source
+    ids = seed(client, 4)
+    bundle_file = str(tmp_path / "dashboards.zip")
+    bundle.dump_dashboards_to_bundle(client, ids, bundle_file)
+    assert bundle.is_bundle(bundle_file)
+    with DashboardBundle(bundle_file) as b:
+        assert sorted(b.get_dashboard_ids()) == sorted(ids)
+        for dashboard_id in ids:
+            assert b.get_dashboard(dashboard_id) == get_dashboard_definition_by_id(client, dashboard_id)
+    #The widgets reference the query and visualization records instead of embedding them
+    with zipfile.ZipFile(bundle_file) as z:
+        widgets = [w for name in z.namelist() if name.startswith("dashboards/") for w in json.loads(z.read(name))["widgets"]]
+    assert all("$ref" in w["visualization"] for w in widgets if "visualization" in w)
+
+
+def test_shared_records(tmp_path):
+    definition = get_fixtures()[1]
+    other = copy.deepcopy(definition)
+    other["id"] = "other"
+    other["dashboard"]["name"] = "Other"
+    other["queries"][0]["is_parameter_query"] = True
+    #The embedded visualization doesn't match its record anymore: the widget keeps it
+    widget = next(w for w in other["dashboard"]["widgets"] if "visualization" in w)
+    widget["visualization"]["name"] = "Renamed"
+    bundle_file = str(tmp_path / "dashboards.zip")
+    with BundleWriter(bundle_file) as writer:
+        writer.add_dashboard(definition)
+        writer.add_dashboard(other)
+    with zipfile.ZipFile(bundle_file) as z:
+        names = z.namelist()
+    #The queries and visualizations of both dashboards are stored once
+    assert len([name for name in names if name.startswith("queries/")]) == len(definition["queries"])
+    assert len(names) == len(set(names))
+    with DashboardBundle(bundle_file) as b:
+        assert b.get_dashboard(definition["id"]) == definition
+        assert b.get_dashboard("other") == other
+
+
+def test_load_from_bundle(tmp_path, source, target):
+    source_workspace, source_client = source
+    target_workspace, target_client = target
+    ids = seed(source_client, 3)
+    bundle_file = str(tmp_path / "dashboards.zip")
+    bundle.dump_dashboards_to_bundle(source_client, ids, bundle_file)
+    state = bundle.load_dashboards_from_bundle(target_client, bundle_file, {})
+    assert sorted(state) == sorted(ids)
+    assert sorted(d["new_id"] for d in state.values()) == sorted(target_workspace.dashboards)
+    assert len(target_workspace.widgets) == len(source_workspace.widgets)
+
+    #Nothing changed: the second load doesn't write anything
+    target_workspace.reset_stats()
+    bundle.load_dashboards_from_bundle(target_client, bundle_file, state)
+    assert {call: count for call, count in target_workspace.calls.items() if call[0] != "GET"} == {}
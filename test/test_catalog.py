@@ -0,0 +1,119 @@
+import pytest
+
+from mock_server import MockWorkspace
+from dbsqlclone.utils import catalog, clone_dashboard
+from dbsqlclone.utils.catalog import Catalog
+from dbsqlclone.utils.cleanup import Cleanup
+
+listing = ("GET", "/api/2.0/preview/sql/dashboards")
+
+
+@pytest.fixture
+def dashboards(monkeypatch, source):
+    #5 dashboards: a full listing takes 3 pages
+    monkeypatch.setattr(clone_dashboard, "page_size", 2)
+    workspace, client = source
+    ids = []
+    for i in range(5):
+        with client.post("/api/2.0/preview/sql/dashboards", json={"name": f"dashboard {i}", "tags": ["test"]}) as r:
+            ids.append(r.json()["id"])
+    workspace.reset_stats()
+    return ids
+
+
+def open_catalog(tmp_path, client):
+    #Each catalog is a new run on the same file
+    client.catalog = Catalog(str(tmp_path / "catalog.db"))
+    return client.catalog
+
+
+def names(items):
+    return sorted(i["name"] for i in items)
+
+
+def test_incremental_refresh(tmp_path, source, dashboards):
+    workspace, client = source
+    with open_catalog(tmp_path, client) as c:
+        assert names(c.get_items(client, "dashboards")) == [f"dashboard {i}" for i in range(5)]
+    assert workspace.calls[listing] == 3
+
+    workspace.reset_stats()
+    with open_catalog(tmp_path, client) as c:
+        assert len(c.get_items(client, "dashboards")) == 5
+    #Nothing changed: only the first page is read
+    assert workspace.calls[listing] == 1
+
+    with client.post("/api/2.0/preview/sql/dashboards/"+dashboards[0], json={"name": "renamed", "tags": ["other"]}) as r:
+        r.json()
+    workspace.reset_stats()
+    with open_catalog(tmp_path, client) as c:
+        assert "renamed" in names(c.get_items(client, "dashboards"))
+        #Down to the first dashboard older than the previous refresh
+        assert workspace.calls[listing] == 2
+        assert names(c.get_items(client, "dashboards", ["other"])) == ["renamed"]
+        assert len(c.get_items(client, "dashboards", ["test"])) == 4
+
+
+def test_unordered_listing(monkeypatch, tmp_path, source, dashboards):
+    workspace, client = source
+    with open_catalog(tmp_path, client) as c:
+        c.get_items(client, "dashboards")
+    #Listed in creation order, after a dashboard older than itself
+    with client.post("/api/2.0/preview/sql/dashboards/"+dashboards[1], json={"name": "renamed"}) as r:
+        r.json()
+    route = MockWorkspace.route
+
+    def unordered_route(self, method, path, params, body):
+        return route(self, method, path, {k: v for k, v in params.items() if k != "order"}, body)
+    monkeypatch.setattr(MockWorkspace, "route", unordered_route)
+    workspace.reset_stats()
+    with open_catalog(tmp_path, client) as c:
+        assert "renamed" in names(c.get_items(client, "dashboards"))
+    #The first page isn't sorted by updated_at: listed entirely
+    assert workspace.calls[listing] == 1 + 3
+
+
+def test_deleted_outside(tmp_path, source, dashboards):
+    workspace, client = source
+    with open_catalog(tmp_path, client) as c:
+        c.get_items(client, "dashboards")
+    #Deleted without changing the updated_at of the other dashboards
+    workspace.dashboards[dashboards[2]]["moved_to_trash_at"] = 0
+    workspace.reset_stats()
+    with open_catalog(tmp_path, client) as c:
+        assert dashboards[2] not in [d["id"] for d in c.get_items(client, "dashboards")]
+    #The count doesn't match the catalog anymore: listed entirely
+    assert workspace.calls[listing] == 1 + 2
+
+
+def test_cleanup_removal(tmp_path, source, dashboards):
+    workspace, client = source
+    with open_catalog(tmp_path, client) as c:
+        c.get_items(client, "dashboards")
+        cleanup = Cleanup(client)
+        cleanup.delete("dashboards", dashboards[2])
+        assert cleanup.wait()["deleted"] == 1
+    workspace.reset_stats()
+    with open_catalog(tmp_path, client) as c:
+        assert dashboards[2] not in [d["id"] for d in c.get_items(client, "dashboards")]
+    assert workspace.calls[listing] == 1
+
+
+def test_full_refresh_interval(monkeypatch, tmp_path, source, dashboards):
+    workspace, client = source
+    with open_catalog(tmp_path, client) as c:
+        c.get_items(client, "dashboards")
+    monkeypatch.setattr(catalog, "full_refresh_interval", -1)
+    workspace.reset_stats()
+    with open_catalog(tmp_path, client) as c:
+        c.get_items(client, "dashboards")
+    assert workspace.calls[listing] == 3
+
+
+def test_invalid_file(tmp_path):
+    state_file = tmp_path / "state.json"
+    state_file.write_text('{"ws": {}}')
+    with pytest.raises(Exception, match="isn't a catalog"):
+        Catalog(str(state_file))
+    #Never overwritten
+    assert state_file.read_text() == '{"ws": {}}'
@@ -0,0 +1,232 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from conftest import new_client, new_workspace, seed
+from dbsqlclone.utils import clone_dashboard
+from dbsqlclone.utils.dump_dashboard import DumpCache, QueryCache, get_dashboard_definition_by_id
+
+dashboard = ("GET", "/api/2.0/preview/sql/dashboards/{id}")
+query = ("GET", "/api/2.0/preview/sql/queries/{id}")
+
+
+def dump(client, cache_file):
+    """A run with the dump cache: returns the definitions of the dashboards tagged test."""
+    cache = DumpCache(cache_file)
+    dashboards = clone_dashboard.get_all_dashboards(client, ["test"])
+    cache.set_listing(client, "dashboards", dashboards)
+    query_cache = QueryCache()
+    definitions = {d["id"]: get_dashboard_definition_by_id(client, d["id"], query_cache, cache) for d in dashboards}
+    cache.save()
+    return definitions, cache
+
+
+@pytest.fixture
+def cached(tmp_path, source):
+    """2 dashboards dumped in the cache by a first run."""
+    workspace, client = source
+    ids = seed(client, 2)
+    cache_file = str(tmp_path / "dump_cache.json")
+    definitions, cache = dump(client, cache_file)
+    assert (cache.hits, cache.misses) == (0, 2)
+    workspace.reset_stats()
+    return ids, definitions, cache_file
+
+
+def test_hit(source, cached):
+    workspace, client = source
+    ids, definitions, cache_file = cached
+    reused, cache = dump(client, cache_file)
+    assert (cache.hits, cache.misses) == (2, 0)
+    assert reused == definitions
+    assert workspace.calls[dashboard] == 0 and workspace.calls[query] == 0
+
+
+def test_dashboard_updated(source, cached):
+    workspace, client = source
+    ids, definitions, cache_file = cached
+    with client.post("/api/2.0/preview/sql/dashboards/" + ids[0], json={"name": "renamed"}) as r:
+        r.json()
+    workspace.reset_stats()
+    reused, cache = dump(client, cache_file)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert reused[ids[0]]["dashboard"]["name"] == "renamed"
+    assert workspace.calls[dashboard] == 1
+
+
+def test_query_updated(source, cached):
+    workspace, client = source
+    ids, definitions, cache_file = cached
+    query_id = definitions[ids[1]]["queries"][0]["id"]
+    with client.post("/api/2.0/preview/sql/queries/" + query_id, json={"query": "SELECT 2"}) as r:
+        r.json()
+    workspace.reset_stats()
+    reused, cache = dump(client, cache_file)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert reused[ids[1]]["queries"][0]["query"] == "SELECT 2"
+    assert workspace.calls[dashboard] == 1
+    assert workspace.calls[query] == len(definitions[ids[1]]["queries"])
+
+
+def test_widget_updated(source, cached):
+    workspace, client = source
+    ids, definitions, cache_file = cached
+    widget = next(w for w in definitions[ids[0]]["dashboard"]["widgets"] if "visualization" in w)
+    with client.post("/api/2.0/preview/sql/widgets/" + widget["id"], json={"width": 3}) as r:
+        r.json()
+    #Documented limitation: editing a widget doesn't change the updated_at of its dashboard, the cached definition is reused
+    reused, cache = dump(client, cache_file)
+    assert (cache.hits, cache.misses) == (2, 0)
+    assert reused[ids[0]] == definitions[ids[0]]
+    #Until the dashboard itself is updated
+    with client.post("/api/2.0/preview/sql/dashboards/" + ids[0], json={"name": "renamed"}) as r:
+        r.json()
+    reused, cache = dump(client, cache_file)
+    assert cache.misses == 1
+    assert next(w for w in reused[ids[0]]["dashboard"]["widgets"] if w["id"] == widget["id"])["width"] == 3
+
+
+def test_eviction(source, cached):
+    workspace, client = source
+    ids, definitions, cache_file = cached
+    with client.delete("/api/2.0/preview/sql/dashboards/" + ids[0]) as r:
+        r.json()
+    reused, cache = dump(client, cache_file)
+    assert list(reused) == [ids[1]]
+    #Not in the listing of this run anymore: removed from the file
+    with open(cache_file, "r") as r:
+        assert list(json.load(r)[client.url]) == [ids[1]]
+
+
+def test_invalid_file(tmp_path, source):
+    workspace, client = source
+    seed(client, 1)
+    cache_file = tmp_path / "dump_cache.json"
+    cache_file.write_text("{invalid")
+    definitions, cache = dump(client, str(cache_file))
+    assert len(definitions) == 1
+    assert cache.misses == 1
+
+
+@pytest.fixture
+def slow_source():
+    #Responses in a random order
+    workspace = new_workspace(latency=0.01, latency_jitter=0.03)
+    client = new_client(workspace, None)
+    yield workspace, client
+    client.close()
+    workspace.stop()
+
+
+def create_query(client, name, param_query_ids = []):
+    parameters = [{"name": f"p{i}", "type": "query", "queryId": query_id} for i, query_id in enumerate(param_query_ids)]
+    with client.post("/api/2.0/preview/sql/queries", json={"name": name, "query": "SELECT 1", "options": {"parameters": parameters}}) as r:
+        return r.json()
+
+
+def create_param_dashboard(client):
+    """Dashboard with widgets on queries using nested param queries, some of them shared."""
+    p1 = create_query(client, "p1")
+    p2 = create_query(client, "p2", [p1["id"]])
+    p3 = create_query(client, "p3")
+    queries = [create_query(client, "q1", [p2["id"]]), create_query(client, "q2"), create_query(client, "q3", [p1["id"], p3["id"]]),
+               create_query(client, "q4", [p2["id"], p3["id"]])]
+    with client.post("/api/2.0/preview/sql/dashboards", json={"name": "params", "tags": ["test"]}) as r:
+        dashboard_id = r.json()["id"]
+    for i, q in enumerate(queries + [queries[0], p1]):
+        with client.post("/api/2.0/preview/sql/widgets", json={"dashboard_id": dashboard_id, "visualization_id": q["visualizations"][0]["id"],
+                                                               "text": "", "width": 1, "options": {"position": {"col": i, "row": 0}}}) as r:
+            r.json()
+    return dashboard_id
+
+
+def get_baseline_definition(client, dashboard_id):
+    """get_dashboard_definition_by_id before the query cache: every query fetched one after the other, in the widgets order."""
+    result = {"queries": [], "id": dashboard_id}
+    dashboard = client.get("/api/2.0/preview/sql/dashboards/"+dashboard_id).json()
+    result["dashboard"] = dashboard
+    query_ids = list()
+    param_query_ids = set()
+
+    def recursively_append_param_queries(q):
+        for p in q["options"]["parameters"]:
+            if "queryId" in p:
+                query_ids.insert(0, p["queryId"])
+                param_query_ids.add(p["queryId"])
+                recursively_append_param_queries(client.get("/api/2.0/preview/sql/queries/" + p["queryId"]).json())
+    for widget in dashboard["widgets"]:
+        if "visualization" in widget:
+            if "options" in widget["visualization"]["query"] and "parameters" in widget["visualization"]["query"]["options"]:
+                recursively_append_param_queries(widget["visualization"]["query"])
+            query_ids.append(widget["visualization"]["query"]["id"])
+    query_ids = list(dict.fromkeys(query_ids))
+    for query_id in query_ids:
+        q = client.get("/api/2.0/preview/sql/queries/" + query_id).json()
+        q["is_parameter_query"] = query_id in param_query_ids
+        result["queries"].append(q)
+    return result
+
+
+def test_same_definition_as_baseline(slow_source):
+    workspace, client = slow_source
+    dashboard_id = create_param_dashboard(client)
+    baseline = get_baseline_definition(client, dashboard_id)
+    for _ in range(3):
+        workspace.reset_stats()
+        definition = get_dashboard_definition_by_id(client, dashboard_id, QueryCache())
+        #Same file as the baseline dump, whatever the order of the responses
+        assert json.dumps(definition, indent=4, sort_keys=True) == json.dumps(baseline, indent=4, sort_keys=True)
+        assert [q["id"] for q in definition["queries"]] == [q["id"] for q in baseline["queries"]]
+        #Each query fetched once
+        assert workspace.calls[query] == len(workspace.queries)
+
+
+def test_query_fetched_once(slow_source):
+    workspace, client = slow_source
+    query_ids = [create_query(client, f"q{i}")["id"] for i in range(4)]
+    workspace.reset_stats()
+    query_cache = QueryCache()
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        queries = list(executor.map(lambda i: query_cache.get_query(client, query_ids[i % 4]), range(64)))
+    assert [q["id"] for q in queries] == [query_ids[i % 4] for i in range(64)]
+    assert workspace.calls[query] == 4
+    #Each caller gets its own copy
+    queries[0]["name"] = "modified"
+    assert query_cache.get_query(client, query_ids[0])["name"] == "q0"
+
+
+def test_failure_not_kept(monkeypatch, source):
+    workspace, client = source
+    query_id = create_query(client, "q")["id"]
+    workspace.reset_stats()
+    get = client.get
+    entered = threading.Event()
+    release = threading.Event()
+    attempts = []
+
+    def failing_get(path, *args, **kwargs):
+        attempts.append(path)
+        entered.set()
+        release.wait()
+        raise requests.ConnectionError("injected failure")
+    monkeypatch.setattr(client, "get", failing_get)
+    query_cache = QueryCache()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(query_cache.get_query, client, query_id)
+        entered.wait()
+        #Waits for the call in flight instead of sending another one
+        second = executor.submit(query_cache.get_query, client, query_id)
+        time.sleep(0.1)
+        release.set()
+        for f in [first, second]:
+            with pytest.raises(requests.ConnectionError):
+                f.result()
+    assert len(attempts) == 1
+    #The failure isn't cached: the next call fetches the query again
+    monkeypatch.setattr(client, "get", get)
+    assert query_cache.get_query(client, query_id)["id"] == query_id
+    assert workspace.calls[query] == 1
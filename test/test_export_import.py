@@ -0,0 +1,117 @@
+import importlib
+import json
+import os
+import re
+
+import pytest
+
+from conftest import permissions, root, seed
+from dbsqlclone import export_dashboards, import_dashboards
+from dbsqlclone.utils import instrumentation
+from dbsqlclone.utils.bundle import DashboardBundle
+
+sql = "/api/2.0/preview/sql/"
+
+
+@pytest.fixture
+def configs(tmp_path, source, target):
+    export_config = tmp_path / "config_export.json"
+    export_config.write_text(json.dumps({"source": {"url": source[0].url, "token": "mock-token", "dashboard_tags": ["test"]}}))
+    import_config = tmp_path / "config_import.json"
+    import_config.write_text(json.dumps({"targets": [{"url": target[0].url, "token": "mock-token", "permissions": permissions,
+                                                      "endpoint_id": "endpoint-1"}]}))
+    return str(export_config), str(import_config)
+
+
+def get_exported_ids(output):
+    if output.endswith(".zip"):
+        with DashboardBundle(output) as bundle:
+            return sorted(bundle.get_dashboard_ids())
+    return sorted(re.fullmatch(r"dashboard-(.*)\.json", f).group(1) for f in os.listdir(output))
+
+
+def creates(workspace):
+    return workspace.calls[("POST", sql + "dashboards")] + workspace.calls[("POST", sql + "queries")]
+
+
+@pytest.mark.parametrize("output", ["dashboards", "dashboards.zip"])
+def test_round_trip(capsys, tmp_path, source, target, configs, output):
+    export_config, import_config = configs
+    output = str(tmp_path / output)
+    state_file = str(tmp_path / "state.json")
+    test_ids = seed(source[1], 3)
+    other_id = seed(source[1], 1, "other")[0]
+
+    #Ids and tags, without duplicates
+    assert export_dashboards.main(["--config_file", export_config, "--tags", "test", "--ids", other_id, test_ids[0], "--output", output]) == 0
+    assert get_exported_ids(output) == sorted(test_ids + [other_id])
+    assert "exported 4/4 dashboards (0 failed)" in capsys.readouterr().out
+
+    target_workspace, target_client = target
+    assert import_dashboards.main(["--config_file", import_config, "--input", output, "--tags", "test", "--state_file", state_file]) == 0
+    assert f"imported to {target_workspace.url} 3/3 dashboards (0 failed)" in capsys.readouterr().out
+    with open(state_file, "r") as r:
+        state = json.load(r)[target_workspace.url]
+    assert sorted(state) == sorted(test_ids)
+    assert sorted(s["new_id"] for s in state.values()) == sorted(target_workspace.dashboards)
+    assert sorted(d["name"] for d in target_workspace.dashboards.values()) == \
+           sorted(d["name"] for d in source[0].dashboards.values() if d["id"] in test_ids)
+
+    #With the state: the dashboards are updated instead of being created again
+    target_workspace.reset_stats()
+    assert import_dashboards.main(["--config_file", import_config, "--input", output, "--tags", "test", "--state_file", state_file]) == 0
+    assert creates(target_workspace) == 0
+    assert len(target_workspace.dashboards) == 3
+
+    target_workspace.reset_stats()
+    assert import_dashboards.main(["--config_file", import_config, "--input", output, "--ids", other_id, "--state_file", state_file]) == 0
+    assert target_workspace.calls[("POST", sql + "dashboards")] == 1
+    with open(state_file, "r") as r:
+        assert sorted(json.load(r)[target_workspace.url]) == sorted(test_ids + [other_id])
+
+
+def test_import_files(capsys, tmp_path, source, target, configs):
+    export_config, import_config = configs
+    output = str(tmp_path / "dashboards")
+    ids = seed(source[1], 2)
+    #The dashboard_tags of the configuration
+    assert export_dashboards.main(["--config_file", export_config, "--output", output]) == 0
+    assert get_exported_ids(output) == sorted(ids)
+
+    target_workspace, target_client = target
+    assert import_dashboards.main(["--config_file", import_config, "--files", os.path.join(output, f"dashboard-{ids[1]}*.json")]) == 0
+    assert len(target_workspace.dashboards) == 1
+    #A missing file fails the import, the others are imported
+    assert import_dashboards.main(["--config_file", import_config, "--input", output, "--ids", ids[0], "missing"]) == 1
+    assert "dashboard-missing.json doesn't exist" in capsys.readouterr().out
+    assert len(target_workspace.dashboards) == 2
+
+
+def test_console_scripts():
+    with open(os.path.join(root, "setup.py"), "r") as r:
+        scripts = dict(re.findall(r'"([\w-]+)=([\w.:]+)"', r.read()))
+    assert sorted(scripts) == ["dbsqlclone-export", "dbsqlclone-import"]
+    for entry_point in scripts.values():
+        module, function = entry_point.split(":")
+        assert callable(getattr(importlib.import_module(module), function))
+
+
+def test_progress(capsys, source):
+    workspace, client = source
+    progress = instrumentation.add_hook(instrumentation.Progress("exported", 2, interval=3600))
+    try:
+        with client.get(sql + "queries") as r:
+            r.json()
+        with client.get(sql + "dashboards/missing") as r:
+            r.json()
+        progress.done("d1")
+        assert capsys.readouterr().out == ""
+        progress.done("d2", Exception("failure"))
+    finally:
+        instrumentation.remove_hook(progress)
+    #Printed at the end even if the interval isn't over
+    out = capsys.readouterr().out
+    assert "ERROR - dashboard d2 couldn't be exported: failure" in out
+    assert "exported 2/2 dashboards (1 failed)" in out
+    report = progress.get_report()
+    assert (report["completed"], report["failed"], report["requests"], report["request_errors"]) == (2, 1, 2, 1)
@@ -0,0 +1,94 @@
+import collections
+import json
+
+import pytest
+
+from conftest import seed
+from dbsqlclone.utils import clone_dashboard, instrumentation
+from dbsqlclone.utils.instrumentation import Metrics, percentile
+
+sql = "/api/2.0/preview/sql/"
+
+
+@pytest.fixture
+def metrics():
+    metrics = instrumentation.add_hook(Metrics())
+    yield metrics
+    instrumentation.remove_hook(metrics)
+
+
+def request_event(latency, status = 200, attempt = 0, wait = 0):
+    return {"method": "GET", "endpoint": sql + "queries/{id}", "path": sql + "queries/1", "status": status, "start": 1,
+            "latency": latency, "wait": wait, "attempt": attempt, "bytes_sent": 10, "bytes_received": 100, "thread": 1}
+
+
+def test_percentiles():
+    assert percentile([], 50) == 0
+    assert percentile([3], 95) == 3
+    metrics = Metrics()
+    for latency in reversed(range(1, 101)):
+        metrics.on_request(request_event(latency / 1000, 500 if latency > 98 else 200, 1 if latency > 99 else 0, 0.5))
+    endpoint = metrics.get_summary()["endpoints"]["GET " + sql + "queries/{id}"]
+    assert (endpoint["count"], endpoint["errors"], endpoint["retries"]) == (100, 2, 1)
+    assert (endpoint["p50"], endpoint["p95"], endpoint["max"]) == (0.05, 0.095, 0.1)
+    assert endpoint["wait"] == 50
+    assert (endpoint["bytes_sent"], endpoint["bytes_received"]) == (1000, 10000)
+
+
+def test_clone_metrics(tmp_path, source, target, metrics):
+    source_workspace, source_client = source
+    target_workspace, target_client = target
+    seed(source_client, 2)
+    source_workspace.reset_stats()
+    target_workspace.reset_stats()
+    metrics.requests.clear()
+    #Retried calls
+    target_workspace.inject("POST", sql + "visualizations", 429, count=2, headers={"Retry-After": "0"})
+    source_workspace.inject("GET", sql + "queries/{id}", 503, headers={"Retry-After": "0"})
+    failures = clone_dashboard.delete_and_clone_dashboards_with_tags_to_targets(source_client, [target_client], ["test"], False, {},
+                                                                                state_file=str(tmp_path / "state.json"))
+    assert failures == {target_client.url: []}
+
+    summary = metrics.get_summary()
+    calls = source_workspace.calls + target_workspace.calls
+    #Each call the mocks received is counted once, retries included
+    assert {endpoint: e["count"] for endpoint, e in summary["endpoints"].items()} == \
+           {f"{method} {path}": count for (method, path), count in calls.items()}
+    assert summary["requests"] == sum(calls.values())
+    visualizations = summary["endpoints"]["POST " + sql + "visualizations"]
+    assert (visualizations["errors"], visualizations["retries"]) == (2, 2)
+    queries = summary["endpoints"]["GET " + sql + "queries/{id}"]
+    assert (queries["errors"], queries["retries"]) == (1, 1)
+    assert all(e["p50"] <= e["p95"] <= e["max"] for e in summary["endpoints"].values())
+    #Requests tagged with the workspace and the phase which sent them
+    workspaces = collections.Counter(r["workspace"] for r in metrics.requests)
+    assert workspaces == {source_workspace.url: sum(source_workspace.calls.values()), target_workspace.url: sum(target_workspace.calls.values())}
+    assert all(r["phase"] == "dump" for r in metrics.requests if r["endpoint"] == sql + "dashboards/{id}" and r["method"] == "GET")
+    assert {"dump", "query", "dashboard", "widgets"} <= set(summary["phases"])
+
+
+def test_trace(tmp_path, target, metrics):
+    workspace, client = target
+    workspace.reset_stats()
+    seed(client, 1)
+    trace_file = str(tmp_path / "trace.json")
+    metrics.save_trace(trace_file)
+    with open(trace_file, "r") as r:
+        trace = json.load(r)
+    events = trace["traceEvents"]
+    assert trace["displayTimeUnit"] == "ms"
+    #Complete events sorted by start time, in microseconds
+    assert [e["ts"] for e in events] == sorted(e["ts"] for e in events)
+    for e in events:
+        assert e["ph"] == "X" and e["pid"] == 1
+        assert isinstance(e["ts"], int) and isinstance(e["dur"], int) and e["dur"] >= 0
+        assert isinstance(e["tid"], int)
+    requests = [e for e in events if e["cat"] == "request"]
+    assert len(requests) == len(metrics.requests) == sum(workspace.calls.values())
+    assert all(e["name"] == f"{e['args']['method']} {e['args']['endpoint']}" for e in requests)
+    phases = [e for e in events if e["cat"] == "phase"]
+    assert {"query", "dashboard"} <= set(e["name"] for e in phases)
+    #The requests of a dashboard are within its phase
+    dashboard = next(e for e in phases if e["name"] == "dashboard")
+    create = next(e for e in requests if e["name"] == "POST " + sql + "dashboards")
+    assert dashboard["ts"] <= create["ts"] and create["ts"] + create["dur"] <= dashboard["ts"] + dashboard["dur"] + 2
@@ -0,0 +1,94 @@
+import collections
+import copy
+import threading
+import time
+
+from conftest import get_fixtures, without_default_table
+from mock_server import MockWorkspace
+from dbsqlclone.utils import load_dashboard
+
+
+def track_visualizations(monkeypatch):
+    """Records the creations of each target query, and the max number of creations in flight for a single query."""
+    lock = threading.Lock()
+    running = collections.Counter()
+    created = collections.defaultdict(list)
+    max_running = collections.Counter()
+    create_visualization = load_dashboard.create_visualization
+
+    def tracked(client, v, target_query_id):
+        with lock:
+            running[target_query_id] += 1
+            max_running[target_query_id] = max(max_running[target_query_id], running[target_query_id])
+            created[target_query_id].append(v["id"])
+        try:
+            time.sleep(0.02)
+            return create_visualization(client, v, target_query_id)
+        finally:
+            with lock:
+                running[target_query_id] -= 1
+    monkeypatch.setattr(load_dashboard, "create_visualization", tracked)
+    return created, max_running
+
+
+def test_concurrent_visualizations(monkeypatch, target):
+    workspace, client = target
+    created, max_running = track_visualizations(monkeypatch)
+    dashboard = get_fixtures()[1]
+    state = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    assert max(max_running.values()) > 1
+    for q in dashboard["queries"]:
+        #Mapped in the order of the source ids (after the default table) whatever the order of the creations
+        ids = [load_dashboard.get_first_vis(q)["id"]] + sorted(v["id"] for v in q["visualizations"])
+        assert list(state["queries"][q["id"]]["visualizations"]) == list(dict.fromkeys(ids))
+
+
+def test_ordered_visualizations(monkeypatch, target):
+    workspace, client = target
+    monkeypatch.setattr(load_dashboard, "ordered_visualizations", True)
+    created, max_running = track_visualizations(monkeypatch)
+    dashboard = get_fixtures()[1]
+    load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    assert max(max_running.values()) == 1
+    for ids in created.values():
+        assert ids == sorted(ids)
+
+
+def test_rejected_permissions(monkeypatch, target):
+    workspace, client = target
+    route = MockWorkspace.route
+
+    def forbidden_route(self, method, path, params, body):
+        if method == "POST" and path.startswith("/api/2.0/preview/sql/permissions/"):
+            return 403, {"error_code": "PERMISSION_DENIED", "message": "injected failure"}
+        return route(self, method, path, params, body)
+    monkeypatch.setattr(MockWorkspace, "route", forbidden_route)
+    dashboard = get_fixtures()[1]
+    state = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    #The dashboard is cloned, but the rejected ACLs aren't saved as applied
+    assert "permissions_hash" not in state
+    assert all("permissions_hash" not in q for q in state["queries"].values())
+    assert workspace.permissions == {}
+
+    #The next run sends them again
+    monkeypatch.setattr(MockWorkspace, "route", route)
+    workspace.reset_stats()
+    state = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, state)
+    assert workspace.calls[("POST", "/api/2.0/preview/sql/permissions/dashboards/{id}")] == 1
+    assert workspace.calls[("POST", "/api/2.0/preview/sql/permissions/queries/{id}")] == len(dashboard["queries"])
+    assert state["permissions_hash"] == load_dashboard.get_permissions_hash(client)
+    assert all(q["permissions_hash"] == state["permissions_hash"] for q in state["queries"].values())
+
+
+def test_without_default_table(monkeypatch, target):
+    workspace, client = target
+    without_default_table(monkeypatch)
+    dashboard = get_fixtures()[1]
+    state = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    #The default table is created like the other visualizations
+    assert workspace.calls[("POST", "/api/2.0/preview/sql/visualizations/{id}")] == 0
+    assert workspace.calls[("POST", "/api/2.0/preview/sql/visualizations")] == sum(len(q["visualizations"]) for q in dashboard["queries"])
+    for q in dashboard["queries"]:
+        visualizations = state["queries"][q["id"]]["visualizations"]
+        assert sorted(visualizations) == sorted(v["id"] for v in q["visualizations"])
+        assert all(workspace.visualizations[target_id]["query_id"] == state["queries"][q["id"]]["new_id"] for target_id in visualizations.values())
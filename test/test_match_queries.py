@@ -0,0 +1,58 @@
+import copy
+
+from conftest import get_fixtures
+from dbsqlclone.utils import load_dashboard
+from dbsqlclone.utils.load_dashboard import match_queries
+
+
+def query(id, name, text = "SELECT 1"):
+    return {"id": id, "name": name, "query": text}
+
+
+def test_same_query_text_preferred():
+    queries = [query("s1", "Users", "SELECT * FROM users"), query("s2", "Users", "SELECT count(*) FROM users")]
+    existing = [query("t1", "Users", "SELECT count(*)\n  FROM users"), query("t2", "Users", "SELECT * FROM users")]
+    #The formatting of the query text is ignored
+    assert match_queries(queries, existing) == ({"s1": {"new_id": "t2"}, "s2": {"new_id": "t1"}}, [])
+
+
+def test_duplicated_names_matched_in_order():
+    queries = [query("s1", "Users", "SELECT 1"), query("s2", "Users", "SELECT 2"), query("s3", "Users", "SELECT 3")]
+    existing = [query("t1", "Users", "SELECT 4"), query("t2", "Users", "SELECT 5")]
+    #Each target query is matched once
+    assert match_queries(queries, existing) == ({"s1": {"new_id": "t1"}, "s2": {"new_id": "t2"}}, [])
+
+
+def test_name_fallback_after_text():
+    queries = [query("s1", "Users", "SELECT 1"), query("s2", "Users", "SELECT 2")]
+    existing = [query("t1", "Users", "SELECT 2"), query("t2", "Users", "SELECT 3")]
+    #s2 gets the target with the same text even if s1 comes first
+    assert match_queries(queries, existing) == ({"s2": {"new_id": "t1"}, "s1": {"new_id": "t2"}}, [])
+
+
+def test_not_matching():
+    queries = [query("s1", "Users"), query("s2", "Groups")]
+    existing = [query("t1", "Groups"), query("t2", "Tables"), query("t3", "Groups")]
+    state, not_matching = match_queries(queries, existing)
+    assert state == {"s2": {"new_id": "t1"}}
+    assert [q["id"] for q in not_matching] == ["t2", "t3"]
+
+
+def test_recreate_workspace_state(target):
+    workspace, client = target
+    dashboards = [d for d in get_fixtures() if d["id"] != "317f4809-8d9d-4956-a79a-6eee51412217"]
+    states = {d["id"]: load_dashboard.clone_dashboard(copy.deepcopy(d), client, {}) for d in dashboards}
+    #A query of a target widget which isn't in the source dashboard anymore
+    dashboard = dashboards[0]
+    removed = next(w["visualization"]["query"]["id"] for w in dashboard["dashboard"]["widgets"] if "visualization" in w)
+    stale = states[dashboard["id"]]["queries"][removed]["new_id"]
+    dashboard["queries"] = [q for q in dashboard["queries"] if q["id"] != removed]
+
+    workspace.reset_stats()
+    workspace_state, not_matching = load_dashboard.recreate_workspace_state(client, dashboards, {d: s["new_id"] for d, s in states.items()})
+    for d in dashboards:
+        assert workspace_state[d["id"]]["new_id"] == states[d["id"]]["new_id"]
+        assert workspace_state[d["id"]]["queries"] == {q["id"]: {"new_id": states[d["id"]]["queries"][q["id"]]["new_id"]} for q in d["queries"]}
+    assert [q["id"] for q in not_matching] == [stale]
+    #The target queries are listed, not fetched one by one
+    assert workspace.calls[("GET", "/api/2.0/preview/sql/queries/{id}")] == 0
@@ -0,0 +1,88 @@
+import pytest
+
+from mock_server import MockWorkspace
+from dbsqlclone.utils import clone_dashboard
+
+listing = "/api/2.0/preview/sql/dashboards"
+
+
+@pytest.fixture
+def listings(monkeypatch):
+    """Params of every listing request."""
+    requests = []
+    route = MockWorkspace.route
+
+    def recording_route(self, method, path, params, body):
+        if method == "GET" and path == listing:
+            requests.append(params)
+        return route(self, method, path, params, body)
+    monkeypatch.setattr(MockWorkspace, "route", recording_route)
+    return requests
+
+
+def create_dashboards(client, count, tags = ["test"]):
+    ids = []
+    for i in range(count):
+        with client.post(listing, json={"name": f"dashboard {i}", "tags": tags}) as r:
+            ids.append(r.json()["id"])
+    return ids
+
+
+def pages(listings):
+    return sorted(int(params["page"]) for params in listings)
+
+
+@pytest.mark.parametrize("count, expected_pages", [(0, [1]), (1, [1]), (6, [1, 2, 3]), (7, [1, 2, 3, 4]), (13, list(range(1, 8)))])
+def test_page_count(monkeypatch, listings, source, count, expected_pages):
+    workspace, client = source
+    monkeypatch.setattr(clone_dashboard, "page_size", 2)
+    ids = create_dashboards(client, count)
+    assert sorted(d["id"] for d in clone_dashboard.iter_pages(client, "dashboards")) == sorted(ids)
+    #Never past the last page, even when the count is a multiple of the page size
+    assert pages(listings) == expected_pages
+
+
+def test_smaller_server_pages(monkeypatch, listings, source):
+    workspace, client = source
+    workspace.max_page_size = 2
+    monkeypatch.setattr(clone_dashboard, "page_size", 4)
+    ids = create_dashboards(client, 5)
+    assert sorted(d["id"] for d in clone_dashboard.iter_pages(client, "dashboards")) == sorted(ids)
+    #The pages are counted with the size returned by the server
+    assert pages(listings) == [1, 2, 3]
+    assert all(params["page_size"] == "4" for params in listings)
+
+
+def test_stop_at_short_page(monkeypatch, listings, source):
+    workspace, client = source
+    monkeypatch.setattr(clone_dashboard, "page_size", 2)
+    ids = create_dashboards(client, 5)
+    route = MockWorkspace.route
+
+    def wrong_count_route(self, method, path, params, body):
+        status, response = route(self, method, path, params, body)
+        if method == "GET" and path == listing:
+            if int(params["page"]) > 3:
+                #Must not be read after the short page
+                return 200, {"count": 100, "page_size": 2, "results": [{"id": f"extra-{params['page']}", "tags": ["test"]}] * 2}
+            response["count"] = 100
+        return status, response
+    monkeypatch.setattr(MockWorkspace, "route", wrong_count_route)
+    assert sorted(d["id"] for d in clone_dashboard.iter_pages(client, "dashboards")) == sorted(ids)
+    #Page 3 has a single dashboard: the listing stops there, with at most the prefetched pages requested after it
+    assert max(pages(listings)) <= 3 + clone_dashboard.prefetch_pages
+
+
+def test_single_tag_filtered_by_api(listings, source):
+    workspace, client = source
+    a = create_dashboards(client, 2, ["a"])
+    b = create_dashboards(client, 2, ["b"])
+    create_dashboards(client, 2, ["c"])
+    assert sorted(d["id"] for d in clone_dashboard.iter_all_dashboards(client, ["a"])) == sorted(a)
+    assert listings[-1]["tags"] == "a"
+    #The API filters on all the tags: multiple tags are listed without filter and filtered locally
+    assert sorted(d["id"] for d in clone_dashboard.iter_all_dashboards(client, ["a", "b"])) == sorted(a + b)
+    assert "tags" not in listings[-1]
+    listings.clear()
+    assert list(clone_dashboard.iter_all_dashboards(client, [])) == []
+    assert listings == []
@@ -0,0 +1,102 @@
+import copy
+import threading
+import time
+
+from conftest import get_fixtures
+from dbsqlclone.utils import load_dashboard
+from dbsqlclone.utils.load_dashboard import get_param_query_task_key
+
+submit = ("POST", "/api/2.1/jobs/runs/submit")
+
+
+def get_param_dashboard():
+    """Fixture dashboard whose 2 first queries are param queries, the second one using the first, and the third one using the second."""
+    dashboard = copy.deepcopy(get_fixtures()[1])
+    p1, p2, q = dashboard["queries"][:3]
+    p1["is_parameter_query"] = True
+    p2["is_parameter_query"] = True
+    p2["options"]["parameters"] = [{"name": "p1", "type": "query", "queryId": p1["id"]}]
+    q["options"]["parameters"] = [{"name": "p2", "type": "query", "queryId": p2["id"]}]
+    return dashboard, p1, p2, q
+
+
+def test_single_run_per_batch(monkeypatch, target):
+    workspace, client = target
+    monkeypatch.setattr(load_dashboard, "warmup_batch_delay", 0.5)
+    dashboard, p1, p2, q = get_param_dashboard()
+    states = [None, None]
+
+    def clone(i):
+        states[i] = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    threads = [threading.Thread(target=clone, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    #Both dashboards submitted their param queries within the batch window
+    assert workspace.calls[submit] == 1
+    tasks = {task["task_key"]: task for task in next(iter(workspace.runs.values()))["tasks"]}
+    assert len(tasks) == 4
+    for state in states:
+        p1_key = get_param_query_task_key(state["queries"][p1["id"]]["new_id"])
+        p2_key = get_param_query_task_key(state["queries"][p2["id"]]["new_id"])
+        #Each task only waits for the param queries of its own dashboard
+        assert "depends_on" not in tasks[p1_key]
+        assert tasks[p2_key]["depends_on"] == [{"task_key": p1_key}]
+        target_query = workspace.queries[state["queries"][q["id"]]["new_id"]]
+        assert target_query["options"]["parameters"][0]["queryId"] == state["queries"][p2["id"]]["new_id"]
+
+    #Nothing changed: the param queries already have their results
+    workspace.reset_stats()
+    load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, states[0])
+    assert workspace.calls[submit] == 0
+
+
+def test_batches_after_window(monkeypatch, target):
+    workspace, client = target
+    dashboard = get_param_dashboard()[0]
+    load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    #Submitted after the first run: a new batch
+    assert workspace.calls[submit] == 2
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_run_timeout(monkeypatch, target):
+    workspace, client = target
+    workspace.run_duration = 3600
+    clock = FakeClock()
+    monkeypatch.setattr(load_dashboard, "time", clock)
+    monkeypatch.setattr(load_dashboard, "warmup_timeout", 120)
+    task = {"task_key": "run_param_query_1", "depends_on": [], "sql_task": {"query": {"query_id": "1"}, "warehouse_id": "endpoint-1"}}
+    assert load_dashboard.run_param_queries_job(client, [task]) is False
+    #The polling interval grows from 2s, up to 30s, and stops before the deadline
+    assert clock.sleeps[:3] == [2, 3, 4.5]
+    assert max(clock.sleeps) == 30
+    assert all(b == min(a * 1.5, 30) for a, b in zip(clock.sleeps, clock.sleeps[1:]))
+    assert sum(clock.sleeps) <= 120
+    assert workspace.calls[("GET", "/api/2.1/jobs/runs/get")] == len(clock.sleeps) + 1
+
+
+def test_clone_with_run_timeout(monkeypatch, target):
+    workspace, client = target
+    workspace.run_duration = 3600
+    monkeypatch.setattr(load_dashboard, "warmup_timeout", 1)
+    dashboard, p1, p2, q = get_param_dashboard()
+    start = time.monotonic()
+    state = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    #The run never ends: the clone goes on at the deadline instead of waiting for it
+    assert time.monotonic() - start < 5
+    assert state["queries"][q["id"]]["new_id"] in workspace.queries
@@ -0,0 +1,108 @@
+import collections
+import json
+import runpy
+import sys
+
+from conftest import seed, permissions
+from dbsqlclone.utils import clone_dashboard, planner
+
+sql = "/api/2.0/preview/sql/"
+#Request sent by each planned operation
+endpoints = {
+    ("query", "create"): ("POST", sql + "queries"),
+    ("query", "update"): ("POST", sql + "queries/{id}"),
+    ("query", "delete"): ("DELETE", sql + "queries/{id}"),
+    ("visualization", "create"): ("POST", sql + "visualizations"),
+    ("visualization", "update"): ("POST", sql + "visualizations/{id}"),
+    ("visualization", "delete"): ("DELETE", sql + "visualizations/{id}"),
+    ("query_permissions", "set"): ("POST", sql + "permissions/queries/{id}"),
+    ("warmup", "run"): ("POST", "/api/2.1/jobs/runs/submit"),
+    ("dashboard", "create"): ("POST", sql + "dashboards"),
+    ("dashboard", "update"): ("POST", sql + "dashboards/{id}"),
+    ("dashboard", "delete"): ("DELETE", sql + "dashboards/{id}"),
+    ("dashboard_permissions", "set"): ("POST", sql + "permissions/dashboards/{id}"),
+    ("widget", "create"): ("POST", sql + "widgets"),
+    ("widget", "update"): ("POST", sql + "widgets/{id}"),
+    ("widget", "delete"): ("DELETE", sql + "widgets/{id}"),
+}
+
+
+def planned_writes(target_plan):
+    writes = collections.Counter()
+    for operation in target_plan["operations"]:
+        if operation["calls"] > 0:
+            writes[endpoints[(operation["type"], operation["action"])]] += operation["calls"]
+    return writes
+
+
+def writes(workspace):
+    return collections.Counter({call: count for call, count in workspace.calls.items() if call[0] != "GET"})
+
+
+def run_clone_resources(monkeypatch, tmp_path, source, target, *args):
+    config = {"source": {"url": source[0].url, "token": "mock-token", "dashboard_tags": ["test"]},
+              "targets": [{"url": target[0].url, "token": "mock-token", "permissions": permissions, "endpoint_id": "endpoint-1"}],
+              "delete_target_dashboards": False}
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    monkeypatch.setattr(sys, "argv", ["clone_resources.py", "--config_file", str(tmp_path / "config.json"),
+                                      "--state_file", str(tmp_path / "state.json"), *args])
+    for workspace, _ in [source, target]:
+        workspace.reset_stats()
+    try:
+        runpy.run_module("dbsqlclone.clone_resources", run_name="__main__")
+    except SystemExit as e:
+        assert e.code in (None, 0)
+
+
+def test_plan_and_execute(monkeypatch, tmp_path, source, target):
+    seed(source[1], 2)
+    plan_file = str(tmp_path / "plan.json")
+    run_clone_resources(monkeypatch, tmp_path, source, target, "--plan", plan_file)
+    #Dry run: nothing is written in the workspaces
+    assert writes(source[0]) == {} and writes(target[0]) == {}
+    target_plan = planner.load_plan(plan_file)["targets"][target[0].url]
+    expected = planned_writes(target_plan)
+    assert sum(expected.values()) == target_plan["summary"]["writes"] > 0
+    run_clone_resources(monkeypatch, tmp_path, source, target, "--execute_plan", plan_file)
+    assert writes(target[0]) == expected
+
+    #A source query is renamed: only this query is updated
+    workspace_state = json.loads((tmp_path / "state.json").read_text())[clone_dashboard.get_workspace_state_id(source[1], target[1])]
+    query_id = next(iter(next(iter(workspace_state.values()))["queries"]))
+    with source[1].post(sql + "queries/" + query_id, json={"name": "renamed"}) as r:
+        r.json()
+    run_clone_resources(monkeypatch, tmp_path, source, target, "--plan", plan_file)
+    target_plan = planner.load_plan(plan_file)["targets"][target[0].url]
+    assert planned_writes(target_plan) == {("POST", sql + "queries/{id}"): 1}
+    run_clone_resources(monkeypatch, tmp_path, source, target, "--execute_plan", plan_file)
+    assert writes(target[0]) == {("POST", sql + "queries/{id}"): 1}
+
+    #Nothing changed since the previous run
+    run_clone_resources(monkeypatch, tmp_path, source, target, "--plan", plan_file)
+    target_plan = planner.load_plan(plan_file)["targets"][target[0].url]
+    assert target_plan["summary"]["writes"] == 0
+    assert all(o["action"] == "skip" for o in target_plan["operations"])
+    run_clone_resources(monkeypatch, tmp_path, source, target, "--execute_plan", plan_file)
+    assert writes(target[0]) == {}
+
+
+def test_plan_cleanup(tmp_path, source, target):
+    source_workspace, source_client = source
+    target_workspace, target_client = target
+    seed(source_client, 1)
+    #Left in the target by a previous clone
+    stale_ids = seed(target_client, 1)
+    source_workspace.reset_stats()
+    target_workspace.reset_stats()
+    plan = planner.plan_dashboards_with_tags(source_client, [target_client], ["test"], True, {})
+    assert writes(source_workspace) == {} and writes(target_workspace) == {}
+    target_plan = plan["targets"][target_client.url]
+    cleanup = [o for o in target_plan["operations"] if o["id"].startswith("cleanup/")]
+    assert [o["target_id"] for o in cleanup if o["type"] == "dashboard"] == stale_ids
+    #The cleanup starts once all the dashboards are loaded
+    assert all(o["depends_on"] == ["loaded"] for o in cleanup)
+
+    failures = clone_dashboard.delete_and_clone_dashboards_with_tags_to_targets(source_client, [target_client], ["test"], True, {},
+                                                                                state_file=str(tmp_path / "state.json"), plan=plan)
+    assert failures == {target_client.url: []}
+    assert writes(target_workspace) == planned_writes(target_plan)
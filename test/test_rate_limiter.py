@@ -0,0 +1,131 @@
+import time
+
+import pytest
+import requests
+
+from dbsqlclone.utils import rate_limiter
+from dbsqlclone.utils.rate_limiter import RateLimiter
+
+queries = "/api/2.0/preview/sql/queries"
+query = "/api/2.0/preview/sql/queries/{id}"
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "max_backoff", 0.05)
+
+
+def test_throttled_halves():
+    limiter = RateLimiter(rate=20, burst=20, max_concurrency=8, max_rate=100)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert (limiter.rate, limiter.concurrency) == (10, 4)
+    #The requests in flight at the same time are throttled together: a single decrease per second
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert (limiter.rate, limiter.concurrency, limiter.throttled) == (10, 4, 2)
+
+
+def test_growth_above_initial_rate():
+    limiter = RateLimiter(rate=20, burst=1000, max_concurrency=4, max_rate=22)
+    limiter.concurrency = 2
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release()
+    #A window of successes (one per allowed request in flight) adds one request and one request/sec
+    assert (limiter.rate, limiter.concurrency) == (21, 3)
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release()
+    #Probes above the initial rate, up to max_rate
+    assert (limiter.rate, limiter.concurrency) == (22, 4)
+
+
+def test_token_bucket():
+    limiter = RateLimiter(rate=20, burst=1, max_concurrency=4, max_rate=20)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release()
+    assert time.monotonic() - start >= 4 / 20 * 0.9
+
+
+def test_pause():
+    limiter = RateLimiter(rate=1000, burst=1000, max_concurrency=4, max_rate=1000)
+    limiter.pause(0.2)
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.15
+
+
+def test_retry_after_capped(source):
+    workspace, client = source
+    workspace.inject("GET", queries, 429, headers={"Retry-After": "100"})
+    rate = client.rate_limiter.rate
+    start = time.monotonic()
+    with client.get(queries) as r:
+        assert r.status_code == 200
+    #Waited max_backoff instead of the Retry-After
+    assert time.monotonic() - start < 1
+    assert workspace.calls[("GET", queries)] == 2
+    assert client.rate_limiter.rate == rate / 2
+    assert client.rate_limiter.throttled == 1
+
+
+@pytest.mark.parametrize("method, path, status", [("POST", queries, 429), ("POST", queries, 503), ("DELETE", query, 429),
+                                                  ("GET", queries, 503)])
+def test_always_retried(source, method, path, status):
+    workspace, client = source
+    with client.post(queries, json={"name": "q", "query": "SELECT 1"}) as r:
+        query_id = r.json()["id"]
+    workspace.inject(method, path, status, count=2)
+    with client.request(method, path.replace("{id}", query_id), json={"name": "q", "query": "SELECT 1"}) as r:
+        assert r.status_code == 200
+    assert workspace.calls[(method, path)] == (1 if (method, path) == ("POST", queries) else 0) + 3
+
+
+@pytest.mark.parametrize("method, retried", [("POST", False), ("GET", True), ("DELETE", True)])
+def test_server_errors(source, method, retried):
+    workspace, client = source
+    with client.post(queries, json={"name": "q", "query": "SELECT 1"}) as r:
+        query_id = r.json()["id"]
+    workspace.reset_stats()
+    workspace.inject(method, query, 500)
+    with client.request(method, query.replace("{id}", query_id), json={"name": "q"}) as r:
+        #Retrying a POST could create duplicates
+        assert r.status_code == (200 if retried else 500)
+    assert workspace.calls[(method, query)] == (2 if retried else 1)
+
+
+def test_max_retries(source):
+    workspace, client = source
+    client.max_retries = 2
+    workspace.inject("GET", queries, 429, count=10)
+    with client.get(queries) as r:
+        assert r.status_code == 429
+    assert workspace.calls[("GET", queries)] == 3
+
+
+@pytest.mark.parametrize("method, retried", [("POST", False), ("GET", True)])
+def test_connection_errors(monkeypatch, source, method, retried):
+    workspace, client = source
+    session_request = client.session.request
+    attempts = []
+
+    def failing_request(*args, **kwargs):
+        attempts.append(args)
+        if len(attempts) == 1:
+            raise requests.ConnectionError("injected failure")
+        return session_request(*args, **kwargs)
+    monkeypatch.setattr(client.session, "request", failing_request)
+    if retried:
+        with client.request(method, queries) as r:
+            assert r.status_code == 200
+        assert len(attempts) == 2
+    else:
+        with pytest.raises(requests.ConnectionError):
+            client.request(method, queries, json={"name": "q", "query": "SELECT 1"})
+        assert len(attempts) == 1
+    #The slot of the failed call is released
+    assert client.rate_limiter.in_flight == 0
+
@@ -0,0 +1,161 @@
+import copy
+
+import pytest
+
+from conftest import get_fixtures
+from mock_server import MockWorkspace
+from dbsqlclone.utils import load_dashboard
+from dbsqlclone.utils.load_dashboard import content_hash, get_visualization_changes, get_visualization_payload, get_widget_changes, \
+    get_widget_payload
+
+
+def vis(id, type = "COUNTER", name = "Counter", options = None):
+    return {"id": id, "type": type, "name": name, "description": "", "options": options or {}, "query_plan": None}
+
+
+def test_visualizations_matched_by_type_and_name():
+    query = {"id": "q", "visualizations": [vis("s1", name="Users"), vis("s2", name="Groups")]}
+    #t0 is the default table created with the target query
+    target_query = {"id": "tq", "visualizations": [vis("t0", "TABLE", "Table"), vis("t1", name="Groups"), vis("t2", name="Users")]}
+    mapping, to_update, to_create, to_delete = get_visualization_changes(query, target_query, {})
+    assert mapping == {"s1": "t2", "s2": "t1"}
+    assert (to_update, to_create, to_delete) == ([], [], [])
+
+
+def test_visualizations_matched_by_type():
+    s1, s2 = vis("s1", name="Users"), vis("s2", "CHART", "Bar")
+    query = {"id": "q", "visualizations": [s1, s2]}
+    target_query = {"id": "tq", "visualizations": [vis("t0", "TABLE", "Table"), vis("t1", name="Old name"), vis("t2", "PIVOT", "Pivot")]}
+    mapping, to_update, to_create, to_delete = get_visualization_changes(query, target_query, {})
+    assert mapping == {"s1": "t1"}
+    assert to_update == [(s1, "t1")]
+    assert to_create == [s2]
+    #The default table is never deleted
+    assert to_delete == ["t2"]
+
+
+def test_default_table_not_matched():
+    table = vis("s1", "TABLE", "Table")
+    query = {"id": "q", "visualizations": [table]}
+    target_query = {"id": "tq", "visualizations": [vis("t0", "TABLE", "Table")]}
+    assert get_visualization_changes(query, target_query, {}) == ({}, [], [table], [])
+    #Unless the state maps it
+    state = {"visualizations": {"s1": "t0"}, "visualization_hashes": {"s1": content_hash(get_visualization_payload(table, "tq"))}}
+    assert get_visualization_changes(query, target_query, state) == ({"s1": "t0"}, [], [], [])
+
+
+def test_visualizations_state_mapping():
+    s1 = vis("s1", name="Users", options={"color": "red"})
+    query = {"id": "q", "visualizations": [s1]}
+    #The state mapping wins over the name
+    target_query = {"id": "tq", "visualizations": [vis("t0", "TABLE", "Table"), vis("t1", name="Users"), vis("t2", name="Renamed")]}
+    state = {"visualizations": {"s1": "t2"}, "visualization_hashes": {"s1": content_hash(get_visualization_payload(s1, "tq"))}}
+    mapping, to_update, to_create, to_delete = get_visualization_changes(query, target_query, state)
+    assert mapping == {"s1": "t2"}
+    #Unchanged since the previous run according to the state hash, even if the target content differs
+    assert (to_update, to_create, to_delete) == ([], [], ["t1"])
+    state["visualization_hashes"]["s1"] = "previous"
+    assert get_visualization_changes(query, target_query, state)[1] == [(s1, "t2")]
+
+
+def widget(id, visualization_id = None, text = "", col = 0, width = 1):
+    w = {"id": id, "text": text, "width": width, "options": {"position": {"col": col, "row": 0}}}
+    if visualization_id is not None:
+        w["visualization"] = {"id": visualization_id, "query": {"id": "q"}}
+    return w
+
+
+def target_widget(id, visualization_id = None, text = "", col = 0, width = 1):
+    w = {"id": id, "text": text, "width": width, "options": {"position": {"col": col, "row": 0}}}
+    if visualization_id is not None:
+        w["visualization"] = {"id": visualization_id}
+    return w
+
+
+dashboard_state = {"queries": {"q": {"visualizations": {"v1": "tv1", "v2": "tv2"}}}}
+
+
+def test_widgets_matched_by_visualization_and_position():
+    dashboard = {"widgets": [widget("w1", "v1", col=0), widget("w2", "v1", col=3), widget("w3", text="# Title")]}
+    target = {"id": "td", "widgets": [target_widget("t1", "tv1", col=3), target_widget("t2", "tv1", col=0), target_widget("t3", text="# Title")]}
+    widgets, to_update, to_create, to_delete = get_widget_changes(dashboard, dashboard_state, target)
+    assert widgets == {"w1": "t2", "w2": "t1", "w3": "t3"}
+    assert (to_update, to_create, to_delete) == ([], [], [])
+
+
+def test_widgets_updated_or_recreated():
+    w1, w2, w3 = widget("w1", "v1", col=2), widget("w2", "v2"), widget("w3", text="# New title")
+    dashboard = {"widgets": [w1, w2, w3]}
+    #t1 only moved, t2 shows another visualization and t3 another text: they can't be updated in place
+    target = {"id": "td", "widgets": [target_widget("t1", "tv1"), target_widget("t2", "tv1", width=2), target_widget("t3", text="# Title")]}
+    widgets, to_update, to_create, to_delete = get_widget_changes(dashboard, dashboard_state, target)
+    assert widgets == {"w1": "t1"}
+    assert to_update == [(w1, "t1")]
+    assert to_create == [w2, w3]
+    assert sorted(to_delete) == ["t2", "t3"]
+
+
+def test_widgets_state_mapping():
+    w1 = widget("w1", "v1")
+    dashboard = {"widgets": [w1]}
+    target = {"id": "td", "widgets": [target_widget("t1", "tv1"), target_widget("t2", "tv1", col=5)]}
+    state = dict(dashboard_state, widgets={"w1": "t2"}, widget_hashes={"w1": content_hash(get_widget_payload(w1, dashboard_state, "td"))})
+    assert get_widget_changes(dashboard, state, target) == ({"w1": "t2"}, [], [], ["t1"])
+    #Changed since the previous run: updated in place as the visualization is the same
+    state["widget_hashes"]["w1"] = "previous"
+    assert get_widget_changes(dashboard, state, target) == ({"w1": "t2"}, [(w1, "t2")], [], ["t1"])
+
+
+def test_update_in_place(target):
+    workspace, client = target
+    dashboard = next(d for d in get_fixtures() if d["id"] == "19394330-2274-4b4b-90ce-d415a7ff2130")
+    state = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    widgets = dict(state["widgets"])
+
+    def writes():
+        return {call: count for call, count in workspace.calls.items() if call[0] != "GET"}
+
+    #No change: nothing is written to the target
+    workspace.reset_stats()
+    state = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, state)
+    assert writes() == {}
+
+    chart = next(v for q in dashboard["queries"] for v in q["visualizations"] if v["id"].startswith("104db01f"))
+    chart["options"]["legend"] = {"enabled": False}
+    moved = next(w for w in dashboard["dashboard"]["widgets"] if w["id"].startswith("3bc6c07f"))
+    moved["options"]["position"]["col"] = 2
+    removed = next(w for w in dashboard["dashboard"]["widgets"] if "visualization" not in w)
+    dashboard["dashboard"]["widgets"].remove(removed)
+    workspace.reset_stats()
+    state = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, state)
+    #Only the changed visualization and widget are updated, the removed widget is deleted
+    assert writes() == {("POST", "/api/2.0/preview/sql/visualizations/{id}"): 1,
+                        ("POST", "/api/2.0/preview/sql/widgets/{id}"): 1,
+                        ("DELETE", "/api/2.0/preview/sql/widgets/{id}"): 1}
+    assert workspace.widgets[widgets[moved["id"]]]["options"]["position"]["col"] == 2
+    assert widgets[removed["id"]] not in workspace.widgets
+    del widgets[removed["id"]]
+    assert state["widgets"] == widgets
+
+
+def test_rejected_update(monkeypatch, target):
+    workspace, client = target
+    dashboard = next(d for d in get_fixtures() if d["id"] == "19394330-2274-4b4b-90ce-d415a7ff2130")
+    state = load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, {})
+    chart = next(v for q in dashboard["queries"] for v in q["visualizations"] if v["id"].startswith("104db01f"))
+    chart["options"]["legend"] = {"enabled": False}
+    route = MockWorkspace.route
+
+    def rejecting_route(self, method, path, params, body):
+        if method == "POST" and path.startswith("/api/2.0/preview/sql/visualizations/"):
+            return 400, {"error_code": "BAD_REQUEST", "message": "injected failure"}
+        return route(self, method, path, params, body)
+    monkeypatch.setattr(MockWorkspace, "route", rejecting_route)
+    with pytest.raises(Exception, match="couldn't update visualization"):
+        load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, copy.deepcopy(state))
+
+    #The update is retried by the next run
+    monkeypatch.setattr(MockWorkspace, "route", route)
+    workspace.reset_stats()
+    load_dashboard.clone_dashboard(copy.deepcopy(dashboard), client, state)
+    assert workspace.calls[("POST", "/api/2.0/preview/sql/visualizations/{id}")] == 1
@@ -0,0 +1,181 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from conftest import get_fixtures
+from dbsqlclone.utils import load_dashboard, scheduler
+from dbsqlclone.utils.scheduler import Scheduler, Task
+
+
+def test_dependencies():
+    order = []
+    with Scheduler(2) as s:
+        a = Task(lambda: order.append("a") or "a", name="a")
+        b = Task(lambda: order.append("b") or a.result() + "b", [a], name="b")
+        s.submit([a, b])
+    assert b.result() == "ab"
+    assert order == ["a", "b"]
+
+
+def test_failed_dependency():
+    ran = []
+
+    def fail():
+        raise ValueError("failed")
+    with Scheduler(2) as s:
+        a = Task(fail, name="a")
+        b = Task(lambda: ran.append("b"), [a], name="b")
+        c = Task(lambda: ran.append("c"), [b], name="c")
+        s.submit([a, b, c])
+    #The dependents fail with the error of the dependency, without running
+    for task in [a, b, c]:
+        with pytest.raises(ValueError):
+            task.result()
+    assert ran == []
+
+
+def test_critical_path_first():
+    order = []
+    blocker = threading.Event()
+    with Scheduler(1) as s:
+        #Holds the only thread until the whole batch is submitted
+        s.submit([Task(lambda: blocker.wait(5), name="blocker")])
+        a1 = Task(lambda: order.append("a1"), name="a1")
+        a2 = Task(lambda: order.append("a2"), [a1], name="a2")
+        a3 = Task(lambda: order.append("a3"), [a2], name="a3")
+        b = Task(lambda: order.append("b"), name="b")
+        c = Task(lambda: order.append("c"), name="c")
+        s.submit([b, c, a1, a2, a3])
+        blocker.set()
+    assert order[:2] == ["a1", "a2"]
+    assert sorted(order) == ["a1", "a2", "a3", "b", "c"]
+
+
+def test_children():
+    release = threading.Event()
+    children = []
+    with Scheduler(2) as s:
+        def parent_fn():
+            children.extend(s.submit([Task(lambda: release.wait(5) and "child", name="child")]))
+            return "parent"
+        parent = s.submit([Task(parent_fn, name="parent")])[0]
+        time.sleep(0.1)
+        #The parent ran, but waits for its child
+        assert len(children) == 1
+        assert not parent.done()
+        release.set()
+    assert parent.result() == "parent"
+    assert children[0].result() == "child"
+
+
+def test_failed_child():
+    def fail():
+        raise ValueError("failed")
+    with Scheduler(2) as s:
+        parent = s.submit([Task(lambda: s.submit([Task(fail, name="child")]) and "parent", name="parent")])[0]
+    with pytest.raises(ValueError):
+        parent.result()
+
+
+def test_continuation():
+    future = Future()
+    with Scheduler(1) as s:
+        a = Task(lambda: future, name="a")
+        #Can only run if a doesn't hold the only thread while its future is pending
+        b = Task(lambda: future.set_result("done"), name="b")
+        s.submit([a, b])
+    assert a.result() == "done"
+
+
+def test_failed_continuation():
+    future = Future()
+    with Scheduler(1) as s:
+        a = Task(lambda: future, name="a")
+        b = Task(lambda: a.result(), [a], name="b")
+        s.submit([a, b, Task(lambda: future.set_exception(ValueError("failed")), name="c")])
+    for task in [a, b]:
+        with pytest.raises(ValueError):
+            task.result()
+
+
+class Concurrency():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max = 0
+
+    def run(self, fn):
+        with self.lock:
+            self.running += 1
+            self.max = max(self.max, self.running)
+        try:
+            return fn()
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def test_background_after_ready_tasks():
+    order = []
+    blocker = threading.Event()
+    with Scheduler(1) as s:
+        s.submit([Task(lambda: blocker.wait(5), name="blocker")])
+        s.submit([Task(lambda: order.append("background"), name="background", background=True),
+                  Task(lambda: order.append("a"), name="a"),
+                  Task(lambda: order.append("b"), name="b")])
+        blocker.set()
+    assert order == ["a", "b", "background"]
+
+
+def test_background_capped(monkeypatch):
+    monkeypatch.setattr(scheduler, "max_background_workers", 1)
+    concurrency = Concurrency()
+    release = threading.Event()
+    with Scheduler(3) as s:
+        foreground = s.submit([Task(lambda: release.wait(5), name="foreground")])[0]
+        background = s.submit([Task(lambda: concurrency.run(lambda: time.sleep(0.05)), name=f"background {i}", background=True)
+                               for i in range(4)])
+        for task in background:
+            task.result(timeout=5)
+        #The background tasks ran one at a time, while the foreground task was running
+        assert not foreground.done()
+        release.set()
+    assert concurrency.max == 1
+
+
+def test_background_uncapped_when_alone(monkeypatch):
+    monkeypatch.setattr(scheduler, "max_background_workers", 1)
+    concurrency = Concurrency()
+    barrier = threading.Barrier(3, timeout=5)
+    with Scheduler(3) as s:
+        background = s.submit([Task(lambda: concurrency.run(barrier.wait), name=f"background {i}", background=True) for i in range(3)])
+    for task in background:
+        task.result()
+    assert concurrency.max == 3
+
+
+def test_widgets_dont_wait_for_permissions(monkeypatch, target):
+    workspace, client = target
+    widget_created = threading.Event()
+    waited = []
+    create_widget = load_dashboard.create_widget
+    set_permissions = load_dashboard.set_permissions
+
+    def created(*args):
+        widget_created.set()
+        return create_widget(*args)
+
+    def slow_permissions(client, item, *args):
+        if item == "dashboards":
+            #Times out if the widgets wait for the dashboard permissions
+            waited.append(widget_created.wait(5))
+        return set_permissions(client, item, *args)
+    monkeypatch.setattr(load_dashboard, "create_widget", created)
+    monkeypatch.setattr(load_dashboard, "set_permissions", slow_permissions)
+    dashboard = get_fixtures()[0]
+    state = load_dashboard.clone_dashboard(dashboard, client, {})
+    assert waited == [True]
+    assert len(state["widgets"]) == len(dashboard["dashboard"]["widgets"])
+    assert state["permissions_hash"] == load_dashboard.get_permissions_hash(client)
@@ -0,0 +1,139 @@
+import json
+import os
+
+from conftest import seed
+from mock_server import MockWorkspace
+from dbsqlclone.utils import clone_dashboard, load_dashboard
+from dbsqlclone.utils.state_store import StateStore
+
+
+def test_replay(tmp_path):
+    state_file = str(tmp_path / "state.json")
+    store = StateStore(state_file)
+    assert store.load() == {}
+    journal = store.get_journal("ws", "d1")
+    journal.query("q1", {"new_id": "nq1"})
+    journal.new_dashboard("nd1")
+    store.get_journal("ws", "d2").dashboard({"new_id": "nd2", "queries": {}})
+    store.close()
+
+    store = StateStore(state_file)
+    state = store.load()
+    assert state == {"ws": {"d1": {"queries": {"q1": {"new_id": "nq1"}}, "new_id": "nd1"}, "d2": {"new_id": "nd2", "queries": {}}}}
+    #Only the dashboards fully cloned are completed
+    assert store.is_completed("ws", "d2")
+    assert not store.is_completed("ws", "d1")
+    assert not store.is_completed("other", "d2")
+
+
+def test_replay_on_state_file(tmp_path):
+    state_file = str(tmp_path / "state.json")
+    with open(state_file, "w") as w:
+        json.dump({"ws": {"d1": {"new_id": "nd1", "queries": {"q1": {"new_id": "nq1"}}}}}, w)
+    store = StateStore(state_file)
+    store.get_journal("ws", "d1").query("q2", {"new_id": "nq2"})
+    store.close()
+    assert StateStore(state_file).load() == {"ws": {"d1": {"new_id": "nd1", "queries": {"q1": {"new_id": "nq1"}, "q2": {"new_id": "nq2"}}}}}
+
+
+def test_truncated_journal(tmp_path):
+    state_file = str(tmp_path / "state.json")
+    store = StateStore(state_file)
+    store.get_journal("ws", "d1").query("q1", {"new_id": "nq1"})
+    store.close()
+    #Process killed while writing the last record
+    with open(state_file + ".journal", "a") as w:
+        w.write('{"workspace":"ws","dashboard":"d1","query":"q2","st')
+    assert StateStore(state_file).load() == {"ws": {"d1": {"queries": {"q1": {"new_id": "nq1"}}}}}
+
+
+def test_checkpoint(tmp_path):
+    state_file = str(tmp_path / "state.json")
+    store = StateStore(state_file)
+    store.get_journal("ws", "d1").dashboard({"new_id": "nd1"})
+    state = store.load()
+    store.checkpoint(state)
+    assert not os.path.exists(state_file + ".journal")
+    assert not store.is_completed("ws", "d1")
+    store.close()
+    with open(state_file, "r") as r:
+        assert json.load(r) == {"ws": {"d1": {"new_id": "nd1"}}}
+    assert StateStore(state_file).load() == state
+
+
+def test_resume(monkeypatch, tmp_path, source, target):
+    source_workspace, source_client = source
+    target_workspace, target_client = target
+    state_file = str(tmp_path / "state.json")
+    ids = seed(source_client, 3)
+    failing_id = ids[1]
+    failing_name = source_workspace.dashboards[failing_id]["name"]
+    route = MockWorkspace.route
+
+    def failing_route(self, method, path, params, body):
+        if self is target_workspace and method == "POST" and path == "/api/2.0/preview/sql/dashboards" and body.get("name") == failing_name:
+            return 400, {"error_code": "BAD_REQUEST", "message": "injected failure"}
+        return route(self, method, path, params, body)
+    monkeypatch.setattr(MockWorkspace, "route", failing_route)
+    failures = clone_dashboard.delete_and_clone_dashboards_with_tags_to_targets(source_client, [target_client], ["test"], False, None,
+                                                                                state_file=state_file)
+    assert [dashboard_id for dashboard_id, _ in failures[target_client.url]] == [failing_id]
+    #The journal is kept to resume the failed dashboard
+    assert os.path.exists(state_file + ".journal")
+    queries = len(target_workspace.queries)
+
+    monkeypatch.setattr(MockWorkspace, "route", route)
+    source_workspace.reset_stats()
+    target_workspace.reset_stats()
+    failures = clone_dashboard.delete_and_clone_dashboards_with_tags_to_targets(source_client, [target_client], ["test"], False, None,
+                                                                                state_file=state_file, resume=True)
+    assert failures[target_client.url] == []
+    #Only the failed dashboard is dumped and cloned again, its queries created by the first run are reused
+    assert source_workspace.calls[("GET", "/api/2.0/preview/sql/dashboards/{id}")] == 1
+    assert target_workspace.calls[("POST", "/api/2.0/preview/sql/dashboards")] == 1
+    assert target_workspace.calls[("POST", "/api/2.0/preview/sql/queries")] == 0
+    assert len(target_workspace.queries) == queries
+    assert not os.path.exists(state_file + ".journal")
+    with open(state_file, "r") as r:
+        state = json.load(r)
+    workspace_state = state[clone_dashboard.get_workspace_state_id(source_client, target_client)]
+    assert sorted(workspace_state) == sorted(ids)
+    assert sorted(d["new_id"] for d in workspace_state.values()) == sorted(target_workspace.dashboards)
+
+
+def test_resume_after_query_created(monkeypatch, tmp_path, source, target):
+    source_workspace, source_client = source
+    target_workspace, target_client = target
+    state_file = str(tmp_path / "state.json")
+    seed(source_client, 1)
+    create_visualization = load_dashboard.create_visualization
+
+    def failing_create_visualization(client, v, target_query_id):
+        raise Exception("injected failure")
+    #The run stops after the creation of the queries, before their visualizations
+    monkeypatch.setattr(load_dashboard, "create_visualization", failing_create_visualization)
+    failures = clone_dashboard.delete_and_clone_dashboards_with_tags_to_targets(source_client, [target_client], ["test"], False, None,
+                                                                                state_file=state_file)
+    assert len(failures[target_client.url]) == 1
+    queries = len(target_workspace.queries)
+    assert queries > 0
+
+    monkeypatch.setattr(load_dashboard, "create_visualization", create_visualization)
+    target_workspace.reset_stats()
+    failures = clone_dashboard.delete_and_clone_dashboards_with_tags_to_targets(source_client, [target_client], ["test"], False, None,
+                                                                                state_file=state_file, resume=True)
+    assert failures[target_client.url] == []
+    #The queries recorded by the journal are reused, with their default table
+    assert target_workspace.calls[("POST", "/api/2.0/preview/sql/queries")] == 0
+    assert len(target_workspace.queries) == queries
+    with open(state_file, "r") as r:
+        workspace_state = json.load(r)[clone_dashboard.get_workspace_state_id(source_client, target_client)]
+    dashboard_state = next(iter(workspace_state.values()))
+    assert len(dashboard_state["queries"]) == queries
+    for query_id, query_state in dashboard_state["queries"].items():
+        source_visualizations = [v["id"] for v in source_workspace.visualizations.values() if v["query_id"] == query_id]
+        target_visualizations = [v["id"] for v in target_workspace.visualizations.values() if v["query_id"] == query_state["new_id"]]
+        #No duplicated default table
+        assert len(target_visualizations) == len(source_visualizations)
+        assert sorted(query_state["visualizations"]) == sorted(source_visualizations)
+        assert sorted(query_state["visualizations"].values()) == sorted(target_visualizations)
@@ -0,0 +1,113 @@
+import copy
+
+import pytest
+
+from conftest import get_fixtures
+from dbsqlclone.utils import load_dashboard
+from dbsqlclone.utils.clone_dashboard import TargetIndex
+
+sql = "/api/2.0/preview/sql/"
+query = ("GET", sql + "queries/{id}")
+dashboard = ("GET", sql + "dashboards/{id}")
+query_acl = ("GET", sql + "permissions/queries/{id}")
+dashboard_acl = ("GET", sql + "permissions/dashboards/{id}")
+
+
+def writes(workspace):
+    return {call: count for call, count in workspace.calls.items() if call[0] != "GET"}
+
+
+@pytest.fixture
+def cloned(target):
+    """Fixture dashboard cloned in the target, with its state."""
+    workspace, client = target
+    definition = get_fixtures()[1]
+    state = load_dashboard.clone_dashboard(copy.deepcopy(definition), client, {})
+    workspace.reset_stats()
+    return definition, state
+
+
+def reload(client, definition, state, target_index):
+    return load_dashboard.clone_dashboard(copy.deepcopy(definition), client, copy.deepcopy(state), target_index=target_index)
+
+
+def test_unchanged_without_get(target, cloned):
+    workspace, client = target
+    definition, state = cloned
+    target_index = TargetIndex(client, {definition["id"]: state})
+    workspace.reset_stats()
+    reload(client, definition, state, target_index)
+    #The listing shows the same updated_at as the state: nothing is fetched nor written
+    assert workspace.calls[query] == 0 and workspace.calls[dashboard] == 0
+    assert writes(workspace) == {}
+
+    #Without the index, each object of the state is fetched
+    workspace.reset_stats()
+    reload(client, definition, state, None)
+    assert workspace.calls[query] == len(definition["queries"])
+    assert workspace.calls[dashboard] == 1
+    assert writes(workspace) == {}
+
+
+def test_updated_outside(target, cloned):
+    workspace, client = target
+    definition, state = cloned
+    query_id = state["queries"][definition["queries"][0]["id"]]["new_id"]
+    with client.post(sql + "queries/" + query_id, json={"description": "edited in the target"}) as r:
+        r.json()
+    target_index = TargetIndex(client, {definition["id"]: state})
+    workspace.reset_stats()
+    reload(client, definition, state, target_index)
+    #Only the query with another updated_at is fetched
+    assert workspace.calls[query] == 1
+    assert workspace.calls[dashboard] == 0
+
+
+def test_trashed_and_missing(target, cloned):
+    workspace, client = target
+    definition, state = cloned
+    trashed, missing = [state["queries"][q["id"]]["new_id"] for q in definition["queries"][:2]]
+    with client.delete(sql + "queries/" + trashed) as r:
+        r.json()
+    del workspace.queries[missing]
+    with client.delete(sql + "dashboards/" + state["new_id"]) as r:
+        r.json()
+    target_index = TargetIndex(client, {definition["id"]: state})
+    assert not target_index.exists("queries", trashed) and not target_index.exists("queries", missing)
+    workspace.reset_stats()
+    new_state = reload(client, definition, state, target_index)
+    #Re-created without fetching them first
+    assert workspace.calls[query] == 0 and workspace.calls[dashboard] == 0
+    assert workspace.calls[("POST", sql + "queries")] == 2
+    assert workspace.calls[("POST", sql + "dashboards")] == 1
+    for q in definition["queries"][:2]:
+        assert new_state["queries"][q["id"]]["new_id"] not in [trashed, missing]
+    assert new_state["new_id"] != state["new_id"]
+    assert new_state["new_id"] in workspace.dashboards
+
+
+def test_acl_prefetch(target, cloned):
+    workspace, client = target
+    definition, state = cloned
+    #State saved by a version without the permissions hash
+    del state["permissions_hash"]
+    for query_state in state["queries"].values():
+        del query_state["permissions_hash"]
+    target_index = TargetIndex(client, {definition["id"]: state})
+    #All the ACLs are fetched with the index
+    assert workspace.calls[query_acl] == len(definition["queries"])
+    assert workspace.calls[dashboard_acl] == 1
+    workspace.reset_stats()
+    new_state = reload(client, definition, state, target_index)
+    #The permission tasks use them: the ACLs already applied aren't fetched nor sent again
+    assert workspace.calls[query_acl] == 0 and workspace.calls[dashboard_acl] == 0
+    assert writes(workspace) == {}
+    assert new_state["permissions_hash"] == load_dashboard.get_permissions_hash(client)
+
+
+def test_acl_not_prefetched(target, cloned):
+    workspace, client = target
+    definition, state = cloned
+    #The state has the permissions hashes: no ACL to fetch
+    TargetIndex(client, {definition["id"]: state})
+    assert workspace.calls[query_acl] == 0 and workspace.calls[dashboard_acl] == 0